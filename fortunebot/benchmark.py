@@ -0,0 +1,433 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks the bot offline. A recorded IRC log (or a generated one) is
+replayed through the bot's message handling with a fake connection, and the
+scripts that would reach the network are fed canned pages instead. Micro
+benchmarks cover markov training and generation, replace and CacheDict.
+
+Each benchmark runs in its own process, so its peak memory can be measured.
+Results can be saved as a baseline, and later runs are compared against it,
+flagging metrics that got worse by more than the tolerance.
+
+A log has one message per line, as "#channel nick message". Lines that don't
+start with a channel are said by a default nick in a default channel.
+
+Hooked by setuptools into `fortunebot-benchmark`
+"""
+
+from __future__ import print_function
+import sys
+import os
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import multiprocessing
+from collections import defaultdict
+from argparse import ArgumentParser
+
+import mock
+import irc.client
+from fortunebot.bot import Fortunebot
+from fortunebot.scripts.markov import Markov
+from fortunebot.scripts.replace import Replace
+from fortunebot.utils import CacheDict, MarkovTable
+from fortunebot.utils.fortunedb import write_strfile
+
+SEED = 1234
+RESPOND = "fortunebot"
+CHANNELS = ["#bench", "#bench2"]
+NICKS = ["nick{0}".format(i) for i in range(50)]
+# Messages between simulated polls
+POLL_EVERY = 500
+# Latency changes smaller than this are noise
+MIN_MS = 0.1
+
+CONFIG = """
+[Connect]
+server = localhost
+port = 6667
+channels = {channels}
+nickname = {respond}
+realname = {respond}
+reconnect_tries = 0
+reconnect_interval = 0
+ping_tries = 0
+ping_interval = 30
+
+[Outbound]
+burst = 1000000
+rate = 1000000
+
+[Scripts]
+enable = yes
+weather_key = bench
+weather_cachedur = 300
+weather_zippath =
+insult_pool = 20
+fortune_length = 100
+fortune_path = {tmpdir}/fortunes
+markov_path = {tmpdir}/corpus.txt
+markov_listen = yes
+markov_record = no
+markov_respond = {respond}
+remind_tasklimit = 1000
+replace_shortcut = yes
+replace_maxlength = 200
+replace_maxlines = 20
+burn_words = your face
+"""
+
+INSULT_PAGE = "<html>\nThou art a bench-pressing knave.</font>\n</html>"
+GEOIP_PAGE = json.dumps({"zip_code": "90024"})
+WEATHER_PAGE = json.dumps({"data": {
+    "nearest_area": [{"areaName": [{"value": "Los Angeles"}],
+                      "region": [{"value": "California"}]}],
+    "current_condition": [{"temp_F": "70", "temp_C": "21",
+                           "weatherDesc": [{"value": "Sunny"}],
+                           "humidity": "40"}],
+}})
+
+class FakeClient(object):
+    """
+    Stands in for the HTTP client, answering with canned pages
+    """
+
+    def get(self, url, **kwargs):
+        if "pangloss" in url:
+            text = INSULT_PAGE
+        elif "geoip" in url:
+            text = GEOIP_PAGE
+        else:
+            text = WEATHER_PAGE
+        return mock.Mock(text=text, status_code=200)
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.sent = 0
+
+    def privmsg(self, target, text):
+        self.sent += 1
+
+def make_words(rng, count):
+    syllables = ["ka", "lo", "mi", "ne", "ru", "sa", "ti", "vo", "ze", "pu"]
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(syllables)
+                          for _ in range(rng.randint(1, 4))))
+    return sorted(words)
+
+def make_corpus(rng, count):
+    """
+    Make up count lines of chatter, with word frequencies falling off like in
+    natural language
+    """
+    words = make_words(rng, 5000)
+    lines = []
+    for _ in range(count):
+        length = rng.randint(3, 15)
+        lines.append(" ".join(
+            words[min(int(rng.paretovariate(1.1)) - 1, len(words) - 1)]
+            for _ in range(length)))
+    return lines
+
+def make_log(rng, count, corpus):
+    """
+    Make up count messages of chatter mixed with commands, as log lines
+    """
+    commands = ["!w 90024", "!w", "!fortune", "!insult", "!8ball will it?",
+                "!choose this that", "!remind -s 30 stretch", "!help",
+                "s/a/o/", "{0} what now".format(RESPOND)]
+    lines = []
+    for _ in range(count):
+        if rng.random() < 0.25:
+            text = rng.choice(commands)
+        else:
+            text = rng.choice(corpus)
+        lines.append("{0} {1} {2}".format(rng.choice(CHANNELS),
+                                          rng.choice(NICKS), text))
+    return lines
+
+def parse_log(lines):
+    messages = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if not line.strip():
+            continue
+        if line.startswith("#"):
+            parts = line.split(None, 2)
+            if len(parts) < 3:
+                continue
+            channel, nick, text = parts
+        else:
+            channel, nick, text = CHANNELS[0], NICKS[0], line
+        messages.append((channel, nick, text))
+    return messages
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+def peak_rss():
+    # Kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def bench_replay(log, corpus):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(tmpdir, "corpus.txt"), "w") as f:
+            for line in corpus:
+                f.write(line + "\n")
+        os.mkdir(os.path.join(tmpdir, "fortunes"))
+        rng = random.Random(SEED)
+        write_strfile(os.path.join(tmpdir, "fortunes", "bench"),
+                      [" ".join(rng.sample(corpus, 2))[:90]
+                       for _ in range(1000)])
+        confpath = os.path.join(tmpdir, "fortunebot.conf")
+        with open(confpath, "w") as f:
+            f.write(CONFIG.format(channels=" ".join(CHANNELS), respond=RESPOND,
+                                  tmpdir=tmpdir))
+
+        client = FakeClient()
+        with mock.patch("fortunebot.scripts.weather.get_client",
+                        lambda: client), \
+                mock.patch("fortunebot.scripts.insult.get_client",
+                           lambda: client):
+            bot = Fortunebot()
+            bot.connection = FakeConnection()
+            bot.load_config([confpath])
+            return replay(bot, parse_log(log))
+    finally:
+        shutil.rmtree(tmpdir)
+
+def replay(bot, messages):
+    latencies = defaultdict(list)
+    call_script = bot.call_script
+    def timed(name, s, hook, channel, *args):
+        start = time.time()
+        try:
+            return call_script(name, s, hook, channel, *args)
+        finally:
+            latencies[(name, hook)].append(time.time() - start)
+    bot.call_script = timed
+
+    start = time.time()
+    for i, (channel, nick, text) in enumerate(messages):
+        source = irc.client.NickMask("{0}!{0}@{0}.example.com".format(nick))
+        bot.on_pubmsg(bot.connection,
+                      irc.client.Event("pubmsg", source, channel, [text]))
+        if i % POLL_EVERY == POLL_EVERY - 1:
+            for name, s in list(bot.scripts.items()):
+                if "on_poll" in dir(s):
+                    for ch in CHANNELS:
+                        bot.dispatcher.submit(name, ch, timed, name, s,
+                                              "on_poll", ch, ch)
+    bot.dispatcher.wait()
+    bot.outbox.wait()
+    elapsed = time.time() - start
+
+    res = {
+        "messages_per_sec": len(messages) / elapsed,
+        "sent": bot.connection.sent,
+        "peak_rss_kb": peak_rss(),
+    }
+    for (name, hook), values in latencies.items():
+        for q in [50, 95, 99]:
+            res["{0}.{1}.p{2}_ms".format(name, hook, q)] = \
+                percentile(values, q / 100.0) * 1000
+    return res
+
+def bench_markov_train(corpus):
+    start = time.time()
+    table = MarkovTable()
+    for line in corpus:
+        for triplet in Markov.triples(line):
+            table.add_triple(*triplet)
+    table.compact()
+    elapsed = time.time() - start
+    return {"lines_per_sec": len(corpus) / elapsed, "peak_rss_kb": peak_rss()}
+
+def bench_markov_generate(corpus, count=2000):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, "corpus.txt")
+        with open(path, "w") as f:
+            for line in corpus:
+                f.write(line + "\n")
+        markov = Markov(path, False, False, RESPOND)
+    finally:
+        shutil.rmtree(tmpdir)
+    random.seed(SEED)
+    rng = random.Random(SEED)
+    latencies = []
+    start = time.time()
+    for _ in range(count):
+        text = "{0} {1}".format(RESPOND, rng.choice(corpus))
+        t = time.time()
+        markov.generate(text)
+        latencies.append(time.time() - t)
+    elapsed = time.time() - start
+    return {"generations_per_sec": count / elapsed,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p95_ms": percentile(latencies, 0.95) * 1000,
+            "peak_rss_kb": peak_rss()}
+
+def bench_replace(corpus, count=20000):
+    replace = Replace(True, 200, 20)
+    rng = random.Random(SEED)
+    sources = [irc.client.NickMask("{0}!{0}@example.com".format(n))
+               for n in NICKS]
+    commands = ["s/a/o/", "s/ka/ke/g", "s/lo+/LO/s", "!replace -l 2 ru RU"]
+    start = time.time()
+    for _ in range(count):
+        source = rng.choice(sources)
+        if rng.random() < 0.3:
+            text = rng.choice(commands)
+        else:
+            text = rng.choice(corpus)
+        replace.on_pubmsg(source, CHANNELS[0], text)
+    elapsed = time.time() - start
+    replace.on_unload()
+    return {"messages_per_sec": count / elapsed, "peak_rss_kb": peak_rss()}
+
+def bench_cachedict(count=200000):
+    rng = random.Random(SEED)
+    cache = CacheDict(limit=count // 2)
+    start = time.time()
+    for i in range(count):
+        cache.insert(i, i, rng.randint(0, 3600))
+        if i % 3 == 0:
+            key = rng.randint(max(0, i - 1000), i)
+            if key in cache:
+                del cache[key]
+    # Everything due within the next half hour
+    cache.prune(-1800)
+    elapsed = time.time() - start
+    return {"ops_per_sec": count / elapsed, "peak_rss_kb": peak_rss()}
+
+def isolated(conn, func, args):
+    try:
+        conn.send((True, func(*args)))
+    except Exception as e:
+        conn.send((False, e))
+
+def run_isolated(func, *args):
+    """
+    Run a benchmark in a fresh process, so it has its own peak memory. It
+    isn't daemonic, so the scripts it runs may start processes of their own.
+    """
+    conn, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(target=isolated, args=(child, func, args))
+    proc.start()
+    child.close()
+    try:
+        ok, res = conn.recv()
+    finally:
+        proc.join()
+        conn.close()
+    if not ok:
+        raise res
+    return res
+
+def run(names, messages, corpus_lines, log_path=None):
+    rng = random.Random(SEED)
+    corpus = make_corpus(rng, corpus_lines)
+    if log_path:
+        with open(log_path) as f:
+            log = f.readlines()
+    else:
+        log = make_log(rng, messages, corpus)
+    benchmarks = [
+        ("replay", bench_replay, (log, corpus)),
+        ("markov_train", bench_markov_train, (corpus,)),
+        ("markov_generate", bench_markov_generate, (corpus,)),
+        ("replace", bench_replace, (corpus,)),
+        ("cachedict", bench_cachedict, ()),
+    ]
+    results = {}
+    for name, func, args in benchmarks:
+        if names and name not in names:
+            continue
+        results[name] = run_isolated(func, *args)
+    return results
+
+def compare(results, baseline, tolerance):
+    """
+    Get descriptions of the metrics that got worse than the baseline by more
+    than tolerance. Rates should go up, and everything else down.
+    """
+    regressions = []
+    for name, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get(name, {}).get(metric)
+            if not old or metric == "sent":
+                continue
+            if metric.endswith("_per_sec"):
+                worse = value < old * (1 - tolerance)
+            else:
+                worse = value > old * (1 + tolerance)
+                if metric.endswith("_ms") and value - old < MIN_MS:
+                    worse = False
+            if worse:
+                regressions.append("{0}.{1}: {2:.4g} (baseline {3:.4g})".format(
+                    name, metric, value, old))
+    return regressions
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument(
+        "benchmarks", nargs="*",
+        help="Benchmarks to run, out of replay, markov_train, "
+            "markov_generate, replace and cachedict. Default all")
+    parser.add_argument(
+        "--log", default=None,
+        help="IRC log to replay. Default a generated one")
+    parser.add_argument(
+        "--messages", type=int, default=20000,
+        help="Number of messages to generate for the replay. Default 20000")
+    parser.add_argument(
+        "--corpus-lines", type=int, default=20000, dest="corpus_lines",
+        help="Number of lines of markov corpus to generate. Default 20000")
+    parser.add_argument(
+        "--baseline", default="fortunebot-benchmark.json",
+        help="Baseline file to compare against. Default "
+            "fortunebot-benchmark.json")
+    parser.add_argument(
+        "--save", action="store_true", default=False,
+        help="Save the results as the new baseline")
+    parser.add_argument(
+        "--tolerance", type=float, default=0.25,
+        help="Fraction by which a metric may get worse before it's flagged. "
+            "Default 0.25")
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    results = run(args.benchmarks, args.messages, args.corpus_lines, args.log)
+    for name, metrics in sorted(results.items()):
+        print(name)
+        for metric, value in sorted(metrics.items()):
+            print("    {0}: {1:.4g}".format(metric, value))
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to {0}".format(args.baseline))
+    if regressions:
+        print("Regressions against {0}:".format(args.baseline))
+        for r in regressions:
+            print("    " + r)
+        sys.exit(1)
@@ -7,6 +7,10 @@ bot.py
 The main bot engine, a subclass of irclib's SingleServerIRCBot. It's fitted
 with a configuration system, dynamic script plug-in system, and slightly
 enhanced basic IRC event handling (reconnects, etc).
+
+Reloading the config only rebuilds the scripts whose settings changed, in the
+background, and swaps them in once they're ready. The rest keep running
+undisturbed, along with whatever they've loaded or learned.
 """
 
 import six
@@ -16,6 +20,7 @@ import errno
 import logging
 import importlib
 import inspect
+import threading
 import irc.bot
 import fortunebot.utils as utils
 import fortunebot.scripts
@@ -32,51 +37,152 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
         super(Fortunebot, self).__init__([], "", "")
         self.config = {}
         self.scripts = {}
+        self.specs = {}
+        self.limits = {}
         self.help_msg = {}
-        self.poll_thread = utils.RepeatingThread(1.0, 0.0, 0, self.on_poll)
+        self.router = utils.Router()
+        self.reload_lock = threading.Lock()
+        self.scheduler = utils.Scheduler()
+        self.dispatcher = utils.Dispatcher(self.send_msg,
+                                           schedule=self.scheduler.call_later)
+        self.outbox = utils.Outbox(self.send_line)
+        self.stats = utils.Stats()
+        self.stats.add_gauge("outbox_depth", self.outbox.depth)
+        self.stats.add_gauge("dispatcher_pending", self.dispatcher.depth)
+        self.stats_server = None
         self.ping_thread = utils.RepeatingThread(30.0, 0.0, 0, self.probe_connection)
         self.ping_ignored = 0
         self.exit = False
 
     def clean(self):
+        self.unload_scripts(self.scripts)
         for name in list(self.scripts):
             del self.scripts[name]
+        self.specs = {}
+        self.limits = {}
+
+    def save_scripts(self, scripts):
+        """
+        Give scripts about to be replaced a chance to save their state
+        without stopping, so their replacements start from it
+        """
+        for name, s in six.iteritems(scripts):
+            if "on_save" in dir(s):
+                try:
+                    s.on_save()
+                except Exception as e:
+                    logger.warning("{0} script error during on_save: {1}".format(name, e))
+
+    def unload_scripts(self, scripts):
+        """
+        Give scripts about to be dropped a chance to save their state
+        """
+        for name, s in six.iteritems(scripts):
+            if "on_unload" in dir(s):
+                try:
+                    s.on_unload()
+                except Exception as e:
+                    logger.warning("{0} script error during on_unload: {1}".format(name, e))
 
     def load_config(self, confpaths):
+        """
+        Load the config. Scripts whose class and settings are unchanged are
+        kept as they are. Replacements for the rest are built while the old
+        ones carry on handling messages, and swapped in once they're ready.
+        A script whose replacement fails to build keeps running as it was.
+        """
         logger.info("Loading config from {0}".format(", ".join(confpaths)))
+        with self.reload_lock:
 
-        # Reset configurations
-        self.config = {}
-        self.scripts = {}
-        self.help_msg = {}
+            # Read core settings from config file
+            sections = ["Connect", "Dispatch", "Outbound", "Stats", "Scripts"]
+            parser = utils.EasyConfigParser(sections=sections)
+            if not parser.read(confpaths):
+                raise Exception("No config files were found or successfully read. "
+                    "Try generating one with fortunebot-generate-config.")
+            config = {
+                "server": parser.get("Connect", "server"),
+                "port": parser.getint("Connect", "port"),
+                "channels": parser.get("Connect", "channels"),
+                "nickname": parser.get("Connect", "nickname"),
+                "realname": parser.get("Connect", "realname"),
+                "reconnect_tries": parser.getint("Connect", "reconnect_tries"),
+                "reconnect_interval": parser.getint("Connect", "reconnect_interval"),
+                "ping_tries": parser.getint("Connect", "ping_tries"),
+                "ping_interval": parser.getint("Connect", "ping_interval"),
+            }
+            config["channels"] = config["channels"].split()
+            config["channels"] = [c if c[0] == '#' else '#' + c
+                                  for c in config["channels"]]
+            config["reconnect_tries"] = max(0, config["reconnect_tries"])
+            config["reconnect_interval"] = max(0, config["reconnect_interval"])
+            config["ping_tries"] = max(0, config["ping_tries"])
+            config["ping_interval"] = max(0, config["ping_interval"])
+            config["stats_admins"] = parser.get("Stats", "admins",
+                                                fallback="").split()
+            self.config = config
+            if self.ping_thread:
+                self.ping_thread.change_interval(self.config["ping_interval"])
+            self.dispatcher.configure(
+                parser.getint("Dispatch", "workers", fallback=4),
+                parser.getfloat("Dispatch", "timeout", fallback=10.0),
+                parser.getint("Dispatch", "concurrency", fallback=1))
+            self.outbox.configure(
+                parser.getfloat("Outbound", "rate", fallback=2.0),
+                parser.getint("Outbound", "burst", fallback=5))
+            self.serve_stats(parser.get("Stats", "host", fallback="127.0.0.1"),
+                             parser.getint("Stats", "port", fallback=0))
+
+            specs, limits = self.read_specs(parser)
+            changed = dict((name, s) for name, s in six.iteritems(self.scripts)
+                           if name in specs and self.specs[name] != specs[name])
+            # Their replacements pick up from what they've saved
+            self.save_scripts(changed)
 
-        # Read core settings from config file
-        sections = ["Connect", "Scripts"]
-        parser = utils.EasyConfigParser(sections=sections)
-        if not parser.read(confpaths):
-            raise Exception("No config files were found or successfully read. "
-                "Try generating one with fortunebot-generate-config.")
-        self.config = {
-            "server": parser.get("Connect", "server"),
-            "port": parser.getint("Connect", "port"),
-            "channels": parser.get("Connect", "channels"),
-            "nickname": parser.get("Connect", "nickname"),
-            "realname": parser.get("Connect", "realname"),
-            "reconnect_tries": parser.getint("Connect", "reconnect_tries"),
-            "reconnect_interval": parser.getint("Connect", "reconnect_interval"),
-            "ping_tries": parser.getint("Connect", "ping_tries"),
-            "ping_interval": parser.getint("Connect", "ping_interval"),
-        }
-        self.config["channels"] = self.config["channels"].split()
-        self.config["channels"] = [c if c[0] == '#' else '#' + c
-                                   for c in self.config["channels"]]
-        self.config["reconnect_tries"] = max(0, self.config["reconnect_tries"])
-        self.config["reconnect_interval"] = max(0, self.config["reconnect_interval"])
-        self.config["ping_tries"] = max(0, self.config["ping_tries"])
-        self.config["ping_interval"] = max(0, self.config["ping_interval"])
-        if self.ping_thread:
-            self.ping_thread.change_interval(self.config["ping_interval"])
+            # Instantiate the scripts that changed or aren't running yet
+            scripts = dict((name, s) for name, s in six.iteritems(self.scripts)
+                           if name in specs)
+            built = {}
+            for name, (c, params) in sorted(six.iteritems(specs)):
+                if name in scripts and name not in changed:
+                    continue
+                try:
+                    built[name] = c(**params)
+                except Exception as e:
+                    logger.warning("Script {0} initialization error: {1}".format(name, e))
+            scripts.update(built)
+            self.specs = dict((name, specs[name] if name in built else
+                               self.specs[name]) for name in scripts)
+            self.limits = dict((name, limits[name] if name in built else
+                                self.limits[name]) for name in scripts)
+            retired = dict((name, s) for name, s in six.iteritems(self.scripts)
+                           if scripts.get(name) is not s)
+            self.swap_scripts(scripts)
+            if retired:
+                self.unload_scripts(retired)
+                logger.info("Dropped: {0}".format(", ".join(retired)))
+        logger.info("Successfully loaded: {0}".format(", ".join(self.scripts)))
 
+    def reload_config(self, confpaths):
+        """
+        Load the config on a background thread, so slow scripts don't hold up
+        the connection while they start. Returns the thread.
+        """
+        def reload():
+            try:
+                self.load_config(confpaths)
+            except Exception as e:
+                logger.warning("Unable to reload config: {0}".format(e))
+        t = threading.Thread(target=reload)
+        t.daemon = True
+        t.start()
+        return t
+
+    def read_specs(self, parser):
+        """
+        Get the class and parameters of each script enabled in the config,
+        along with the dispatcher limits of each, to apply once it's running
+        """
         # Dynamically load scripts
         prefix = "fortunebot.scripts"
         module_names = fortunebot.scripts.__all__
@@ -94,26 +200,68 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
                     break
         # Look for global default enable/disable flag
         enable_all = parser.getboolean("Scripts", "enable", fallback=False)
-        # Retrieve configurations and instantiate script objects
+        # Retrieve configurations of enabled scripts
         pfuncs = {'str': parser.get,
                   'int': parser.getint,
                   'float': parser.getfloat,
                   'bool': parser.getboolean}
+        specs = {}
+        limits = {}
         for c in classes:
             try :
                 ename = "enable_{0}".format(c.NAME)
                 if parser.getboolean("Scripts", ename, fallback=enable_all):
                     params = {}
                     if "PARAMS" in dir(c):
-                        for t, p in c.PARAMS:
-                            params[p] = pfuncs[t]("Scripts", "{0}_{1}"
-                                                  .format(c.NAME, p))
-                    if "HELP" in dir(c):
-                        self.help_msg[c.NAME] = c.HELP
-                    self.scripts[c.NAME] = c(**params)
+                        # A third element is the default for optional params
+                        for param in c.PARAMS:
+                            t, p = param[:2]
+                            option = "{0}_{1}".format(c.NAME, p)
+                            if len(param) > 2:
+                                params[p] = pfuncs[t]("Scripts", option,
+                                                      fallback=param[2])
+                            else:
+                                params[p] = pfuncs[t]("Scripts", option)
+                    limits[c.NAME] = (getattr(c, "CONCURRENCY", None),
+                                      getattr(c, "TIMEOUT", None))
+                    specs[c.NAME] = (c, params)
             except Exception as e:
                 logger.warning("Script {0} initialization error: {1}".format(c.NAME, e))
-        logger.info("Successfully loaded: {0}".format(", ".join(self.scripts)))
+        return specs, limits
+
+    def swap_scripts(self, scripts):
+        """
+        Start routing messages to scripts instead of the running ones
+        """
+        for name in scripts:
+            if name in self.limits:
+                self.dispatcher.set_limits(name, *self.limits[name])
+        self.help_msg = dict((name, s.HELP) for name, s in six.iteritems(scripts)
+                             if "HELP" in dir(s))
+        self.router = utils.Router(scripts)
+        self.scripts = scripts
+        self.schedule_polls()
+
+    def serve_stats(self, host, port):
+        """
+        Serve stats over HTTP at host and port, or stop serving them if port
+        is 0
+        """
+        server = self.stats_server
+        if server and server.server_address[1] == port and \
+                server.host == host:
+            return
+        if server:
+            server.stop()
+            self.stats_server = None
+        if not port:
+            return
+        try:
+            self.stats_server = utils.StatsServer(self.stats, host, port)
+            self.stats_server.start()
+            logger.info("Serving stats at {0}:{1}".format(host, port))
+        except Exception as e:
+            logger.warning("Unable to serve stats: {0}".format(e))
 
     def start(self):
         if not self.config["server"] or not self.config["channels"]:
@@ -135,14 +283,17 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
             return
         if not isinstance(msg, list):
             msg = [msg]
-        c = self.connection
+        lines = []
         for m in msg:
             try:
                 m = utils.to_unicode(m)
-                m = utils.strip_unprintable(m)
-                c.privmsg(channel, m)
+                lines.append(utils.strip_unprintable(m))
             except Exception as e:
                 logger.warning("Failed on send_msg: {}".format(e))
+        self.outbox.put(channel, lines)
+
+    def send_line(self, channel, line):
+        self.connection.privmsg(channel, line)
 
     def reconnect(self):
         for count in range(self.config["reconnect_tries"]):
@@ -156,7 +307,8 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
 
     def on_disconnect(self, c, e):
         logger.info("Disconnected from server")
-        self.poll_thread.cancel()
+        self.scheduler.cancel()
+        self.outbox.clear()
         self.ping_thread.cancel()
         self.ping_ignored = 0
         if self.config["reconnect_tries"]:
@@ -167,7 +319,7 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
 
     def on_welcome(self, c, e):
         logger.info("Connected to server")
-        self.poll_thread.start()
+        self.scheduler.start()
         self.ping_thread.start()
         for ch in self.config["channels"]:
             c.join(ch)
@@ -183,16 +335,51 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
     def on_pong(self, c, e):
         self.ping_ignored = 0
 
-    def on_poll(self):
+    def schedule_polls(self):
+        for key in self.scheduler.scheduled():
+            self.scheduler.remove(key)
         for name, s in six.iteritems(self.scripts):
             if "on_poll" in dir(s):
                 for ch in self.config["channels"]:
-                    try:
-                        msg = s.on_poll(ch)
-                    except Exception as e:
-                        logger.warning("{0} script error during on_poll for {1}: {2}".format(name, ch, e))
-                        msg = None
-                    self.send_msg(ch, msg)
+                    self.schedule_poll(name, s, ch)
+
+    def schedule_poll(self, name, s, channel):
+        """
+        Schedule the next on_poll of a script for a channel at the time the
+        script's next_poll asks for. Scripts without a next_poll are polled
+        every second.
+        """
+        if self.scripts.get(name) is not s or "on_poll" not in dir(s):
+            # Replaced by a reload, or nothing to poll
+            return
+        if "next_poll" in dir(s):
+            try:
+                when = s.next_poll(channel)
+            except Exception as e:
+                logger.warning("{0} script error during next_poll for {1}: {2}".format(name, channel, e))
+                when = None
+        else:
+            when = time.time() + 1
+        key = (name, channel)
+        if when is None:
+            self.scheduler.remove(key)
+        else:
+            self.scheduler.call_at(when, lambda: self.dispatcher.submit(
+                name, channel, self.call_script, name, s, "on_poll", channel,
+                channel), key)
+
+    def call_script(self, name, s, hook, channel, *args):
+        start = time.time()
+        error = False
+        try:
+            return getattr(s, hook)(*args)
+        except Exception as e:
+            error = True
+            logger.warning("{0} script error during {1} for {2}: {3}".format(name, hook, channel, e))
+        finally:
+            self.stats.record(name, hook, time.time() - start, error)
+            if hook == "on_poll" or "next_poll" in dir(s):
+                self.schedule_poll(name, s, channel)
 
     def parse_help(self, text):
         msg = None
@@ -211,6 +398,14 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
                 msg += ", ".join(self.scripts)
         return msg
 
+    def parse_stats(self, source, text):
+        if text.split()[:1] != ["!stats"]:
+            return None
+        nick = getattr(source, "nick", source)
+        if nick not in self.config.get("stats_admins", []):
+            return None
+        return self.stats.summary()
+
     def on_privmsg(self, c, e):
 
         # Extract info
@@ -222,6 +417,11 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
         if help_msg:
             self.send_msg(source, help_msg)
 
+        # Handle stats
+        stats_msg = self.parse_stats(source, text)
+        if stats_msg:
+            self.send_msg(source.nick, stats_msg)
+
     def on_pubmsg(self, c, e):
 
         # Extract info
@@ -229,20 +429,22 @@ class Fortunebot(irc.bot.SingleServerIRCBot):
         channel = e.target
         text = e.arguments[0]
 
+        self.stats.message(channel)
+
         # Handle help
         help_msg = self.parse_help(text)
         if help_msg:
             self.send_msg(channel, help_msg)
 
-        # Invoke scripts
-        for name, s in six.iteritems(self.scripts):
-            if "on_pubmsg" in dir(s):
-                try:
-                    msg = s.on_pubmsg(source, channel, text)
-                except Exception as ex:
-                    logger.warning("{0} script error during on_pubmsg: {1}".format(name, ex))
-                    msg = None
-                self.send_msg(channel, msg)
+        # Handle stats
+        stats_msg = self.parse_stats(source, text)
+        if stats_msg:
+            self.send_msg(channel, stats_msg)
+
+        # Invoke interested scripts on the worker threads
+        for name, s in self.router.route(text):
+            self.dispatcher.submit(name, channel, self.call_script, name, s,
+                                   "on_pubmsg", channel, source, channel, text)
 
     def process_forever(self, timeout=0.2):
         """
@@ -5,33 +5,40 @@
 Entry class into fortunebot. Sets up basic logging, handles file paths,
 and daemonizes the process if necessary.
 
+Given shard config files, runs a supervisor instead, which runs one bot per
+shard in its own worker process and restarts any that die. Each shard's
+config is read over the common ones, so a shard only needs to set what differs,
+like the server and channels. Shards may point markov_snapshot at the same
+file to share a single copy of the model in memory, but only one of them may
+save it; the rest set markov_snapshot_save off and map it read-only. The
+supervisor won't start shards that would both save the same snapshot.
+
 Hooked by setuptools into `fortunebot`
 """
 
 import six
 import sys
 import os
+import time
+import errno
 import signal
 import resource
 import logging
 import appdirs
 from argparse import ArgumentParser
 from fortunebot.bot import Fortunebot
+import fortunebot.utils as utils
 logger = logging.getLogger("fortunebot")
 
 class FortunebotRunner(object):
 
-    def __init__(self, daemonize, pidpath, logpath, confpath, workpath):
+    def __init__(self, daemonize, pidpath, logpath, confpath, workpath,
+                 shard=None):
         self.daemonize = daemonize
         self.workpath = os.path.abspath(workpath)
         self.pidpath = self.resolved(pidpath)
         self.logpath = self.resolved(logpath)
-        self.confpaths = [
-            os.path.join(
-                appdirs.user_config_dir("fortunebot"), "fortunebot.conf"),
-            self.resolved("fortunebot.conf"),
-            self.resolved(confpath),
-        ]
+        self.confpaths = self.shard_confpaths(confpath, shard)
         try:
             self.bot = Fortunebot()
         except Exception as ex:
@@ -40,6 +47,20 @@ class FortunebotRunner(object):
     def resolved(self, path):
         return os.path.abspath(os.path.join(self.workpath, path))
 
+    def shard_confpaths(self, confpath, shard=None):
+        """
+        Get the config files to read, in order, with shard's last if given
+        """
+        confpaths = [
+            os.path.join(
+                appdirs.user_config_dir("fortunebot"), "fortunebot.conf"),
+            self.resolved("fortunebot.conf"),
+            self.resolved(confpath),
+        ]
+        if shard:
+            confpaths.append(self.resolved(shard))
+        return confpaths
+
     def start(self):
         if self.status():
             die("Bot already running!")
@@ -52,6 +73,9 @@ class FortunebotRunner(object):
             self.setup_logging()
             self.writepid()
 
+        self.run()
+
+    def run(self):
         try:
             os.chdir(self.workpath)
         except Exception as ex:
@@ -181,7 +205,123 @@ class FortunebotRunner(object):
 
     def sighup_handler(self, signum, frame):
         logger.info("Reloading bot configs")
-        self.bot.load_config(self.confpaths)
+        self.bot.reload_config(self.confpaths)
+
+class FortunebotSupervisor(FortunebotRunner):
+
+    RESTART_DELAY = 30
+
+    def __init__(self, daemonize, pidpath, logpath, confpath, workpath,
+                 shards):
+        self.daemonize = daemonize
+        self.workpath = os.path.abspath(workpath)
+        self.pidpath = self.resolved(pidpath)
+        self.logpath = self.resolved(logpath)
+        self.confpath = confpath
+        self.shards = shards
+        self.children = {}
+        self.exiting = False
+
+    def run(self):
+        try:
+            os.chdir(self.workpath)
+        except Exception as ex:
+            die("Died while changing to workpath: {}".format(ex))
+
+        for snapshot, shards in six.iteritems(self.snapshot_writers()):
+            if len(shards) > 1:
+                die("Shards {0} would all save markov_snapshot {1}. Set "
+                    "markov_snapshot_save = no for all but one of them, or "
+                    "give each its own snapshot".format(
+                        ", ".join(shards), snapshot))
+        logger.info("Starting {0} shards".format(len(self.shards)))
+        for shard in self.shards:
+            self.spawn(shard)
+        self.supervise()
+        self.clean()
+        os._exit(0)
+
+    def snapshot_writers(self):
+        """
+        Get the shards that save each markov snapshot. A shard saving a
+        snapshot another one saves would write over its counts, and replace
+        the file under it while it's switching over to its own.
+        """
+        writers = {}
+        for shard in self.shards:
+            parser = utils.EasyConfigParser(sections=["Scripts"])
+            parser.read(self.shard_confpaths(self.confpath, shard))
+            enabled = parser.getboolean(
+                "Scripts", "enable_markov",
+                fallback=parser.getboolean("Scripts", "enable", fallback=False))
+            snapshot = parser.get("Scripts", "markov_snapshot", fallback="")
+            if (enabled and snapshot and
+                    parser.getboolean("Scripts", "markov_snapshot_save",
+                                      fallback=True)):
+                path = self.resolved(snapshot)
+                writers.setdefault(path, []).append(shard)
+        return writers
+
+    def spawn(self, shard):
+        """
+        Fork a worker process running a bot for shard
+        """
+        try:
+            pid = os.fork()
+        except OSError as e:
+            logger.error("Unable to fork shard {0}. {1}".format(shard, e.strerror))
+            return
+        if pid:
+            self.children[pid] = shard
+            return
+        # The bot's threads are only started in the worker, since they
+        # wouldn't survive the fork
+        self.children = {}
+        try:
+            runner = FortunebotRunner(False, self.pidpath, self.logpath,
+                                      self.confpath, self.workpath, shard)
+            runner.setup_signals()
+            logger.info("Starting shard {0}".format(shard))
+            runner.run()
+        except Exception:
+            logger.exception("Shard {0} died:".format(shard))
+        os._exit(1)
+
+    def supervise(self):
+        """
+        Wait on the workers, restarting any that exit until told to stop
+        """
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                break
+            shard = self.children.pop(pid, None)
+            if shard is None or self.exiting:
+                continue
+            logger.warning("Shard {0} exited with status {1}, restarting in "
+                           "{2} seconds".format(shard, status, self.RESTART_DELAY))
+            time.sleep(self.RESTART_DELAY)
+            if not self.exiting:
+                self.spawn(shard)
+
+    def signal_children(self, signum):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    def sigterm_handler(self, signum, frame):
+        logger.info("Stopping shards...")
+        self.exiting = True
+        self.signal_children(signal.SIGTERM)
+
+    def sighup_handler(self, signum, frame):
+        logger.info("Reloading shard configs")
+        self.signal_children(signal.SIGHUP)
 
 def parse_args(args):
     parser = ArgumentParser()
@@ -202,6 +342,10 @@ def parse_args(args):
         help="Specify the working directory of the process, which affects "
             "all relative paths on command line and config file. Default "
             "current directory")
+    parser.add_argument(
+        "--shard", action="append", default=[], dest="shards",
+        help="Run a bot in its own process for each shard config file given, "
+            "read over the common config file. Can be given multiple times")
     return parser.parse_args(args)
 
 def die(msg, code=1):
@@ -221,7 +365,12 @@ def main():
     args = parse_args(sys.argv[1:])
 
     # Start the bot!
-    runner = FortunebotRunner(args.daemonize, args.pidpath,
-                              args.logpath, args.confpath,
-                              args.workpath)
+    if args.shards:
+        runner = FortunebotSupervisor(args.daemonize, args.pidpath,
+                                      args.logpath, args.confpath,
+                                      args.workpath, args.shards)
+    else:
+        runner = FortunebotRunner(args.daemonize, args.pidpath,
+                                  args.logpath, args.confpath,
+                                  args.workpath)
     runner.start()
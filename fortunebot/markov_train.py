@@ -0,0 +1,200 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Builds a markov snapshot out of a corpus file using a pool of processes, so
+the bot can load the model at startup instead of reading the corpus itself.
+Point markov_snapshot at the output, and markov_path at the same corpus to
+keep reading lines appended after training.
+
+The corpus is split into byte ranges on line boundaries. A first pass over the
+ranges collects the vocabulary, so that every worker interns words to the same
+ids. A second pass counts the triples of each range into a partial snapshot,
+and the partial snapshots are then merged in parallel, with each worker taking
+a slice of the key space.
+
+Snapshots are built with contexts up to the 2nd order, whose keys are made of
+word ids shared by every worker. Longer contexts are keyed by trie nodes each
+worker would number differently, so a bot with a higher markov_order reads the
+corpus itself instead.
+
+Hooked by setuptools into `fortunebot-markov-train`
+"""
+
+from __future__ import print_function
+import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
+from array import array
+from argparse import ArgumentParser
+from fortunebot.scripts.markov import Markov
+from fortunebot.utils.markovtable import (MarkovTable, Vocabulary,
+                                          write_snapshot, read_snapshot,
+                                          merge_rows)
+from fortunebot.utils.recorder import end_position
+
+# Vocabulary shared by the counting workers, set up by init_worker
+worker_vocab = None
+
+def split_ranges(path, count):
+    """
+    Split the file into up to count byte ranges starting on line boundaries
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+    with open(path, "rb") as f:
+        for i in range(1, count):
+            f.seek(max(size * i // count, bounds[-1]))
+            f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(bounds[i], bounds[i+1]) for i in range(count)
+            if bounds[i] < bounds[i+1]]
+
+def read_lines(path, start, end, respond):
+    with open(path, "rb") as f:
+        f.seek(start)
+        pos = start
+        while pos < end:
+            line = f.readline()
+            if not line:
+                break
+            pos += len(line)
+            line = line.decode("utf-8", "replace")
+            if respond not in line:
+                yield line
+
+def collect_words(task):
+    path, start, end, respond = task
+    words = set()
+    for line in read_lines(path, start, end, respond):
+        words.update(line.split())
+    return words
+
+def init_worker(words):
+    global worker_vocab
+    worker_vocab = Vocabulary()
+    for word in words:
+        worker_vocab.intern(word)
+
+def count_range(task):
+    path, start, end, respond, outpath = task
+    table = MarkovTable()
+    table.vocab = worker_vocab
+    for line in read_lines(path, start, end, respond):
+        for triplet in Markov.triples(line):
+            table.add_triple(*triplet)
+    sections = [array("q", [0, 0]), array("I"), bytearray()]
+    for pair in table.transitions:
+        for t in pair:
+            t.compact()
+            sections.extend((t.keys, t.offsets, t.ids, t.cums))
+    write_snapshot(outpath, sections)
+    return outpath
+
+def merge_range(task):
+    paths, block, lo, hi = task
+    sources = []
+    for path in paths:
+        _, _, sections = read_snapshot(path)
+        start = 3 + block * 4
+        sources.append(sections[start:start + 4])
+    return merge_rows(sources, lo, hi)
+
+def key_ranges(order, bounds):
+    """
+    Split the keys of an order into ranges along the given word id bounds
+    """
+    shift = 32 if order == 2 else 0
+    if order == 0:
+        return [(0, 1)]
+    return [(bounds[i] << shift, bounds[i+1] << shift)
+            for i in range(len(bounds) - 1)]
+
+def train(path, output, respond, workers):
+    ranges = split_ranges(path, workers * 4)
+    pool = multiprocessing.Pool(workers)
+    try:
+        tasks = [(path, start, end, respond) for start, end in ranges]
+        words = set()
+        for found in pool.imap_unordered(collect_words, tasks):
+            words.update(found)
+        words = sorted(words, key=lambda w: w.encode("utf-8"))
+    finally:
+        pool.close()
+        pool.join()
+
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output)))
+    try:
+        pool = multiprocessing.Pool(workers, init_worker, (words,))
+        try:
+            tasks = [(path, start, end, respond,
+                      os.path.join(tmpdir, "part{0}".format(i)))
+                     for i, (start, end) in enumerate(ranges)]
+            parts = pool.map(count_range, tasks)
+
+            # Merge every order and direction over slices of the word ids
+            bounds = [0] + [len(words) * i // workers + 1
+                            for i in range(1, workers)] + [len(words) + 1]
+            tasks = []
+            for block in range(2 * (MarkovTable.ORDER + 1)):
+                for lo, hi in key_ranges(block // 2, bounds):
+                    tasks.append((parts, block, lo, hi))
+            merged = pool.map(merge_range, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        vocab = Vocabulary()
+        for word in words:
+            vocab.intern(word)
+        sections = list(vocab.sections())
+        tasks = iter(zip(tasks, merged))
+        for block in range(2 * (MarkovTable.ORDER + 1)):
+            keys, offsets, ids, cums = (array("q"), array("q", [0]), array("I"),
+                                        array("Q"))
+            for _ in key_ranges(block // 2, bounds):
+                _, (pkeys, poffsets, pids, pcums) = next(tasks)
+                shift = len(ids)
+                keys.extend(pkeys)
+                offsets.extend(o + shift for o in poffsets[1:])
+                ids.extend(pids)
+                cums.extend(pcums)
+            sections.extend((keys, offsets, ids, cums))
+        write_snapshot(output, sections, end_position(path))
+    finally:
+        # The partial snapshots take up about as much as the corpus
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return len(words)
+
+def parse_args(args):
+    parser = ArgumentParser()
+    parser.add_argument(
+        "corpus",
+        help="Corpus file to train on, one line per message")
+    parser.add_argument(
+        "output",
+        help="Path to write the snapshot to")
+    parser.add_argument(
+        "--respond", default="fortunebot",
+        help="Skip lines containing this word, like the bot does with its "
+            "markov_respond word. Default fortunebot")
+    parser.add_argument(
+        "--workers", type=int, default=multiprocessing.cpu_count(),
+        help="Number of worker processes. Default number of CPUs")
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args(sys.argv[1:])
+    try:
+        count = train(args.corpus, args.output, args.respond,
+                      max(1, args.workers))
+    except (IOError, OSError) as e:
+        error_exit(e)
+    print("Wrote {0} words to {1}".format(count, args.output))
+
+def error_exit(e):
+    print(e, file=sys.stderr)
+    sys.exit(1)
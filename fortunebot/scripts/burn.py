@@ -4,6 +4,7 @@
 burn.py
 """
 
+import re
 import random
 
 class Burn(object):
@@ -14,6 +15,8 @@ class Burn(object):
 
     def __init__(self, words):
         self.words = words.split()
+        # Only messages with the words in order can be burned
+        self.PATTERNS = [".*".join(re.escape(w) for w in self.words)]
 
     def on_pubmsg(self, source, channel, text):
         text = text.lower()
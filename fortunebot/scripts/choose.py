@@ -9,6 +9,7 @@ import random
 class Choose(object):
 
     NAME = "choose"
+    COMMANDS = ["!choose"]
     HELP = "!choose [choices...] - Helps you make a decision (DISCLAIMER: Not "\
            "liable for any damage or consequence that result from said decision"
 
@@ -3,24 +3,35 @@
 """
 fortune.py
 
-A script that tells fortune messages, using the system's fortune command.
+A script that tells fortune messages from the system's fortune databases.
+The databases are read directly, falling back to running the system's fortune
+command when none can be found.
 """
 
 from threading import Timer
 from subprocess import Popen, PIPE
+from fortunebot.utils.fortunedb import FortuneDB, SEARCH_PATHS
+import os
 import re
 
 class Fortune(object):
 
     NAME = "fortune"
-    PARAMS = [('int', "length")]
+    PARAMS = [('int', "length"),
+              ('str', "path", "")]
+    COMMANDS = ["!fortune"]
+    CONCURRENCY = 4
     HELP = "!fortune [category] - Receive a fortune cookie from an optional "\
            "category"
 
-    def __init__(self, length):
+    def __init__(self, length, path=""):
         if length < 0:
             length = 0
         self.length = length
+        paths = [os.path.expanduser(path)] if path else SEARCH_PATHS
+        self.db = FortuneDB(paths, length)
+        if not len(self.db):
+            self.db = None
 
     def on_pubmsg(self, source, channel, text):
         args = text.split()
@@ -30,13 +41,29 @@ class Fortune(object):
         return self.get_fortune(category)
 
     def get_fortune(self, category):
-        cmd = ["fortune", "-sn", str(self.length)]
         if category:
             #Sanitize
             category = category.split()[0]
             category = "".join([c for c in category if c.isalnum()])
+        if self.db:
+            res = self.db.choice(category)
+        else:
+            res = self.run_fortune(category)
+        if not res:
+            res = "ERROR: Fortune not found"
+        else:
+            res = res.strip()
+            res = re.sub(r"[ \t\r\n]+", " ", res)
+        return res
+
+    def run_fortune(self, category):
+        cmd = ["fortune", "-sn", str(self.length)]
+        if category:
             cmd.append(category)
-        proc = Popen(cmd, stderr=PIPE, stdout=PIPE)
+        try:
+            proc = Popen(cmd, stderr=PIPE, stdout=PIPE)
+        except OSError:
+            return None
         def killproc():
             if proc.poll() == None:
                 try:
@@ -47,10 +74,4 @@ class Fortune(object):
         timeout.start()
         res, _ = proc.communicate()
         timeout.cancel()
-        if not res:
-            res = "ERROR: Fortune not found"
-        else:
-            res = res.decode("latin1")
-            res = res.strip()
-            res = re.sub(r"[ \t\r\n]+", " ", res)
-        return res
+        return res.decode("latin1")
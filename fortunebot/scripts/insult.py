@@ -5,15 +5,48 @@ insult.py
 
 A script that produces Shakespearean insults. It pulls insults via HTTP from
 Chris Seidel's Shakespearean Insulter website.
+
+Insults are fetched ahead of time into a pool, which is topped up in the
+background whenever it runs low, so replies don't wait on the website. Every
+insult fetched is also remembered, optionally on disk, to fall back on while
+the website is down.
 """
 
-import requests
+import os
 import re
+import random
+import threading
+from collections import deque
+from fortunebot.utils import get_client
+
+URL = "http://www.pangloss.com/seidel/Shaker/index.html"
 
 class Insult(object):
 
     NAME = "insult"
+    PARAMS = [("int", "pool", 20),
+              ("str", "cache", "")]
+    COMMANDS = ["!insult"]
+    CONCURRENCY = 4
     HELP = "!insult - Insults you elegantly"
+    # Most insults to remember
+    CACHE_LIMIT = 1000
+
+    def __init__(self, pool=20, cache=""):
+        self.pool = deque()
+        self.pool_size = max(1, pool)
+        self.low_water = max(1, self.pool_size // 4)
+        self.seen = []
+        self.seen_set = set()
+        self.cache_path = os.path.expanduser(cache) if cache else ""
+        self.filling = False
+        self.failed = False
+        self.lock = threading.Lock()
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                for line in f:
+                    self.remember(line.strip(), False)
+        self.fill_pool()
 
     def on_pubmsg(self, source, channel, text):
         args = text.split()
@@ -22,12 +55,71 @@ class Insult(object):
         return self.get_insult()
 
     def get_insult(self):
-        insult = ""
+        with self.lock:
+            insult = self.pool.popleft() if self.pool else None
+            failed = self.failed
+            low = len(self.pool) < self.low_water
+        if low:
+            self.fill_pool()
+        if not insult and not failed:
+            # Ran dry before the pool could be filled
+            insult = self.fetch_insult()
+        if not insult:
+            with self.lock:
+                if self.seen:
+                    insult = random.choice(self.seen)
+        return insult or "ERROR: Unable to retrieve insult"
+
+    def fill_pool(self):
+        """
+        Top up the pool in the background, unless that's already underway
+        """
+        with self.lock:
+            if self.filling:
+                return
+            self.filling = True
+        t = threading.Thread(target=self.refill)
+        t.daemon = True
+        t.start()
+
+    def refill(self):
+        try:
+            while True:
+                with self.lock:
+                    if len(self.pool) >= self.pool_size:
+                        break
+                insult = self.fetch_insult()
+                if not insult:
+                    break
+                with self.lock:
+                    self.pool.append(insult)
+        finally:
+            with self.lock:
+                self.filling = False
+
+    def fetch_insult(self):
         try:
-            r = requests.get("http://www.pangloss.com/seidel/Shaker/index.html")
+            r = get_client().get(URL)
             match = re.search("^.+?</font>$", r.text, re.M)
             insult = match.group(0).split('<')[0]
         except:
-            insult = "ERROR: Unable to retrieve insult"
+            with self.lock:
+                self.failed = True
+            return None
+        with self.lock:
+            self.failed = False
+            self.remember(insult, True)
         return insult
 
+    def remember(self, insult, save):
+        if (not insult or insult in self.seen_set or
+                len(self.seen) >= self.CACHE_LIMIT):
+            return
+        self.seen.append(insult)
+        self.seen_set.add(insult)
+        if save and self.cache_path:
+            try:
+                with open(self.cache_path, "a") as f:
+                    f.write("{0}\n".format(insult))
+            except IOError:
+                pass
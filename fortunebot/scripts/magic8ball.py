@@ -11,6 +11,7 @@ import random
 class Magic8Ball(object):
 
     NAME = "magic8ball"
+    COMMANDS = ["!8ball"]
     HELP = "!8ball [question] - Seek answer from the magic 8-ball"
 
     def on_pubmsg(self, source, channel, text):
@@ -6,10 +6,95 @@ markov.py
 A script that listens to and records conversations in irc channels. When
 somebody says a magic word, the script generates a markov chain response using
 the recorded conversations as base.
+
+Recorded lines are written out in batches in the background, and the corpus
+is rotated into compressed segments as it grows, keeping only the newest few.
+
+Separate models can also be kept for each channel or speaker, learned from
+what's heard while the bot runs. Replies are drawn from the most specific
+model that knows enough about each word, falling back to the model of
+everything.
+
+Contexts of up to order words are counted, and each word of a reply is picked
+after the longest context next to it that's been followed by enough words,
+backing off to shorter ones. Higher orders stick closer to what was said.
+
+So the models don't grow forever, their counts can be decayed periodically,
+dropping the ones that fall below a threshold along with words no longer
+used. The decay runs a slice at a time between messages.
 """
 
+import os
+import re
+import time
 import random
-from collections import Counter, deque
+import logging
+import threading
+from collections import deque
+from fortunebot.utils import MarkovTable, Recorder, PartitionCache
+from fortunebot.utils.markovtable import decay, snapshot_generation
+from fortunebot.utils.recorder import read_lines, end_position
+logger = logging.getLogger("fortunebot")
+
+class Keywords(object):
+    """
+    The words of a prompt still to be worked into a reply. They're kept by
+    id, with the positions of each, so that picking one at random, dropping
+    one or finding those counted in a row don't depend on the length of the
+    prompt or the size of the model.
+    """
+
+    def __init__(self, vocab, words):
+        self.vocab = vocab
+        self.ids = []
+        self.where = {}
+        for word in words:
+            wid = vocab.lookup(word)
+            if wid is not None:
+                self.where.setdefault(wid, set()).add(len(self.ids))
+                self.ids.append(wid)
+
+    def remove_id(self, wid):
+        positions = self.where.get(wid)
+        if not positions:
+            return False
+        i = positions.pop()
+        if not positions:
+            del self.where[wid]
+        last = self.ids.pop()
+        if i < len(self.ids):
+            # Fill the gap with the last one
+            self.ids[i] = last
+            self.where[last].remove(len(self.ids))
+            self.where[last].add(i)
+        return True
+
+    def discard(self, word):
+        wid = self.vocab.lookup(word)
+        if wid is not None:
+            self.remove_id(wid)
+
+    def pop(self):
+        """
+        Remove and return a random keyword
+        """
+        wid = random.choice(self.ids)
+        self.remove_id(wid)
+        return self.vocab.word(wid)
+
+    def pop_from(self, row):
+        """
+        Remove and return a random keyword counted in row, or None
+        """
+        found = row.common(self.where)
+        if not found:
+            return None
+        wid = random.choice([w for w in found for _ in self.where[w]])
+        self.remove_id(wid)
+        return self.vocab.word(wid)
+
+    def __len__(self):
+        return len(self.ids)
 
 class Markov(object):
 
@@ -17,82 +102,346 @@ class Markov(object):
     PARAMS = [("str", "path"),
               ("bool", "listen"),
               ("bool", "record"),
-              ("str", "respond")]
+              ("str", "respond"),
+              ("str", "snapshot", ""),
+              ("int", "snapshot_interval", 3600),
+              ("int", "flush_lines", 100),
+              ("float", "flush_interval", 5.0),
+              ("int", "segment_size", 16384),
+              ("int", "segments", 8),
+              ("str", "partitions", ""),
+              ("str", "partition_path", ""),
+              ("int", "partition_budget", 65536),
+              ("int", "decay_interval", 0),
+              ("float", "decay_factor", 0.5),
+              ("int", "decay_threshold", 1),
+              ("int", "order", 2),
+              ("bool", "snapshot_save", True)]
     HELP = "Call fortunebot's name, and it shall respond..."
+    LEVELS = ["nick", "channel"]
+    # Entries decayed per slice, and seconds between slices
+    DECAY_STEP = 4096
+    DECAY_DELAY = 0.1
+    SAVE_CHECK = 1
 
-    def __init__(self, path, listen, record, respond):
+    def __init__(self, path, listen, record, respond, snapshot="",
+                 snapshot_interval=3600, flush_lines=100, flush_interval=5.0,
+                 segment_size=16384, segments=8, partitions="",
+                 partition_path="", partition_budget=65536, decay_interval=0,
+                 decay_factor=0.5, decay_threshold=1, order=2,
+                 snapshot_save=True):
         self.listen = listen
         self.respond = respond
-        self.table = [{}, {}, {}]
-        self.sample_file = None
+        self.levels = [level for level in self.LEVELS
+                       if level in partitions.split()]
+        for level in partitions.split():
+            if level not in self.LEVELS:
+                raise ValueError("Unknown markov partition {0}".format(level))
+        if not listen:
+            # Only messages calling for a reply matter
+            self.PATTERNS = [re.escape(respond)]
+        self.order = max(MarkovTable.ORDER, order)
+        self.table = MarkovTable(order=self.order)
+        self.lock = threading.Lock()
+        self.recorder = None
+        self.path = path
+        self.sample_position = 0
+        self.snapshot = snapshot
+        # Off for every process sharing the snapshot but the one saving it,
+        # so the rest only map it, and switch over to each newer one
+        self.snapshot_save = bool(snapshot) and snapshot_save
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_due = time.time() + snapshot_interval
+        self.saving = False
+        self.decay_interval = decay_interval
+        self.decay_factor = decay_factor
+        self.decay_threshold = decay_threshold
+        self.decay_due = time.time() + decay_interval
+        self.decaying = None
+        if snapshot and os.path.exists(snapshot):
+            try:
+                table, position = MarkovTable.load(snapshot)
+                if table.order != self.order:
+                    raise ValueError("{0} was saved with order {1}".format(
+                        snapshot, table.order))
+                self.table, self.sample_position = table, position
+            except (ValueError, EnvironmentError) as e:
+                logger.warning("Ignoring markov snapshot: {0}".format(e))
+        if not self.snapshot_save:
+            # Nothing here writes a snapshot to merge the delta into
+            self.table.unpin()
+        loaded = self.sample_position
         if path:
-            self.init_sample_file(path, record)
+            if record:
+                self.recorder = Recorder(path, flush_lines, flush_interval,
+                                         segment_size * 1024, segments,
+                                         track=self.snapshot_save)
+            self.init_sample_file(path)
+        # Save whatever was read past the snapshot
+        if self.snapshot_save and self.sample_position != loaded:
+            self.save_snapshot()
+        self.partitions = None
+        if self.levels:
+            self.partitions = PartitionCache(self.table.vocab, partition_path,
+                                             partition_budget * 1024,
+                                             self.order)
         self.end_mult = 20
         self.expand_limit = 50
         self.sentence_chance = 0.7
         self.chain_keyword_chance = 0.4
+        # Rows of a partition with fewer counts fall back to the next model
+        self.min_row = 5
+        # Contexts past the 2nd order followed by fewer words back off
+        self.backoff = 2
 
-    def __del__(self):
-        if self.sample_file:
-            self.sample_file.close()
-            self.sample_file = None
+    def on_save(self):
+        """
+        Write out what's been heard so far without stopping, so a replacement
+        being built picks it up
+        """
+        if self.recorder:
+            with self.lock:
+                try:
+                    self.recorder.flush()
+                except EnvironmentError as e:
+                    logger.warning("Unable to record markov lines: {0}".format(e))
+        self.save_partitions()
+        # A save or decay already underway owns the table until it's done
+        if self.snapshot_save and not self.saving and not self.decaying:
+            self.save_snapshot()
 
-    def init_sample_file(self, path, record):
-        if not record:
-            self.sample_file = open(path)
-        else:
-            self.sample_file = open(path, "r+", 1) # r+w line buffered
-        for line in self.sample_file:
+    def on_unload(self):
+        if self.recorder:
+            self.recorder.close()
+            self.recorder = None
+        self.save_partitions()
+
+    def init_sample_file(self, path):
+        if not os.path.exists(path):
+            raise IOError("No such file: {0}".format(path))
+        if self.sample_position > end_position(path):
+            # The file was replaced since the snapshot was taken
+            self.table = MarkovTable(order=self.order)
+            self.sample_position = 0
+        # Lines before the position are already in the snapshot. Without
+        # one, the whole corpus is counted in bulk, while the few lines past
+        # a snapshot go through the delta, keeping its arrays shared.
+        bulk = self.table.mmap is None
+        if bulk:
+            self.table.start_bulk()
+        try:
+            self.sample_position = self.read_corpus(self.table,
+                                                    self.sample_position)
+        finally:
+            if bulk:
+                self.table.end_bulk()
+
+    def read_corpus(self, table, position):
+        """
+        Add the lines recorded from position on to table, returning the
+        position after them
+        """
+        for position, line in read_lines(self.path, position):
             if self.respond not in line:
-                self.add_line(line)
-        if not record:
-            self.sample_file.close()
-            self.sample_file = None
+                self.add_line(line, table)
+        return position
 
     def on_pubmsg(self, source, channel, text):
         if not text.split():
             return
-        if self.respond in text:
-            return self.generate(text)
-        elif self.listen:
-            self.add_line(text)
-            if self.sample_file:
-                self.sample_file.write("{0}\n".format(text))
-
-    def add_line(self, line):
-        for triplet in self.triples(line):
-            before = triplet[0]
-            after = triplet[2]
-            """
-            0th order Markov chain
-            Basically gives a random word
-            """
-            key0 = None
-            if key0 not in self.table[0]:
-                self.table[0][key0] = (Counter(), Counter())
-            self.table[0][key0][0][before] += 1
-            self.table[0][key0][1][after] += 1
-            """
-            1st order Markov chain
-            Gives a word known to precede/succeed a base word
-            """
-            key1 = triplet[1]
-            if key1 not in self.table[1]:
-                self.table[1][key1] = (Counter(), Counter())
-            self.table[1][key1][0][before] += 1
-            self.table[1][key1][1][after] += 1
-            """
-            2nd order Markov chain
-            Gives a word known to precede/succeed a word pair
-            """
-            key2a = (triplet[0], triplet[1])
-            key2b = (triplet[1], triplet[2])
-            if key2a not in self.table[2]:
-                self.table[2][key2a] = (Counter(), Counter())
-            if key2b not in self.table[2]:
-                self.table[2][key2b] = (Counter(), Counter())
-            self.table[2][key2b][0][before] += 1
-            self.table[2][key2a][1][after] += 1
+        keys = self.partition_keys(source, channel)
+        with self.lock:
+            if self.respond in text:
+                tables = [self.partitions.get(key) for key in keys]
+                tables = [t for t in tables if t] + [self.table]
+                return self.generate(text, tables)
+            elif self.listen:
+                self.add_line(text)
+                for key in keys:
+                    self.add_line(text, self.partitions.get(key, True))
+                    self.partitions.update(key)
+                if self.recorder:
+                    self.recorder.write(text)
+
+    def partition_keys(self, source, channel):
+        """
+        Get the keys of the partitions a message belongs in, the most specific
+        first
+        """
+        keys = []
+        for level in self.levels:
+            name = getattr(source, "nick", source) if level == "nick" else channel
+            if name:
+                keys.append((level, name.lower()))
+        return keys
+
+    def on_poll(self, channel):
+        # Snapshots and decay wait for each other, since neither expects the
+        # other to change the table under it
+        now = time.time()
+        if ((self.snapshot or self.partitions) and not self.saving and
+                not self.decaying and now >= self.snapshot_due):
+            self.saving = True
+            self.snapshot_due = now + self.snapshot_interval
+            threading.Thread(target=self.save).start()
+        elif (self.partitions and self.partitions.evicted and
+                not self.saving and not self.decaying):
+            # Evicted partitions are written out without waiting for the
+            # next save, so they're not held on to for long
+            self.saving = True
+            threading.Thread(target=self.save_evicted).start()
+        elif (self.decay_interval and not self.saving and
+                now >= self.decay_due):
+            self.decay_slice()
+
+    def next_poll(self, channel):
+        # A deadline blocked by the other action can't be acted on yet, so
+        # it's left out rather than polled for over and over
+        if self.saving:
+            # Check back for decay and the next save once this one is done
+            return time.time() + self.SAVE_CHECK
+        if self.decaying:
+            return self.decay_due
+        times = []
+        if self.snapshot or self.partitions:
+            times.append(self.snapshot_due)
+        if self.partitions and self.partitions.evicted:
+            times.append(time.time())
+        if self.decay_interval:
+            times.append(self.decay_due)
+        return min(times) if times else None
+
+    def decay_slice(self):
+        """
+        Do the next slice of decaying the models, starting a new pass if
+        none is running
+        """
+        with self.lock:
+            if not self.decaying:
+                tables = [self.table]
+                if self.partitions:
+                    tables.extend(self.partitions.tables.values())
+                self.decaying = decay(tables, self.decay_factor,
+                                      self.decay_threshold, self.DECAY_STEP)
+            if next(self.decaying, True):
+                self.decaying = None
+                self.decay_due = time.time() + self.decay_interval
+                if self.partitions:
+                    for key in list(self.partitions.tables):
+                        self.partitions.update(key)
+            else:
+                self.decay_due = time.time() + self.DECAY_DELAY
+
+    def save(self):
+        try:
+            self.save_partitions()
+            if self.snapshot_save:
+                self.save_snapshot()
+            elif self.snapshot:
+                self.refresh_snapshot()
+        finally:
+            self.snapshot_due = time.time() + self.snapshot_interval
+            self.saving = False
+
+    def save_partitions(self):
+        if self.partitions:
+            with self.lock:
+                saved = self.partitions.take_dirty()
+            for path, table in saved:
+                self.partitions.save(path, table)
+            with self.lock:
+                self.partitions.written()
+
+    def save_evicted(self):
+        try:
+            self.save_partitions()
+        finally:
+            self.saving = False
+
+    def save_snapshot(self):
+        """
+        Merge everything heard so far into a new snapshot and switch over to
+        it. The merge happens outside the lock, so messages keep being handled
+        in the meantime.
+        """
+        with self.lock:
+            if self.recorder:
+                try:
+                    self.catch_up(self.recorder.flush())
+                except EnvironmentError as e:
+                    logger.warning("Unable to record markov lines: {0}".format(e))
+            frozen = self.table.freeze()
+            position = self.sample_position
+        try:
+            generation = frozen.save(self.snapshot, position)
+            with self.lock:
+                self.table.attach(self.snapshot, generation)
+        except Exception as e:
+            logger.warning("Unable to save markov snapshot: {0}".format(e))
+            with self.lock:
+                self.table.thaw(frozen)
+
+    def refresh_snapshot(self):
+        """
+        Switch over to the snapshot the process saving it wrote since the one
+        in use, if any, dropping the counts it covers from memory. It's loaded
+        and the lines recorded past it are read outside the lock. Without a
+        recorder, lines heard would be lost, so the table is kept.
+        """
+        if self.listen and not self.recorder:
+            return
+        generation = snapshot_generation(self.snapshot)
+        if generation is None or generation == self.table.generation:
+            return
+        try:
+            table, position = MarkovTable.load(self.snapshot)
+            if table.order != self.order:
+                raise ValueError("{0} was saved with order {1}".format(
+                    self.snapshot, table.order))
+            if self.path:
+                if position > end_position(self.path):
+                    raise ValueError("{0} is past the end of {1}".format(
+                        self.snapshot, self.path))
+                position = self.read_corpus(table, position)
+        except (ValueError, EnvironmentError) as e:
+            logger.warning("Unable to refresh markov snapshot: {0}".format(e))
+            return
+        table.unpin()
+        with self.lock:
+            if self.recorder:
+                try:
+                    self.recorder.flush()
+                except EnvironmentError as e:
+                    logger.warning("Unable to record markov lines: {0}".format(e))
+            if self.path:
+                # What was recorded in the meantime
+                position = self.read_corpus(table, position)
+            if self.partitions:
+                self.partitions.rebase(table.vocab)
+            self.table = table
+            self.sample_position = position
+
+    def catch_up(self, end):
+        """
+        Add the lines other processes recorded to the corpus up to the
+        position end, so the snapshot's position doesn't skip past lines
+        this one never heard
+        """
+        own = deque(self.recorder.take_written())
+        start = self.sample_position
+        for position, line in read_lines(self.recorder.path, start):
+            if position > end:
+                break
+            while own and own[0][1] <= start:
+                own.popleft()
+            if not (own and own[0][0] <= start) and self.respond not in line:
+                self.add_line(line)
+            start = position
+        self.sample_position = end
+
+    def add_line(self, line, table=None):
+        table = table or self.table
+        table.add_words(line.split())
 
     @staticmethod
     def triples(line):
@@ -109,76 +458,114 @@ class Markov(object):
     def filter_keywords(self, text):
         keywords = []
         for word in text.split():
-            if word in self.table[1] and self.respond not in word:
+            if word in self.table and self.respond not in word:
                 keywords.append(word)
         return keywords
 
-    def get_word(self, base, keywords, prepend, order, end_mult):
-        if order > 2:
-            order = 2
-        elif order < 1:
-            order = 1
-        if base not in self.table[order]:
+    def row(self, tables, order, base, prepend):
+        """
+        Get the row of the first of tables with enough counts in it, or else
+        of the last one
+        """
+        for table in tables[:-1]:
+            c = table.row(order, base, prepend)
+            if c and c.total() >= self.min_row:
+                return c
+        return tables[-1].row(order, base, prepend)
+
+    def random_word(self, tables):
+        for table in tables[:-1]:
+            c = table.row(0, None, False)
+            if c and c.total() - c.count(None) >= self.min_row:
+                return c.sample()
+        return tables[-1].random_word()
+
+    def context_row(self, tables, context, prepend):
+        """
+        Get the row of the longest part of context next to the word to pick
+        that's been followed by enough words, backing off to shorter ones
+        """
+        for order in range(len(context), MarkovTable.ORDER, -1):
+            part = context[:order] if prepend else context[-order:]
+            c = self.row(tables, order, part, prepend)
+            if c and c.total() >= self.backoff:
+                return c
+        part = context[:2] if prepend else context[-2:]
+        return self.row(tables, 2, part, prepend)
+
+    def get_word(self, tables, base, keywords, prepend, order, end_mult):
+        """
+        Pick the word before (if prepend) or after base, which is a word for
+        the 1st order or else a tuple of two or more words
+        """
+        if order <= 1:
+            c = self.row(tables, 1, base, prepend)
+        else:
+            c = self.context_row(tables, base, prepend)
+        if not c:
             return None
-        idx = 0 if prepend else 1
-        c = self.table[order][base][idx]
-        if len(c) == 1:
-            return next(iter(c))
+        if c.single():
+            return c.first()
         if random.random() < self.chain_keyword_chance:
-            chainables = [k for k in keywords if k in c]
-            if chainables:
-                res = random.choice(chainables)
-                keywords.remove(res)
+            res = keywords.pop_from(c)
+            if res:
                 return res
-        end_chance = (c[None] * end_mult) / sum(c.values())
+        end_chance = (c.count(None) * end_mult) / c.total()
         if random.random() < end_chance:
             return None
-        res = random.choice([w for w in c.elements() if w is not None])
-        if res in keywords:
-            keywords.remove(res)
+        res = c.sample()
+        keywords.discard(res)
         return res
 
-    def generate_sentece(self, keywords):
+    def generate_sentece(self, tables, keywords):
         if not keywords:
-            if not self.table[1]:
+            if not self.table:
+                return ""
+            base = self.random_word(tables)
+            if not base:
                 return ""
-            base = random.choice(list(self.table[1].keys()))
         else:
-            base = random.choice(keywords)
-            keywords.remove(base)
+            base = keywords.pop()
         sentence = deque([base])
         """
         Expand left
         """
-        left = self.get_word(base, keywords, True, 1, 0)
+        left = self.get_word(tables, base, keywords, True, 1, 0)
         if left:
             sentence.appendleft(left)
             for mult in range(self.end_mult, 200, self.end_mult):
-                pair = (sentence[0], sentence[1])
-                left = self.get_word(pair, keywords, True, 2, mult/100.0)
+                context = tuple(sentence)[:self.order]
+                left = self.get_word(tables, context, keywords, True,
+                                     self.order, mult/100.0)
                 if not left:
                     break
                 sentence.appendleft(left)
         """
         Expand right
         """
-        right = self.get_word(base, keywords, False, 1, 0)
+        right = self.get_word(tables, base, keywords, False, 1, 0)
         if right:
             sentence.append(right)
             for mult in range(self.end_mult, 200, self.end_mult):
-                pair = (sentence[-2], sentence[-1])
-                right = self.get_word(pair, keywords, False, 2, mult/100.0)
+                context = tuple(sentence)[-self.order:]
+                right = self.get_word(tables, context, keywords, False,
+                                      self.order, mult/100.0)
                 if not right:
                     break
                 sentence.append(right)
         return ' '.join(sentence)
 
-    def generate(self, text):
-        keywords = self.filter_keywords(text)
+    def generate(self, text, tables=None):
+        """
+        Generate a reply from the first of tables that knows enough about
+        each word, or from the model of everything heard
+        """
+        tables = tables or [self.table]
+        keywords = Keywords(self.table.vocab, self.filter_keywords(text))
         msg = ""
-        msg += self.generate_sentece(keywords)
+        msg += self.generate_sentece(tables, keywords)
         while keywords and len(msg) < self.expand_limit and random.random() < self.sentence_chance:
             msg += '. '
-            msg += self.generate_sentece(keywords)
+            msg += self.generate_sentece(tables, keywords)
         return msg
 
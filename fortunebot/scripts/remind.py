@@ -5,33 +5,93 @@ remind.py
 
 A script that stores messages on behalf of users and plays them back after a
 specified duration.
+
+Given a path, tasks are also kept in a database so they survive restarts.
+Only the tasks due within the next WINDOW seconds are held in memory, and the
+next window is read in halfway through the current one. New tasks are written
+to the database in batches, at most FLUSH_DELAY seconds after being set.
 """
 
 from collections import defaultdict
-from fortunebot.utils import UndeadArgumentParser, CacheDict
+from fortunebot.utils import UndeadArgumentParser, CacheDict, ReminderStore
+import os
+import time
 import random
 import argparse
 import shlex
+import threading
 
 class Remind(object):
 
     NAME = "remind"
-    PARAMS = [("int", "tasklimit")]
+    PARAMS = [("int", "tasklimit"),
+              ("str", "path", "")]
+    COMMANDS = ["!remind"]
     HELP = "!remind [-s|-m|-h|-d] <time> <message> - Schedule a message to be "\
            "announced after a certain time. -s, -m, -h, or -d specifies the "  \
            "time to be in seconds, minutes, hours, or days (if no option, "    \
            "defaults to days)"
+    WINDOW = 60*60
+    FLUSH_DELAY = 1
+    FLUSH_BATCH = 256
 
-    def __init__(self, tasklimit):
+    def __init__(self, tasklimit, path=""):
         self.tasklimit = tasklimit
-        self.tasks = defaultdict(lambda: CacheDict(limit=tasklimit))
+        self.store = None
+        self.horizon = None
+        self.flush_due = None
+        # Polls and messages may be handled concurrently
+        self.lock = threading.Lock()
+        if path:
+            self.store = ReminderStore(os.path.expanduser(path))
+            self.tasks = defaultdict(CacheDict)
+            self.load_window(int(time.time()))
+        else:
+            self.tasks = defaultdict(lambda: CacheDict(limit=tasklimit))
+
+    def load_window(self, now):
+        """
+        Read in the stored tasks due before the end of the next window
+        """
+        start = self.horizon
+        self.horizon = now + self.WINDOW
+        for rkey, channel, due, message in self.store.due(start, self.horizon):
+            self.tasks[channel].insert(rkey, message, due - now)
 
     def on_poll(self, channel):
-        toggled = self.tasks[channel].prune()
+        with self.lock:
+            toggled = self.tasks[channel].prune()
+            if self.store:
+                if toggled:
+                    self.store.remove(channel, list(toggled))
+                now = int(time.time())
+                if now >= self.horizon - self.WINDOW // 2:
+                    self.load_window(now)
+                self.store.flush()
+                self.flush_due = None
         if not toggled:
             return
         return list(toggled.values())
 
+    def next_poll(self, channel):
+        with self.lock:
+            times = []
+            if channel in self.tasks:
+                times.append(self.tasks[channel].next_expiry())
+            if self.store:
+                times.append(self.horizon - self.WINDOW // 2)
+                times.append(self.flush_due)
+            times = [t for t in times if t is not None]
+            return min(times) if times else None
+
+    def on_save(self):
+        if self.store:
+            with self.lock:
+                self.store.flush()
+
+    def on_unload(self):
+        self.on_save()
+
     def on_pubmsg(self, source, channel, text):
         try:
             args = self.parse_args(text)
@@ -60,12 +120,29 @@ class Remind(object):
         return parser.parse_args(sargs)
 
     def set_reminder(self, channel, dur, message):
-        if len(self.tasks[channel]) == self.tasklimit:
-            return "NOPE. I have too many other things to remember."
-        # A bit of a hack to find unique keys used to insert messages into
-        # CacheDict
-        rkey = random.randint(0, 1<<30)
-        while rkey in self.tasks[channel]:
-            rkey = random.randint(0, 1<<30)
-        self.tasks[channel].insert(rkey, message, dur)
+        with self.lock:
+            if self.store:
+                count = self.store.count(channel)
+            else:
+                count = len(self.tasks[channel])
+            if count >= self.tasklimit:
+                return "NOPE. I have too many other things to remember."
+            if self.store:
+                now = int(time.time())
+                rkey = self.store.add(channel, now + dur, message)
+                if self.store.pending() >= self.FLUSH_BATCH:
+                    self.store.flush()
+                    self.flush_due = None
+                elif self.flush_due is None:
+                    self.flush_due = now + self.FLUSH_DELAY
+                if now + dur >= self.horizon:
+                    # Read in with its window
+                    return "Task registered"
+            else:
+                # A bit of a hack to find unique keys used to insert messages
+                # into CacheDict
+                rkey = random.randint(0, 1<<30)
+                while rkey in self.tasks[channel]:
+                    rkey = random.randint(0, 1<<30)
+            self.tasks[channel].insert(rkey, message, dur)
         return "Task registered"
@@ -7,31 +7,42 @@ A script that helps users amend their previous message using regular
 expression. If the shortcut configuration is set, the script will trigger on
 "s/<pattern>/<replacement>" messages, and produce a corrected version of the
 user's previous message.
+
+Patterns are run in a separate process with a deadline, so that one which
+backtracks forever can't hang the bot. Each nick's lines are remembered per
+channel, within a memory budget, forgetting the nicks idle the longest first.
 """
 
 import re
 import shlex
-from fortunebot.utils import UndeadArgumentParser
+from fortunebot.utils import (UndeadArgumentParser, SafeRegex, RegexTimeout,
+                              HistoryStore)
 from argparse import ArgumentError
-from collections import defaultdict, deque
 
 class Replace(object):
 
     NAME = "replace"
     PARAMS = [("bool", "shortcut"),
               ("int", "maxlength"),
-              ("int", "maxlines")]
+              ("int", "maxlines"),
+              ("float", "timeout", 0.5),
+              ("int", "budget", 4096)]
     HELP = "!replace [-l <line> | -s] <pattern> <replacement> - Replace "      \
            "pattern from your previous message with replacement. Use the -l "  \
            "flag to select a specific past line, or -s to find the most "      \
            "recent line to which pattern applies to. Also triggered by "       \
            "s/<pattern>/<replacement>/[line][s]"
 
-    def __init__(self, shortcut, maxlength, maxlines):
+    def __init__(self, shortcut, maxlength, maxlines, timeout=0.5,
+                 budget=4096):
         self.shortcut = shortcut
         self.maxlength = maxlength
         self.maxlines = maxlines
-        self.cache = defaultdict(lambda: deque(maxlen=maxlines))
+        self.history = HistoryStore(maxlines, budget * 1024)
+        self.regex = SafeRegex(timeout)
+
+    def on_unload(self):
+        self.regex.stop()
 
     def find_delimiter(self, text):
         l = 0
@@ -100,31 +111,31 @@ class Replace(object):
             return "Syntax: !replace [-l <line> | -s] <pattern> <repl>"
         nick = source.nick
         if not args:
-            self.cache[nick].appendleft(text)
+            self.history.add(channel, nick, text)
             return None
-        if nick not in self.cache:
+        history = self.history.get(channel, nick)
+        if not history:
             return None
         pattern, repl, line, search = args
-        if line == -1:
-            if search:
-                flag = True
-                for message in self.cache[nick]:
-                    if re.search(pattern, message):
-                        flag = False
-                        break
-                if flag:
-                    return "Unable to find anything that matches pattern!"
-            else:
-                message = self.cache[nick][0]
-        else:
-            try:
-                message = self.cache[nick][line-1]
-            except Exception:
-                return "Invalid line number"
         try:
-            res = re.sub(pattern, repl, message)
+            if line == -1:
+                if search:
+                    found = self.regex.search(pattern, history)
+                    if found < 0:
+                        return "Unable to find anything that matches pattern!"
+                    message = history[found]
+                else:
+                    message = history[0]
+            else:
+                try:
+                    message = history[line-1]
+                except Exception:
+                    return "Invalid line number"
+            res = self.regex.sub(pattern, repl, message)
         except re.error:
             return "But {0}, that's not valid regex!".format(nick)
+        except RegexTimeout:
+            return "Nice try, {0}. That regex takes way too long!".format(nick)
         # Limit length to prevent abuse
         if len(res) > self.maxlength:
             res = res[:self.maxlength] + "[...]"
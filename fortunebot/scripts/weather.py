@@ -4,13 +4,19 @@
 weather.py
 
 A script that tells the weather. Uses the World Weather Online API.
+
+Lookups for the same zip code or host that miss the cache at the same time
+share a single request. Cached answers about to expire are still used, but
+refreshed in the background, so that busy zip codes never miss.
 """
 
 import six
-import requests
+import time
+import threading
 import json
 import shlex
-from fortunebot.utils import UndeadArgumentParser, CacheDict
+from fortunebot.utils import (UndeadArgumentParser, CacheDict, SingleFlight,
+                              get_client)
 from argparse import ArgumentError
 
 class Weather(object):
@@ -19,6 +25,8 @@ class Weather(object):
     PARAMS = [("str", "key"),
               ("int", "cachedur"),
               ("str", "zippath")]
+    COMMANDS = ["!w", "!weather"]
+    CONCURRENCY = 4
     HELP = "!w [-s <save_zipcode>] [query_zipcode] - Provides weather " \
            "information about the location specified by query_zipcode. If " \
            "unspecified, will attempt to geolocate user. Can also save a " \
@@ -33,6 +41,11 @@ class Weather(object):
         self.zipcache = CacheDict(duration=cachedur)
         self.hostcache = CacheDict(duration=cachedur)
         self.savecache = {}
+        # Messages may be handled concurrently, so guard the caches
+        self.lock = threading.Lock()
+        self.flights = SingleFlight()
+        # Refresh cached answers in their last fifth
+        self.refresh = cachedur // 5
         self.zipfile = None
         if zippath:
             self.load_zips(zippath)
@@ -87,38 +100,71 @@ class Weather(object):
     def save_zip(self, nick, zipcode):
         if not self.valid_zip(zipcode):
             return "Zip code is not in 5-digit format!"
-        if nick in self.savecache and self.savecache[nick] == zipcode:
-            return
-        self.savecache[nick] = zipcode
-        if self.zipfile:
-            self.zipfile.write("{0} {1}\n".format(nick, zipcode))
+        with self.lock:
+            if nick in self.savecache and self.savecache[nick] == zipcode:
+                return
+            self.savecache[nick] = zipcode
+            if self.zipfile:
+                self.zipfile.write("{0} {1}\n".format(nick, zipcode))
 
     def valid_zip(self, zipcode):
         return len(zipcode) == 5 and zipcode.isdigit()
 
+    def lookup(self, name, cache, key, fetch):
+        """
+        Get key from cache, or else fetch it, sharing the fetch with any
+        other lookups of key that miss at the same time. fetch returns the
+        answer and whether to cache it.
+        """
+        with self.lock:
+            cache.prune()
+            hit = key in cache
+            if hit:
+                res = cache[key]
+                stale = time.time() >= cache.expires(key) - self.refresh
+        if hit:
+            if stale:
+                self.flights.start((name, key), self.fetch_into, cache, key,
+                                   fetch)
+            return res
+        return self.flights.do((name, key), self.fetch_into, cache, key,
+                               fetch)
+
+    def fetch_into(self, cache, key, fetch):
+        res, cacheable = fetch(key)
+        if cacheable:
+            with self.lock:
+                cache[key] = res
+        return res
+
     def get_zip(self, host):
-        if host in self.hostcache:
-            return self.hostcache[host]
+        return self.lookup("host", self.hostcache, host, self.fetch_zip)
+
+    def fetch_zip(self, host):
         url = "https://freegeoip.net/json/{0}".format(host)
+        try:
+            page = get_client().get(url).text
+        except:
+            # Don't cache connection failures
+            return "", False
         res = ""
         try:
-            page = requests.get(url).text
             data = json.loads(page)
             res = data["zip_code"]
         except:
             pass
-        self.hostcache[host] = res
-        return res
+        return res, True
 
     def get_weather(self, zipcode):
         if not self.valid_zip(zipcode):
             return "Zip code is not in 5-digit format!"
-        if zipcode in self.zipcache:
-            return self.zipcache[zipcode]
+        return self.lookup("zip", self.zipcache, zipcode, self.fetch_weather)
+
+    def fetch_weather(self, zipcode):
         url = "http://api.worldweatheronline.com/free/v1/weather.ashx?q={0}&format=json&fx=no&includelocation=yes&key={1}".format(zipcode, self.key)
         res = ""
         try:
-            page = requests.get(url).text
+            page = get_client().get(url).text
             wdata = json.loads(page)["data"]
             if "error" in wdata:
                 res = "No data found for {0}!".format(zipcode)
@@ -134,10 +180,5 @@ class Weather(object):
                 res = "{0}, {1}: {2}. {3}°F ({4}°C). Humidity: {5}%.".format(city, state, desc, tempF, tempC, humidity)
         except:
             # Don't cache connection failures
-            return "Unable to connect to weather API!"
-        self.zipcache[zipcode] = res
-        return res
-
-    def on_poll(self, channel):
-        self.zipcache.prune()
-        self.hostcache.prune()
+            return "Unable to connect to weather API!", False
+        return res, True
@@ -1,8 +1,27 @@
 __all__ = ["undeadargumentparser", "repeatingthread", "undeadargumentparser",
-           "cachedict", "misc"]
+           "cachedict", "markovtable", "dispatcher", "router",
+           "scheduler", "reminderstore", "outbox",
+           "fortunedb", "httpclient",
+           "singleflight", "stats", "saferegex",
+           "historystore", "recorder",
+           "partitioncache", "misc"]
 
 from .undeadargumentparser import UndeadArgumentParser
 from .easyconfigparser import EasyConfigParser
 from .repeatingthread import RepeatingThread
 from .cachedict import CacheDict
+from .markovtable import MarkovTable
+from .dispatcher import Dispatcher
+from .router import Router
+from .scheduler import Scheduler
+from .reminderstore import ReminderStore
+from .outbox import Outbox
+from .fortunedb import FortuneDB
+from .httpclient import HTTPClient, get_client
+from .singleflight import SingleFlight
+from .stats import Stats, StatsServer
+from .saferegex import SafeRegex, RegexTimeout
+from .historystore import HistoryStore
+from .recorder import Recorder
+from .partitioncache import PartitionCache
 from .misc import *
@@ -6,24 +6,36 @@ optionally limit the size of the dictionary, in which case the oldest item will
 be pushed out in a least-recently-set fashion. Finally, CacheDict can also
 prune items according to how long they've been in the dict.
 
-CacheDict uses a regular dict to store mappings, and additionally a deque to
-store the timestamps of insertions. This deque maintains a sorted order.
-Inserting a new item is O(1)
-Pruning/popping is O(1)
-Deleting a specific item is O(n)
-Inserting an item with a specified offset is O(n)
+With lru=True, reading an item also counts as setting it, so that the limit
+pushes out the least recently used item and pruning drops items that haven't
+been used for the duration instead.
+
+CacheDict uses a regular dict to store mappings, and additionally a heap of
+(timestamp, sequence, key) entries ordered by timestamp, with ties kept in
+insertion order. Deleting or replacing an item leaves its old entry in the
+heap, to be skipped when it comes up, and the heap is rebuilt whenever such
+stale entries outnumber the live ones.
+Inserting an item, with or without an offset, is O(log n)
+Pruning/popping is amortized O(log n)
+Deleting a specific item is O(1)
+Reading an item is O(1), or O(log n) with lru=True
 """
 
-import collections
 import time
+import heapq
+import itertools
+from six.moves import collections_abc
 
-class CacheDict(collections.MutableMapping):
+class CacheDict(collections_abc.MutableMapping):
 
     def __init__(self, *args, **kwargs):
         self.store = dict()
-        self.timestore = collections.deque()
+        self.timestore = []
+        self.entries = dict()
+        self.counter = itertools.count()
         self.limit = -1
         self.duration = 0
+        self.lru = bool(kwargs.pop("lru", False))
         if "limit" in kwargs:
             self.limit = int(kwargs["limit"])
             del kwargs["limit"]
@@ -33,7 +45,14 @@ class CacheDict(collections.MutableMapping):
         self.update(dict(*args, **kwargs))
 
     def __getitem__(self, key):
-        return self.store[key]
+        val = self.store[key]
+        if self.lru:
+            self.touch(key)
+        return val
+
+    def __contains__(self, key):
+        # Checking for a key isn't a use of it
+        return key in self.store
 
     def __setitem__(self, key, val):
         self.insert(key, val)
@@ -42,43 +61,72 @@ class CacheDict(collections.MutableMapping):
         now = int(time.time())
         if key in self.store:
             del self[key]
-        if offset == None:
-            self.timestore.append((key, now))
-        else:
-            found = False
-            for i, ele in enumerate(self.timestore):
-                if ele[1] > now + offset:
-                    found = True
-                    self.timestore.rotate(-i)
-                    self.timestore.appendleft((key, now + offset))
-                    self.timestore.rotate(i)
-                    break
-            if not found:
-                self.timestore.append((key, now + offset))
+        self.push(key, now if offset is None else now + offset)
         self.store[key] = val
         if self.limit >= 0 and len(self.store) > self.limit:
-            del self[self.timestore[0][0]]
+            del self[self.first()[0]]
+
+    def touch(self, key):
+        """
+        Reset the timestamp of an item to the current time
+        """
+        self.push(key, int(time.time()))
+
+    def push(self, key, when):
+        seq = next(self.counter)
+        self.entries[key] = (when, seq)
+        heapq.heappush(self.timestore, (when, seq, key))
+        if len(self.timestore) > 2 * len(self.entries) + 64:
+            self.timestore = [(t, s, k) for k, (t, s) in self.entries.items()]
+            heapq.heapify(self.timestore)
+
+    def first(self):
+        """
+        Get the (key, timestamp) of the oldest item, dropping stale entries
+        from the top of the heap on the way
+        """
+        while self.timestore:
+            when, seq, key = self.timestore[0]
+            if self.entries.get(key) == (when, seq):
+                return key, when
+            heapq.heappop(self.timestore)
+        return None
 
     def __delitem__(self, key):
         del self.store[key]
-        for i, v in enumerate(self.timestore):
-            if key == v[0]:
-                del self.timestore[i]
-                break
+        del self.entries[key]
 
     def prune(self, dur=None):
         if dur == None:
             dur = self.duration
         now = int(time.time())
         ret = {}
-        while self.timestore and self.timestore[0][1] + dur <= now:
-            k, _ = self.timestore.popleft()
-            ret[k] = self.store[k]
-            del self.store[k]
+        oldest = self.first()
+        while oldest and oldest[1] + dur <= now:
+            k = oldest[0]
+            heapq.heappop(self.timestore)
+            ret[k] = self.store.pop(k)
+            del self.entries[k]
+            oldest = self.first()
         return ret
 
+    def next_expiry(self):
+        """
+        Get the time at which the next item is due to be pruned, if any
+        """
+        oldest = self.first()
+        if not oldest:
+            return None
+        return oldest[1] + self.duration
+
+    def expires(self, key):
+        """
+        Get the time at which an item is due to be pruned
+        """
+        return self.entries[key][0] + self.duration
+
     def times(self):
-        return {k: t for k, t in self.timestore}
+        return {k: t for k, (t, _) in self.entries.items()}
 
     def __iter__(self):
         return iter(self.store)
@@ -0,0 +1,173 @@
+"""
+dispatcher.py
+
+Runs script handlers on a bounded pool of worker threads, so that a script
+waiting on the network or a subprocess doesn't hold up the IRC connection or
+the other scripts. Each script may only run a limited number of handlers at
+once, and the rest wait in line in the order they were submitted.
+
+Results are handed back in the order their handlers were submitted for each
+target (a channel or a nick). A handler that overruns its timeout is given up
+on, so it doesn't hold up the results queued behind it, and whatever it
+returns afterwards is dropped.
+"""
+
+import time
+import logging
+import threading
+from collections import defaultdict, deque
+from six.moves import queue
+
+logger = logging.getLogger("fortunebot")
+
+class Job(object):
+
+    __slots__ = ("name", "target", "func", "args", "deadline", "pooled",
+                 "done", "result")
+
+    def __init__(self, name, target, func, args, deadline):
+        self.name = name
+        self.target = target
+        self.func = func
+        self.args = args
+        self.deadline = deadline
+        self.pooled = False
+        self.done = False
+        self.result = None
+
+class Dispatcher(object):
+
+    def __init__(self, post, workers=4, timeout=10.0, concurrency=1,
+                 schedule=None):
+        """
+        post is called with a target and a result as results become ready.
+        schedule, if given, is called with a delay and a function to run
+        after it, and is used to give up on handlers that overrun their
+        timeout while results are queued behind them.
+        """
+        self.post = post
+        self.schedule = schedule
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.limits = {}
+        self.running = defaultdict(int)
+        self.waiting = defaultdict(deque)
+        self.pending = defaultdict(deque)
+        self.lock = threading.Condition()
+        self.queue = queue.Queue()
+        self.threads = []
+        self.resize(workers)
+
+    def configure(self, workers, timeout, concurrency):
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.limits = {}
+        self.resize(workers)
+
+    def set_limits(self, name, concurrency=None, timeout=None):
+        """
+        Override the default concurrency and timeout of a script
+        """
+        self.limits[name] = (concurrency or self.concurrency,
+                             timeout or self.timeout)
+
+    def get_limits(self, name):
+        return self.limits.get(name, (self.concurrency, self.timeout))
+
+    def resize(self, workers):
+        workers = max(0, workers)
+        while len(self.threads) < workers:
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        while len(self.threads) > workers:
+            self.threads.pop()
+            self.queue.put(None)
+
+    def submit(self, name, target, func, *args):
+        concurrency, timeout = self.get_limits(name)
+        job = Job(name, target, func, args, time.time() + timeout)
+        with self.lock:
+            self.pending[target].append(job)
+            job.pooled = bool(self.threads)
+            if job.pooled:
+                if self.running[name] < concurrency:
+                    self.running[name] += 1
+                    self.queue.put(job)
+                else:
+                    self.waiting[name].append(job)
+        if not job.pooled:
+            self.run(job)
+        elif self.schedule:
+            self.schedule(timeout, lambda: self.flush(target))
+
+    def depth(self):
+        """
+        Get the number of handlers submitted whose results are yet to be
+        handed back
+        """
+        with self.lock:
+            return sum(len(jobs) for jobs in self.pending.values())
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            self.run(job)
+
+    def run(self, job):
+        result = None
+        if job.deadline > time.time():
+            try:
+                result = job.func(*job.args)
+            except Exception as e:
+                logger.warning("{0} script error during {1}: {2}".format(
+                    job.name, job.func.__name__, e))
+        with self.lock:
+            job.result = result
+            job.done = True
+            if job.pooled:
+                if self.waiting[job.name]:
+                    self.queue.put(self.waiting[job.name].popleft())
+                else:
+                    self.running[job.name] -= 1
+            self._flush(job.target)
+
+    def flush(self, target):
+        with self.lock:
+            self._flush(target)
+
+    def _flush(self, target):
+        jobs = self.pending.get(target)
+        now = time.time()
+        while jobs and (jobs[0].done or jobs[0].deadline <= now):
+            job = jobs.popleft()
+            if not job.done:
+                logger.warning("{0} script timed out for {1}".format(
+                    job.name, target))
+            elif job.result:
+                self.post(target, job.result)
+        if jobs is not None and not jobs:
+            del self.pending[target]
+            if not self.pending:
+                self.lock.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until every submitted handler has finished or timed out
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.lock:
+            while self.pending:
+                if deadline is None:
+                    remaining = self.timeout
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.lock.wait(remaining)
+                for target in list(self.pending):
+                    self._flush(target)
+        return True
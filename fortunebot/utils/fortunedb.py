@@ -0,0 +1,137 @@
+"""
+fortunedb.py
+
+Reads fortune databases directly, instead of running the fortune command for
+every fortune. Each category is a text file of fortunes separated by lines
+holding a delimiter character (usually "%"), alongside the index strfile(1)
+builds for it, named the same with .dat appended, which holds the offset of
+every fortune. The text files are mmap'ed and only read as fortunes are
+picked.
+
+The fortunes short enough to tell are found once when a file is loaded, so
+picking one at random is O(1) within a category, and O(log n) in the number of
+categories across all of them.
+"""
+
+import os
+import mmap
+import codecs
+import random
+import struct
+import bisect
+from array import array
+
+# version, count, longest, shortest, flags, delimiter, padding
+STRFILE_HEADER = struct.Struct(">IIIIIc3x")
+STR_ROTATED = 0x4
+SEARCH_PATHS = [
+    "/usr/share/games/fortunes",
+    "/usr/share/games/fortune",
+    "/usr/share/fortunes",
+    "/usr/share/fortune",
+    "/usr/local/share/games/fortunes",
+    "/usr/local/share/games/fortune",
+]
+
+def write_strfile(path, fortunes, rotated=False):
+    """
+    Write fortunes to path and index them the way strfile(1) does
+    """
+    offsets = []
+    with open(path, "wb") as f:
+        for fortune in fortunes:
+            offsets.append(f.tell())
+            if rotated:
+                fortune = codecs.encode(fortune, "rot13")
+            f.write(fortune.encode("latin1") + b"\n%\n")
+        offsets.append(f.tell())
+    lengths = [len(s) + 1 for s in fortunes] or [0]
+    with open(path + ".dat", "wb") as f:
+        f.write(STRFILE_HEADER.pack(2, len(fortunes), max(lengths),
+                                    min(lengths), STR_ROTATED if rotated else 0,
+                                    b"%"))
+        f.write(struct.pack(">{0}I".format(len(offsets)), *offsets))
+
+class FortuneFile(object):
+
+    def __init__(self, path, length):
+        with open(path + ".dat", "rb") as f:
+            index = f.read()
+        _, count, _, _, flags, delim = STRFILE_HEADER.unpack_from(index)
+        self.offsets = array("I", struct.unpack_from(
+            ">{0}I".format(count + 1), index, STRFILE_HEADER.size))
+        self.rotated = bool(flags & STR_ROTATED)
+        self.delim = delim + b"\n"
+        with open(path, "rb") as f:
+            self.text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.short = array("I", [i for i in range(count)
+                                 if len(self.raw(i)) <= length])
+
+    def raw(self, i):
+        data = self.text[self.offsets[i]:self.offsets[i+1]]
+        if data.endswith(self.delim):
+            data = data[:-len(self.delim)]
+        return data
+
+    def get(self, i):
+        res = self.raw(i).decode("latin1")
+        if self.rotated:
+            res = codecs.decode(res, "rot13")
+        return res
+
+    def choice(self):
+        if not self.short:
+            return None
+        return self.get(random.choice(self.short))
+
+    def __len__(self):
+        return len(self.short)
+
+class FortuneDB(object):
+
+    def __init__(self, paths, length):
+        """
+        Load the categories found in the given directories, keeping the
+        fortunes no longer than length
+        """
+        self.files = {}
+        for d in paths:
+            if not os.path.isdir(d):
+                continue
+            for name in sorted(os.listdir(d)):
+                path = os.path.join(d, name)
+                if (name in self.files or name.endswith(".dat") or
+                        not os.path.isfile(path + ".dat")):
+                    continue
+                try:
+                    self.files[name] = FortuneFile(path, length)
+                except (EnvironmentError, ValueError, struct.error):
+                    continue
+        self.names = [n for n in sorted(self.files) if self.files[n]]
+        self.totals = []
+        total = 0
+        for name in self.names:
+            total += len(self.files[name])
+            self.totals.append(total)
+
+    def choice(self, category=None):
+        """
+        Pick a fortune from the category, or from all of them with every
+        fortune equally likely. Returns None if there are none.
+        """
+        if category:
+            f = self.files.get(category)
+            return f.choice() if f else None
+        if not self.totals:
+            return None
+        r = random.randrange(self.totals[-1])
+        pos = bisect.bisect_right(self.totals, r)
+        f = self.files[self.names[pos]]
+        start = self.totals[pos-1] if pos else 0
+        return f.get(f.short[r - start])
+
+    def __contains__(self, category):
+        return category in self.files
+
+    def __len__(self):
+        return self.totals[-1] if self.totals else 0
@@ -0,0 +1,67 @@
+"""
+historystore.py
+
+Remembers the last few lines each nick said in each channel, within a fixed
+memory budget. Lines are kept UTF-8 encoded, and when the lines stored would
+take up more than the budget, the histories of the nicks that have been idle
+the longest are dropped first. Memory is accounted for approximately, by the
+length of the lines plus a fixed overhead for each line and history.
+
+Adding a line or getting a history is O(1), and evicting one is amortized O(1)
+"""
+
+import six
+from collections import OrderedDict, deque
+
+# Approximate bytes taken up by each line and each history besides the text
+LINE_OVERHEAD = 64
+HISTORY_OVERHEAD = 256
+
+class HistoryStore(object):
+
+    def __init__(self, maxlines, budget):
+        self.maxlines = maxlines
+        self.budget = budget
+        self.size = 0
+        self.histories = OrderedDict()
+
+    def add(self, channel, nick, text):
+        key = (channel, nick)
+        lines = self.histories.pop(key, None)
+        if lines is None:
+            lines = deque()
+            self.size += HISTORY_OVERHEAD
+        self.histories[key] = lines
+        if isinstance(text, six.text_type):
+            text = text.encode("utf-8")
+        lines.appendleft(text)
+        self.size += len(text) + LINE_OVERHEAD
+        while len(lines) > self.maxlines:
+            self.size -= len(lines.pop()) + LINE_OVERHEAD
+        while self.size > self.budget and len(self.histories) > 1:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop the history of the nick that has been idle the longest
+        """
+        _, lines = self.histories.popitem(last=False)
+        self.size -= HISTORY_OVERHEAD
+        self.size -= sum(len(line) + LINE_OVERHEAD for line in lines)
+
+    def get(self, channel, nick):
+        """
+        Get the lines nick said in channel, most recent first
+        """
+        key = (channel, nick)
+        lines = self.histories.pop(key, None)
+        if lines is None:
+            return []
+        self.histories[key] = lines
+        return [line.decode("utf-8") for line in lines]
+
+    def __contains__(self, key):
+        return key in self.histories
+
+    def __len__(self):
+        return len(self.histories)
@@ -0,0 +1,77 @@
+"""
+httpclient.py
+
+An HTTP client for scripts that fetch pages, shared so that requests to the
+same host reuse kept-alive connections instead of setting up a new TCP (and
+TLS) connection every time. Connections are pooled per host, with at most
+max_per_host open to any one host at once. Every request times out, and
+connection failures and 5xx responses to idempotent requests are retried with
+exponential backoff.
+
+get_async runs a request on a small pool of threads, returning an AsyncResult
+whose get() waits for the response.
+"""
+
+import threading
+import requests
+from multiprocessing.pool import ThreadPool
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+RETRY_STATUSES = [500, 502, 503, 504]
+# Number of hosts to keep connection pools for
+POOL_HOSTS = 16
+
+shared_client = None
+shared_lock = threading.Lock()
+
+def get_client():
+    """
+    Get the client shared by every script
+    """
+    global shared_client
+    with shared_lock:
+        if shared_client is None:
+            shared_client = HTTPClient()
+        return shared_client
+
+class HTTPClient(object):
+
+    def __init__(self, timeout=5.0, retries=2, backoff=0.2, max_per_host=4,
+                 workers=4):
+        self.timeout = timeout
+        self.workers = workers
+        self.pool = None
+        self.lock = threading.Lock()
+        self.session = requests.Session()
+        retry = Retry(total=retries, backoff_factor=backoff,
+                      status_forcelist=RETRY_STATUSES, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_HOSTS,
+                              pool_maxsize=max_per_host, pool_block=True,
+                              max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def get_async(self, url, callback=None, **kwargs):
+        """
+        Start a GET in the background. callback, if given, is called with the
+        response once it arrives
+        """
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPool(self.workers)
+        return self.pool.apply_async(self.get, (url,), kwargs, callback)
+
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.terminate()
+                self.pool = None
+        self.session.close()
@@ -0,0 +1,1284 @@
+"""
+markovtable.py
+
+Compact storage for the transition counts of the markov script. Words are
+interned into integer ids, and for every order of the chain the predecessor and
+successor counts of each context are kept in CSR-style arrays: a sorted array of
+context keys, an array of row offsets into it, and parallel arrays holding the
+word ids and the running total of counts within each row. Keeping prefix sums
+instead of plain counts lets a weighted pick from a row be a binary search.
+Fresh counts are first collected in a small dict-based delta, which gets merged
+into the arrays once it grows past a fraction of their size.
+The running totals are 64-bit, since the 0th order rows count every word of
+the corpus, which runs past 2^32 for logs of a few GB.
+
+Context keys are 0 for the 0th order, the word id for the 1st order, and both
+word ids packed into a single integer for the 2nd order. The id 0 is reserved
+for None, which marks the start or the end of a line.
+
+Looking up a context is O(log n)
+Adding a count is amortized O(1)
+Sampling a word from a context is O(log n)
+
+A table may also keep contexts longer than two words, up to its order. Those
+are indexed by a prefix trie rather than by packing every word id into the
+key: each context of two or more words is a node, found by the key of its last
+edge, which packs the id of the node of the context without its last word (or
+that word itself, for pairs) with the id of the last word. A context of order k
+is then keyed by its last edge from a node of length k - 1, so contexts sharing
+a prefix share its nodes, and each one costs a single key whatever its length.
+Looking one up is O(k log n).
+
+A table can be saved to a binary snapshot holding the vocabulary and the merged
+arrays, and a snapshot can be mmap'ed and queried in place, so loading one is
+cheap and processes that load the same snapshot share its pages. While a table
+is backed by a snapshot, fresh counts stay in the delta until the next snapshot
+is written and attached. A table that never writes one can be unpinned, so its
+delta is merged into private arrays instead.
+
+A whole corpus can be counted in bulk instead, collecting the key and word id
+of each count packed into one int, and sorting them into arrays a chunk at a
+time, which are then merged together at the end. That takes a fraction of the
+memory of going through the delta, with no merges along the way.
+
+Tables may share one vocabulary, so that tables for parts of the same
+conversation only hold their own counts. The counts of a table can be added
+to one with a different vocabulary, mapping the words over, in O(n).
+
+To keep the model from growing forever, decay scales every count down and
+drops those that fall below a threshold, a slice at a time. Words no longer
+counted anywhere are released, and their ids reused for new words. Words in a
+snapshot can't be removed from it, so they're left out of the next snapshot
+instead.
+"""
+
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter
+import heapq
+import mmap
+import os
+import random
+import struct
+
+END = 0
+# Approximate bytes taken up by a count in a delta, with its dict entry
+DELTA_ENTRY_BYTES = 96
+# Counts collected at a time while loading in bulk
+BULK_CHUNK = 1 << 18
+SNAPSHOT_MAGIC = b"FBMARKOV"
+SNAPSHOT_VERSION = 3
+# Magic, version, section count, stored position and a random generation id,
+# telling apart the snapshots written to the same path
+SNAPSHOT_HEADER = struct.Struct("=8sIIQQ")
+SNAPSHOT_SECTION = struct.Struct("=QQ")
+# Sections each order past the 2nd adds to a snapshot: the nodes its contexts
+# are keyed from, then its transitions
+HIGHER_TYPECODES = ["q", "I", "q"] + ["q", "q", "I", "Q"] * 2
+
+class Vocabulary(object):
+    """
+    Maps words to ids and back. The first ids may come from a snapshot, in
+    which case they are found by binary search over its sorted word index
+    rather than kept in a dict. Released ids are reused for new words, those
+    of the snapshot included, so the ids stay about as many as the words.
+    """
+
+    def __init__(self):
+        self.base = 1
+        self.blob = None
+        self.offsets = None
+        self.order = None
+        self.words = []
+        self.ids = {}
+        # Released ids to reuse, released ids whose words are still in the
+        # snapshot's sorted index, and the words snapshot ids were reused for.
+        # Only ids the snapshot left empty are reused below the base, so the
+        # index never sees a reused id.
+        self.free = []
+        self.dead = set()
+        self.reused = {}
+        # The ids in use, packed together for picking one at random, and the
+        # index of each in it
+        self.used = array("I")
+        self.slots = array("I", [0])
+        # Set while a snapshot is being written, so ids aren't reused
+        self.hold = False
+        # Set to a set while decaying, to which every id interned is added
+        self.live = None
+
+    def attach(self, blob, offsets, order):
+        """
+        Take the first ids from a snapshot, which must have been written from
+        this vocabulary, and drop the words it covers from memory
+        """
+        size = len(offsets) - 1
+        self.words = self.words[size - self.base:]
+        self.ids = dict((w, size + i) for i, w in enumerate(self.words)
+                        if w is not None)
+        self.blob = blob
+        self.offsets = offsets
+        self.order = order
+        self.base = size
+        # The ids the snapshot left empty are free. Those released while it
+        # was being written are dead until the next one, which still has them.
+        released = self.free
+        self.dead = set(wid for wid in released + list(self.dead)
+                        if wid < size and offsets[wid] != offsets[wid + 1])
+        self.free = [wid for wid in range(1, size)
+                     if offsets[wid] == offsets[wid + 1]]
+        self.free.extend(wid for wid in released if wid >= size)
+        self.reused = {}
+        self.hold = False
+        # Rebuilt, since a freshly loaded vocabulary has none of them yet
+        self.used = array("I")
+        self.slots = array("I", [0]) * (len(self) + 1)
+        for wid in range(1, len(self) + 1):
+            if wid < size:
+                if offsets[wid] != offsets[wid + 1] and wid not in self.dead:
+                    self.use(wid)
+            elif self.words[wid - size] is not None:
+                self.use(wid)
+
+    def copy(self):
+        other = Vocabulary()
+        other.base = self.base
+        other.blob = self.blob
+        other.offsets = self.offsets
+        other.order = self.order
+        other.words = list(self.words)
+        other.ids = dict(self.ids)
+        other.free = list(self.free)
+        other.dead = set(self.dead)
+        other.reused = dict(self.reused)
+        other.used = array("I", self.used)
+        other.slots = array("I", self.slots)
+        return other
+
+    def encoded(self, wid):
+        if wid >= self.base:
+            word = self.words[wid - self.base]
+            return word.encode("utf-8") if word is not None else b""
+        if wid in self.reused:
+            return self.reused[wid].encode("utf-8")
+        return self.blob[self.offsets[wid]:self.offsets[wid + 1]].tobytes()
+
+    def find(self, word):
+        if self.order is None:
+            return None
+        key = word.encode("utf-8")
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.encoded(self.order[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if (lo < len(self.order) and self.encoded(self.order[lo]) == key and
+                self.order[lo] not in self.dead):
+            return self.order[lo]
+        return None
+
+    def lookup(self, word):
+        if word is None:
+            return END
+        wid = self.ids.get(word)
+        if wid is None:
+            wid = self.find(word)
+        return wid
+
+    def intern(self, word):
+        wid = self.lookup(word)
+        if wid is None:
+            if self.free and not self.hold:
+                wid = self.free.pop()
+                if wid < self.base:
+                    self.reused[wid] = word
+                else:
+                    self.words[wid - self.base] = word
+            else:
+                wid = self.base + len(self.words)
+                self.words.append(word)
+                self.slots.append(0)
+            self.ids[word] = wid
+            self.use(wid)
+        if self.live is not None:
+            self.live.add(wid)
+        return wid
+
+    def release(self, wid):
+        """
+        Forget the word of an id no longer counted anywhere
+        """
+        if wid < self.base:
+            if wid in self.reused:
+                del self.ids[self.reused.pop(wid)]
+                self.free.append(wid)
+            # Words already left out of the snapshot are empty. The rest stay
+            # in its sorted index, so their ids are only freed once the next
+            # snapshot leaves them out.
+            elif (self.offsets[wid] != self.offsets[wid + 1] and
+                    wid not in self.dead):
+                self.dead.add(wid)
+            else:
+                return
+        else:
+            word = self.words[wid - self.base]
+            if word is None:
+                return
+            self.words[wid - self.base] = None
+            del self.ids[word]
+            self.free.append(wid)
+        self.unuse(wid)
+
+    def use(self, wid):
+        self.slots[wid] = len(self.used)
+        self.used.append(wid)
+
+    def unuse(self, wid):
+        """
+        Take wid out of the ids in use, moving the last one into its place
+        """
+        last = self.used.pop()
+        if last != wid:
+            i = self.slots[wid]
+            self.used[i] = last
+            self.slots[last] = i
+
+    def random_word(self):
+        if not self.used:
+            return None
+        return self.word(self.used[random.randrange(len(self.used))])
+
+    def word(self, wid):
+        if wid >= self.base:
+            return self.words[wid - self.base]
+        if wid == END:
+            return None
+        if wid in self.reused:
+            return self.reused[wid]
+        return self.encoded(wid).decode("utf-8")
+
+    def sections(self):
+        """
+        The offsets, sorted index and blob of the snapshot form of this
+        vocabulary. Released words are left empty.
+        """
+        if self.offsets is None:
+            offsets = array("q", [0, 0])
+            blob = bytearray()
+            old = iter([])
+        elif not self.dead and not self.reused:
+            offsets = array("q", self.offsets.tobytes())
+            blob = bytearray(self.blob)
+            old = ((self.encoded(wid), wid) for wid in self.order)
+        else:
+            offsets = array("q", [0, 0])
+            blob = bytearray()
+            for wid in range(1, self.base):
+                if wid in self.reused or wid not in self.dead:
+                    blob.extend(self.encoded(wid))
+                offsets.append(len(blob))
+            old = ((self.encoded(wid), wid) for wid in self.order
+                   if wid not in self.dead)
+        new = [(word.encode("utf-8"), wid)
+               for wid, word in self.reused.items()]
+        for i, word in enumerate(self.words):
+            if word is None:
+                offsets.append(len(blob))
+                continue
+            encoded = word.encode("utf-8")
+            blob.extend(encoded)
+            offsets.append(len(blob))
+            new.append((encoded, self.base + i))
+        new.sort()
+        order = array("I", (wid for _, wid in heapq.merge(old, new)))
+        return offsets, order, blob
+
+    def __contains__(self, word):
+        return word is not None and self.lookup(word) is not None
+
+    def __len__(self):
+        return self.base - 1 + len(self.words)
+
+class DeltaRow(object):
+    """
+    Counts of one context that haven't been merged into the arrays yet. The
+    sorted ids and prefix sums are only rebuilt when sampled after an update.
+    """
+
+    __slots__ = ("counts", "total", "ids", "cums")
+
+    def __init__(self):
+        self.counts = {}
+        self.total = 0
+        self.ids = None
+        self.cums = None
+
+    def add(self, wid, n=1):
+        """
+        Increase the count of wid, returning whether it is a new entry
+        """
+        new = wid not in self.counts
+        self.counts[wid] = self.counts.get(wid, 0) + n
+        self.total += n
+        self.ids = None
+        return new
+
+    def index(self):
+        if self.ids is None:
+            self.ids = sorted(self.counts)
+            self.cums = []
+            total = 0
+            for wid in self.ids:
+                total += self.counts[wid]
+                self.cums.append(total)
+        return self.ids, self.cums
+
+class Row(object):
+    """
+    A read-only view of the counts of one context, keyed by word. Combines a
+    slice of the arrays with the context's delta, without copying either.
+    """
+
+    def __init__(self, vocab, ids, cums, lo, hi, extra):
+        self.vocab = vocab
+        self.ids = ids
+        self.cums = cums
+        self.lo = lo
+        self.hi = hi
+        self.extra = extra
+        self.base_total = cums[hi - 1] if hi > lo else 0
+
+    def base_count(self, wid):
+        i = bisect_left(self.ids, wid, self.lo, self.hi)
+        if i == self.hi or self.ids[i] != wid:
+            return 0
+        return self.cums[i] - (self.cums[i - 1] if i > self.lo else 0)
+
+    def count(self, word):
+        wid = self.vocab.lookup(word)
+        if wid is None:
+            return 0
+        n = self.base_count(wid)
+        if self.extra:
+            n += self.extra.counts.get(wid, 0)
+        return n
+
+    def total(self):
+        return self.base_total + (self.extra.total if self.extra else 0)
+
+    def items(self):
+        counts = {}
+        for i in range(self.lo, self.hi):
+            counts[self.ids[i]] = self.cums[i] - (self.cums[i - 1] if i > self.lo else 0)
+        if self.extra:
+            for wid, n in self.extra.counts.items():
+                counts[wid] = counts.get(wid, 0) + n
+        return [(self.vocab.word(wid), counts[wid]) for wid in sorted(counts)]
+
+    def single(self):
+        """
+        Whether only one word is counted, without going through the delta
+        """
+        n = self.hi - self.lo
+        extra = len(self.extra.counts) if self.extra else 0
+        if n + extra <= 1:
+            return True
+        if n > 1 or extra > 1:
+            return False
+        return self.base_count(next(iter(self.extra.counts))) > 0
+
+    def common(self, wids):
+        """
+        Get the ids of wids, a set or dict, that are counted in the row, by
+        looking each up or by going through the row, whichever is shorter
+        """
+        extra = self.extra.counts if self.extra else {}
+        if len(wids) <= self.hi - self.lo + len(extra):
+            return [wid for wid in wids if wid in extra or self.base_count(wid)]
+        res = [wid for wid in extra if wid in wids]
+        for i in range(self.lo, self.hi):
+            wid = self.ids[i]
+            if wid in wids and wid not in extra:
+                res.append(wid)
+        return res
+
+    def first(self):
+        if self.hi > self.lo:
+            return self.vocab.word(self.ids[self.lo])
+        return self.vocab.word(next(iter(self.extra.counts)))
+
+    def sample(self):
+        """
+        Pick a word other than None, weighted by its count
+        """
+        base_end = self.base_count(END)
+        base_rest = self.base_total - base_end
+        r = base_rest
+        if self.extra:
+            r += self.extra.total - self.extra.counts.get(END, 0)
+        r = random.randrange(r)
+        if r < base_rest:
+            i = bisect_right(self.cums, base_end + r, self.lo, self.hi)
+            return self.vocab.word(self.ids[i])
+        ids, cums = self.extra.index()
+        offset = self.extra.counts.get(END, 0)
+        i = bisect_right(cums, offset + r - base_rest)
+        return self.vocab.word(ids[i])
+
+    def __contains__(self, word):
+        return self.count(word) > 0
+
+    def __len__(self):
+        n = self.hi - self.lo
+        if self.extra:
+            for wid in self.extra.counts:
+                if not self.base_count(wid):
+                    n += 1
+        return n
+
+class Transitions(object):
+    """
+    The counts of one direction of one order, in CSR form plus a delta
+    """
+
+    def __init__(self, min_delta=4096):
+        self.keys = array("q")
+        self.offsets = array("q", [0])
+        self.ids = array("I")
+        self.cums = array("Q")
+        self.delta = {}
+        self.delta_size = 0
+        self.min_delta = min_delta
+        # Set while the arrays are shared with a snapshot, in which case the
+        # delta is only merged by writing out a new snapshot
+        self.pinned = False
+        # Set while decaying, which the delta waits on to be merged
+        self.decaying = False
+        # Set to a list while loading in bulk, collecting packed counts, along
+        # with the arrays of the chunks counted so far
+        self.bulk = None
+        self.chunks = None
+
+    def find(self, key):
+        i = bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            return i
+        return -1
+
+    def add(self, key, wid, n=1):
+        if self.bulk is not None and n == 1:
+            self.bulk.append((key << 32) | wid)
+            if len(self.bulk) >= BULK_CHUNK:
+                self.count_bulk()
+            return
+        row = self.delta.get(key)
+        if row is None:
+            row = self.delta[key] = DeltaRow()
+        if row.add(wid, n):
+            self.delta_size += 1
+            self.maybe_compact()
+
+    def maybe_compact(self):
+        if (not self.pinned and not self.decaying and
+                self.delta_size >= max(self.min_delta, len(self.ids) >> 2)):
+            self.compact()
+
+    def row(self, key, vocab):
+        i = self.find(key)
+        extra = self.delta.get(key)
+        if i < 0:
+            if not extra:
+                return None
+            return Row(vocab, self.ids, self.cums, 0, 0, extra)
+        lo, hi = self.offsets[i], self.offsets[i + 1]
+        return Row(vocab, self.ids, self.cums, lo, hi, extra)
+
+    def compact(self):
+        """
+        Merge the delta into the arrays
+        """
+        if not self.delta:
+            return
+        self.keys, self.offsets, self.ids, self.cums = self.merged()
+        self.delta = {}
+        self.delta_size = 0
+
+    def merged(self):
+        """
+        Build new arrays with the delta merged in. Rows untouched by the delta
+        are copied over in bulk.
+        """
+        out = (array("q"), array("q", [0]), array("I"), array("Q"))
+        keys, offsets, ids, cums = out
+        pos = 0
+        for key in sorted(self.delta):
+            i = bisect_left(self.keys, key, pos)
+            self._copy_rows(pos, i, out)
+            row = dict(self.delta[key].counts)
+            if i < len(self.keys) and self.keys[i] == key:
+                prev = 0
+                for j in range(self.offsets[i], self.offsets[i + 1]):
+                    wid = self.ids[j]
+                    row[wid] = row.get(wid, 0) + self.cums[j] - prev
+                    prev = self.cums[j]
+                i += 1
+            keys.append(key)
+            total = 0
+            for wid in sorted(row):
+                total += row[wid]
+                ids.append(wid)
+                cums.append(total)
+            offsets.append(len(ids))
+            pos = i
+        self._copy_rows(pos, len(self.keys), out)
+        return out
+
+    def start_bulk(self):
+        self.bulk = []
+        self.chunks = []
+
+    def count_bulk(self):
+        """
+        Sort the counts collected into the arrays of a chunk
+        """
+        counts = Counter(self.bulk)
+        self.bulk = []
+        out = (array("q"), array("q", [0]), array("I"), array("Q"))
+        keys, offsets, ids, cums = out
+        total = 0
+        for packed in sorted(counts):
+            key = packed >> 32
+            if not keys or keys[-1] != key:
+                if keys:
+                    offsets.append(len(ids))
+                keys.append(key)
+                total = 0
+            total += counts[packed]
+            ids.append(packed & 0xffffffff)
+            cums.append(total)
+        if keys:
+            offsets.append(len(ids))
+        self.chunks.append(out)
+
+    def end_bulk(self):
+        """
+        Merge the chunks counted in bulk into the arrays
+        """
+        self.count_bulk()
+        sources = self.chunks + [(self.keys, self.offsets, self.ids, self.cums)]
+        self.bulk = None
+        self.chunks = None
+        self.keys, self.offsets, self.ids, self.cums = merge_rows(
+            sources, 0, 1 << 63)
+        self.compact()
+
+    def freeze(self):
+        """
+        Hand the arrays and the current delta over to a new object, for writing
+        a snapshot, and start over with an empty delta
+        """
+        frozen = Transitions(self.min_delta)
+        frozen.keys, frozen.offsets = self.keys, self.offsets
+        frozen.ids, frozen.cums = self.ids, self.cums
+        frozen.delta, frozen.delta_size = self.delta, self.delta_size
+        self.delta = {}
+        self.delta_size = 0
+        self.pinned = True
+        return frozen
+
+    def thaw(self, frozen):
+        """
+        Take back the delta of a frozen object whose snapshot never made it
+        """
+        for key, row in frozen.delta.items():
+            for wid, n in row.counts.items():
+                self.add(key, wid, n)
+
+    def attach(self, keys, offsets, ids, cums):
+        self.keys, self.offsets, self.ids, self.cums = keys, offsets, ids, cums
+        self.pinned = True
+
+    def decay(self, factor, threshold, live, step, marks=None, shift=0):
+        """
+        Scale the counts in the arrays by factor, dropping those that fall
+        below threshold, and add the ids still counted to live, along with
+        the keys shifted right by shift to marks if given. A generator, which
+        yields after every step entries or so, and swaps in the new arrays at
+        the end. The delta holds fresh counts, so it's left alone, and isn't
+        merged until it's done.
+        """
+        keys, offsets, ids, cums = self.keys, self.offsets, self.ids, self.cums
+        out = (array("q"), array("q", [0]), array("I"), array("Q"))
+        new_keys, new_offsets, new_ids, new_cums = out
+        self.decaying = True
+        try:
+            done = 0
+            for i in range(len(keys)):
+                lo, hi = offsets[i], offsets[i + 1]
+                prev = 0
+                total = 0
+                for j in range(lo, hi):
+                    n = int((cums[j] - prev) * factor)
+                    prev = cums[j]
+                    if n >= threshold:
+                        total += n
+                        new_ids.append(ids[j])
+                        new_cums.append(total)
+                if total:
+                    live.update(new_ids[new_offsets[-1]:])
+                    if marks is not None:
+                        marks.add(keys[i] >> shift)
+                    new_keys.append(keys[i])
+                    new_offsets.append(len(new_ids))
+                done += hi - lo
+                if done >= step:
+                    done = 0
+                    yield
+                    if self.ids is not ids:
+                        # Replaced by a snapshot in the meantime
+                        return
+            self.keys, self.offsets, self.ids, self.cums = out
+        finally:
+            self.decaying = False
+        self.maybe_compact()
+
+    def counts(self):
+        """
+        Yield the key, word id and count of every entry, in the arrays and
+        then in the delta
+        """
+        for i, key in enumerate(self.keys):
+            prev = 0
+            for j in range(self.offsets[i], self.offsets[i + 1]):
+                yield key, self.ids[j], self.cums[j] - prev
+                prev = self.cums[j]
+        for key, row in self.delta.items():
+            for wid, n in row.counts.items():
+                yield key, wid, n
+
+    def nbytes(self):
+        arrays = (self.keys, self.offsets, self.ids, self.cums)
+        return (sum(len(a) * a.itemsize for a in arrays) +
+                self.delta_size * DELTA_ENTRY_BYTES)
+
+    def _copy_rows(self, lo, hi, out):
+        if lo >= hi:
+            return
+        keys, offsets, ids, cums = out
+        start, end = self.offsets[lo], self.offsets[hi]
+        shift = len(ids) - start
+        keys.frombytes(self.keys[lo:hi].tobytes())
+        ids.frombytes(self.ids[start:end].tobytes())
+        cums.frombytes(self.cums[start:end].tobytes())
+        offsets.extend(o + shift for o in self.offsets[lo + 1:hi + 1])
+
+class Nodes(object):
+    """
+    The trie nodes of the contexts of one length. Each is found by the key of
+    its last edge, kept in a sorted array alongside the node ids plus a delta
+    of fresh ones like Transitions, and by_id maps the ids back to their keys.
+    """
+
+    def __init__(self, min_delta=4096):
+        self.keys = array("q")
+        self.ids = array("I")
+        self.delta = {}
+        self.by_id = array("q")
+        # Released ids to reuse, whose keys are set to -1
+        self.free = []
+        self.min_delta = min_delta
+        self.pinned = False
+        self.decaying = False
+        # Set to a set while decaying, to which every id used is added
+        self.live = None
+
+    def find(self, key):
+        nid = self.delta.get(key)
+        if nid is None:
+            i = bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                nid = self.ids[i]
+        return nid
+
+    def node(self, key):
+        """
+        Get the id of the node at the end of the edge key, adding it if needed
+        """
+        nid = self.find(key)
+        if nid is None:
+            if self.free:
+                nid = self.free.pop()
+                self.by_id[nid] = key
+            else:
+                nid = len(self.by_id)
+                self.by_id.append(key)
+            self.delta[key] = nid
+            self.maybe_compact()
+        if self.live is not None:
+            self.live.add(nid)
+        return nid
+
+    def maybe_compact(self):
+        if (not self.pinned and not self.decaying and
+                len(self.delta) >= max(self.min_delta, len(self.keys) >> 2)):
+            self.compact()
+
+    def compact(self):
+        if not self.delta:
+            return
+        self.keys, self.ids = self.merged()
+        self.delta = {}
+
+    def merged(self):
+        keys, ids = array("q"), array("I")
+        pos = 0
+        for key in sorted(self.delta):
+            i = bisect_left(self.keys, key, pos)
+            keys.frombytes(self.keys[pos:i].tobytes())
+            ids.frombytes(self.ids[pos:i].tobytes())
+            keys.append(key)
+            ids.append(self.delta[key])
+            pos = i
+        keys.frombytes(self.keys[pos:].tobytes())
+        ids.frombytes(self.ids[pos:].tobytes())
+        return keys, ids
+
+    def sections(self):
+        keys, ids = self.merged() if self.delta else (self.keys, self.ids)
+        return keys, ids, self.by_id
+
+    def freeze(self):
+        """
+        Copy the nodes so far over to a new object, for writing a snapshot.
+        Unlike counts, the nodes stay here too, so their ids don't change.
+        """
+        frozen = Nodes(self.min_delta)
+        frozen.keys, frozen.ids = self.keys, self.ids
+        frozen.delta = dict(self.delta)
+        frozen.by_id = array("q", self.by_id.tobytes())
+        self.pinned = True
+        return frozen
+
+    def attach(self, keys, ids, by_id):
+        """
+        Use the arrays of a snapshot, dropping the fresh nodes it holds
+        """
+        self.keys, self.ids = keys, ids
+        for key in list(self.delta):
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                del self.delta[key]
+        if not len(self.by_id):
+            # Freshly loaded
+            self.by_id.frombytes(by_id.tobytes())
+            self.free = [nid for nid, key in enumerate(self.by_id) if key < 0]
+        self.pinned = True
+
+    def decay(self, live, parents, step):
+        """
+        Drop the nodes not in live, and add the parent nodes of the rest to
+        parents if given. A generator like Transitions.decay. The ids dropped
+        are only released at the end, and kept if used again by then.
+        """
+        keys, ids = self.keys, self.ids
+        new_keys, new_ids = array("q"), array("I")
+        dead = []
+        self.decaying = True
+        try:
+            for i in range(len(keys)):
+                if ids[i] in live:
+                    new_keys.append(keys[i])
+                    new_ids.append(ids[i])
+                    if parents is not None:
+                        parents.add(keys[i] >> 32)
+                else:
+                    dead.append(ids[i])
+                if (i + 1) % step == 0:
+                    yield
+                    if self.keys is not keys:
+                        return
+            self.keys, self.ids = new_keys, new_ids
+        finally:
+            self.decaying = False
+        for key, nid in list(self.delta.items()):
+            if nid not in live:
+                del self.delta[key]
+                dead.append(nid)
+        for nid in dead:
+            if nid in live:
+                self.delta[self.by_id[nid]] = nid
+            else:
+                self.by_id[nid] = -1
+                self.free.append(nid)
+        if parents is not None:
+            parents.update(key >> 32 for key in self.delta)
+        self.maybe_compact()
+
+    def nbytes(self):
+        arrays = (self.keys, self.ids, self.by_id)
+        return (sum(len(a) * a.itemsize for a in arrays) +
+                len(self.delta) * DELTA_ENTRY_BYTES)
+
+class MarkovTable(object):
+
+    # The highest order whose contexts are keyed by word ids alone
+    ORDER = 2
+
+    def __init__(self, min_delta=4096, order=ORDER):
+        self.min_delta = min_delta
+        self.order = max(self.ORDER, order)
+        self.vocab = Vocabulary()
+        self.mmap = None
+        # The generation id of the snapshot attached, if any
+        self.generation = None
+        # Indexed by order, then 0 for predecessors and 1 for successors
+        self.transitions = [(Transitions(min_delta), Transitions(min_delta))
+                            for _ in range(self.order + 1)]
+        # Indexed by context length from 2, for the orders past the 2nd
+        self.nodes = [Nodes(min_delta) for _ in range(self.order - self.ORDER)]
+
+    @staticmethod
+    def pack(first, second):
+        return (first << 32) | second
+
+    def add_triple(self, before, word, after):
+        self.add_ids(self.vocab.intern(before), self.vocab.intern(word),
+                     self.vocab.intern(after))
+
+    def add_ids(self, before, word, after):
+        """
+        0th order Markov chain
+        Basically gives a random word
+        """
+        self.transitions[0][0].add(0, before)
+        self.transitions[0][1].add(0, after)
+        """
+        1st order Markov chain
+        Gives a word known to precede/succeed a base word
+        """
+        self.transitions[1][0].add(word, before)
+        self.transitions[1][1].add(word, after)
+        """
+        2nd order Markov chain
+        Gives a word known to precede/succeed a word pair
+        """
+        self.transitions[2][0].add(self.pack(word, after), before)
+        self.transitions[2][1].add(self.pack(before, word), after)
+
+    def add_words(self, words):
+        """
+        Count every context of a line of words, up to the order of the table
+        """
+        ids = [END] + [self.vocab.intern(w) for w in words] + [END]
+        for i in range(1, len(ids) - 1):
+            self.add_ids(ids[i - 1], ids[i], ids[i + 1])
+        # Longer contexts are only counted within the line, since replies
+        # never look up ones running past its ends
+        for start in range(1, len(ids) - 3):
+            key = self.pack(ids[start], ids[start + 1])
+            for end in range(start + 2, min(start + self.order, len(ids) - 1)):
+                nid = self.nodes[end - start - 2].node(key)
+                key = self.pack(nid, ids[end])
+                pair = self.transitions[end - start + 1]
+                pair[0].add(key, ids[start - 1])
+                pair[1].add(key, ids[end + 1])
+
+    def context_key(self, ids, create=False):
+        """
+        Get the key of a context of two or more word ids, adding the nodes it
+        is keyed from if create is set, or None if one is missing
+        """
+        key = self.pack(ids[0], ids[1])
+        for length in range(2, len(ids)):
+            nodes = self.nodes[length - 2]
+            nid = nodes.node(key) if create else nodes.find(key)
+            if nid is None:
+                return None
+            key = self.pack(nid, ids[length])
+        return key
+
+    def context(self, order, key):
+        """
+        Get the word ids of the context of a key of order 2 or more
+        """
+        ids = [key & 0xffffffff]
+        for length in range(order - 1, 1, -1):
+            key = self.nodes[length - 2].by_id[key >> 32]
+            ids.append(key & 0xffffffff)
+        ids.append(key >> 32)
+        ids.reverse()
+        return ids
+
+    def key(self, order, base):
+        if order == 0:
+            return 0
+        if order == 1:
+            return self.vocab.lookup(base)
+        ids = [self.vocab.lookup(w) for w in base]
+        if None in ids:
+            return None
+        return self.context_key(ids)
+
+    def row(self, order, base, prepend):
+        """
+        Get the counts of words preceding (if prepend) or succeeding base,
+        which is None, a word or a tuple of order words depending on order
+        """
+        if order > self.order:
+            return None
+        key = self.key(order, base)
+        if key is None:
+            return None
+        return self.transitions[order][0 if prepend else 1].row(key, self.vocab)
+
+    def compact(self):
+        for pair in self.transitions:
+            for t in pair:
+                t.compact()
+        for nodes in self.nodes:
+            nodes.compact()
+
+    def start_bulk(self):
+        """
+        Count what's added from now on in bulk, rather than through the delta,
+        until end_bulk. Rows aren't up to date until then.
+        """
+        for pair in self.transitions:
+            for t in pair:
+                t.start_bulk()
+
+    def end_bulk(self):
+        for pair in self.transitions:
+            for t in pair:
+                t.end_bulk()
+
+    def delta_size(self):
+        return sum(t.delta_size for pair in self.transitions for t in pair)
+
+    def nbytes(self):
+        """
+        Approximate memory taken up by the counts, leaving out the vocabulary
+        """
+        return (sum(t.nbytes() for pair in self.transitions for t in pair) +
+                sum(nodes.nbytes() for nodes in self.nodes))
+
+    def add_table(self, other):
+        """
+        Add every count of other, which may have a different vocabulary, up
+        to the lower of both orders
+        """
+        mapping = {END: END}
+        def wid(w):
+            res = mapping.get(w)
+            if res is None:
+                res = mapping[w] = self.vocab.intern(other.vocab.word(w))
+            return res
+        for order, (pair, other_pair) in enumerate(zip(self.transitions,
+                                                       other.transitions)):
+            for t, other_t in zip(pair, other_pair):
+                for key, w, n in other_t.counts():
+                    if order == 1:
+                        key = wid(key)
+                    elif order >= 2:
+                        key = self.context_key(
+                            [wid(i) for i in other.context(order, key)], True)
+                    t.add(key, wid(w), n)
+
+    def freeze(self):
+        """
+        Split off a table holding everything added so far, which can then be
+        saved without holding up this one. Until the snapshot is attached,
+        this table only sees counts added after the split.
+        """
+        frozen = MarkovTable(self.min_delta, self.order)
+        frozen.vocab = self.vocab.copy()
+        self.vocab.hold = True
+        frozen.transitions = [(a.freeze(), b.freeze())
+                              for a, b in self.transitions]
+        frozen.nodes = [nodes.freeze() for nodes in self.nodes]
+        return frozen
+
+    def thaw(self, frozen):
+        self.vocab.hold = False
+        for pair, frozen_pair in zip(self.transitions, frozen.transitions):
+            for t, frozen_t in zip(pair, frozen_pair):
+                t.thaw(frozen_t)
+
+    def save(self, path, position=0):
+        """
+        Write a snapshot of the table to path, replacing it atomically.
+        position is stored alongside for the caller's bookkeeping. Returns
+        the generation id of the snapshot, to pass to attach.
+        """
+        sections = list(self.vocab.sections())
+        for order, pair in enumerate(self.transitions):
+            if order > self.ORDER:
+                sections.extend(self.nodes[order - self.ORDER - 1].sections())
+            for t in pair:
+                sections.extend(t.merged() if t.delta else
+                                (t.keys, t.offsets, t.ids, t.cums))
+        return write_snapshot(path, sections, position)
+
+    def attach(self, path, generation=None):
+        """
+        Use the snapshot at path as the base of the table, which must either
+        be empty or be the table the snapshot was saved from. Giving the
+        generation save returned makes sure it's still that snapshot, and
+        not one another process wrote to the same path since. Returns the
+        position stored in the snapshot.
+        """
+        mm, position, sections = read_snapshot(path, generation)
+        if snapshot_order(sections) != self.order:
+            raise ValueError("{0} has a different order".format(path))
+        self.attach_sections(mm, sections)
+        return position
+
+    def attach_sections(self, mm, sections):
+        self.vocab.attach(sections[2], sections[0], sections[1])
+        i = 3
+        for order, pair in enumerate(self.transitions):
+            if order > self.ORDER:
+                self.nodes[order - self.ORDER - 1].attach(*sections[i:i + 3])
+                i += 3
+            for t in pair:
+                t.attach(*sections[i:i + 4])
+                i += 4
+        self.mmap = mm
+        self.generation = SNAPSHOT_HEADER.unpack_from(mm)[4]
+
+    def unpin(self):
+        """
+        Let the delta be merged into private copies of the snapshot's arrays
+        once it's grown, for a table no snapshot will be written from
+        """
+        for pair in self.transitions:
+            for t in pair:
+                t.pinned = False
+                t.maybe_compact()
+        for nodes in self.nodes:
+            nodes.pinned = False
+            nodes.maybe_compact()
+
+    @classmethod
+    def load(cls, path, min_delta=4096):
+        """
+        Open the snapshot at path, returning the table, of whatever order it
+        was saved with, and its stored position
+        """
+        mm, position, sections = read_snapshot(path)
+        table = cls(min_delta, snapshot_order(sections))
+        table.attach_sections(mm, sections)
+        return table, position
+
+    def random_word(self):
+        return self.vocab.random_word()
+
+    def __contains__(self, word):
+        return word in self.vocab
+
+    def __len__(self):
+        return len(self.vocab)
+
+def decay(tables, factor, threshold=1, step=4096):
+    """
+    Scale the counts of tables sharing one vocabulary by factor, dropping
+    those that fall below threshold, then release the words no longer counted
+    in any of them. A generator, which does about step entries of work each
+    time it's advanced, so the work can be spread out.
+
+    Every word of a triple is counted as a predecessor or successor in the
+    0th order, or as a context in the 1st, and a count is never larger than
+    the ones it's a part of in lower orders, so only those need checking to
+    tell which words are still in use. Trie nodes are kept while a longer
+    context or node is still keyed from them, longest first.
+    """
+    vocab = tables[0].vocab
+    threshold = max(1, threshold)
+    # Nothing is merged until the whole pass is done, so fresh counts don't
+    # end up in arrays that are yet to be scaled
+    parts = [t for table in tables for pair in table.transitions for t in pair]
+    parts.extend(nodes for table in tables for nodes in table.nodes)
+    for part in parts:
+        part.decaying = True
+    live = vocab.live = set([END])
+    # The node ids still used in each table, by context length
+    live_nodes = []
+    for table in tables:
+        live_nodes.append([set() for _ in table.nodes])
+        for nodes, used in zip(table.nodes, live_nodes[-1]):
+            nodes.live = used
+    try:
+        for table, used in zip(tables, live_nodes):
+            for order, pair in enumerate(table.transitions):
+                if order == 1:
+                    marks, shift = live, 0
+                elif order > MarkovTable.ORDER:
+                    marks, shift = used[order - MarkovTable.ORDER - 1], 32
+                else:
+                    marks, shift = None, 0
+                for t in pair:
+                    for _ in t.decay(factor, threshold, live, step, marks, shift):
+                        yield
+        # Fresh counts keep their words and contexts
+        for table, used in zip(tables, live_nodes):
+            for t in table.transitions[0]:
+                for row in t.delta.values():
+                    live.update(row.counts)
+            for t in table.transitions[1]:
+                live.update(t.delta)
+            for order in range(MarkovTable.ORDER + 1, table.order + 1):
+                for t in table.transitions[order]:
+                    used[order - MarkovTable.ORDER - 1].update(
+                        key >> 32 for key in t.delta)
+        yield
+        for table, used in zip(tables, live_nodes):
+            for i in reversed(range(len(table.nodes))):
+                parents = used[i - 1] if i else None
+                for _ in table.nodes[i].decay(used[i], parents, step):
+                    yield
+        start = 1
+        while start <= len(vocab):
+            for wid in range(start, min(start + step, len(vocab) + 1)):
+                if wid not in live:
+                    vocab.release(wid)
+            start += step
+            yield
+    finally:
+        vocab.live = None
+        for table in tables:
+            for nodes in table.nodes:
+                nodes.live = None
+        for part in parts:
+            part.decaying = False
+    for part in parts:
+        part.maybe_compact()
+
+def write_snapshot(path, sections, position=0):
+    """
+    Write the vocabulary offsets, sorted index and blob, followed by the keys,
+    offsets, ids and prefix sums of every order and direction, to path. Each
+    order past the 2nd is preceded by the keys, ids and keys by id of the trie
+    nodes its contexts are keyed from. Returns the generation id written.
+    """
+    # Other processes may be saving to the same path
+    tmppath = "{0}.{1}.tmp".format(path, os.getpid())
+    generation = struct.unpack("=Q", os.urandom(8))[0]
+    try:
+        with open(tmppath, "wb") as f:
+            start = SNAPSHOT_HEADER.size + SNAPSHOT_SECTION.size * len(sections)
+            f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                                         len(sections), position, generation))
+            layout = []
+            for data in sections:
+                start += -start % 8
+                length = memoryview(data).nbytes
+                layout.append((start, length))
+                f.write(SNAPSHOT_SECTION.pack(start, length))
+                start += length
+            for (start, _), data in zip(layout, sections):
+                f.seek(start)
+                f.write(data)
+        os.rename(tmppath, path)
+    except Exception:
+        if os.path.exists(tmppath):
+            os.unlink(tmppath)
+        raise
+    return generation
+
+def read_snapshot(path, generation=None):
+    """
+    Map the snapshot at path, returning the mmap, the stored position and
+    views of the sections in the order they were written. If generation is
+    given, the snapshot must be the one written with it.
+    """
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, count, position, found = SNAPSHOT_HEADER.unpack_from(mm)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("{0} is not a markov snapshot".format(path))
+    if generation is not None and found != generation:
+        raise ValueError("{0} was replaced by another writer".format(path))
+    typecodes = ["q", "I", "B"] + ["q", "q", "I", "Q"] * 2 * (MarkovTable.ORDER + 1)
+    higher, rest = divmod(count - len(typecodes), len(HIGHER_TYPECODES))
+    if higher < 0 or rest:
+        raise ValueError("{0} has an unexpected layout".format(path))
+    typecodes += HIGHER_TYPECODES * higher
+    view = memoryview(mm)
+    sections = []
+    for i, typecode in enumerate(typecodes):
+        start, length = SNAPSHOT_SECTION.unpack_from(
+            mm, SNAPSHOT_HEADER.size + SNAPSHOT_SECTION.size * i)
+        sections.append(view[start:start + length].cast(typecode))
+    return mm, position, sections
+
+def snapshot_generation(path):
+    """
+    Get the generation id of the snapshot at path, reading only its header,
+    or None if there's no snapshot there
+    """
+    try:
+        with open(path, "rb") as f:
+            header = f.read(SNAPSHOT_HEADER.size)
+    except EnvironmentError:
+        return None
+    if len(header) < SNAPSHOT_HEADER.size:
+        return None
+    magic, version, _, _, generation = SNAPSHOT_HEADER.unpack(header)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        return None
+    return generation
+
+def snapshot_order(sections):
+    """
+    Get the order of the table the sections of a snapshot were saved from
+    """
+    base = 3 + 8 * (MarkovTable.ORDER + 1)
+    return MarkovTable.ORDER + (len(sections) - base) // len(HIGHER_TYPECODES)
+
+def merge_rows(sources, lo, hi):
+    """
+    Merge the rows with keys in [lo, hi) of several (keys, offsets, ids, cums)
+    arrays that share the same word ids, summing the counts of rows found in
+    more than one of them
+    """
+    keys, offsets, ids, cums = (array("q"), array("q", [0]), array("I"),
+                                array("Q"))
+    heads = []
+    for n, (skeys, _, _, _) in enumerate(sources):
+        i = bisect_left(skeys, lo)
+        end = bisect_left(skeys, hi)
+        if i < end:
+            heads.append((skeys[i], n, i, end))
+    heapq.heapify(heads)
+    while heads:
+        key = heads[0][0]
+        found = []
+        while heads and heads[0][0] == key:
+            _, n, i, end = heapq.heappop(heads)
+            found.append((n, i))
+            if i + 1 < end:
+                heapq.heappush(heads, (sources[n][0][i + 1], n, i + 1, end))
+        keys.append(key)
+        if len(found) == 1:
+            n, i = found[0]
+            _, soffsets, sids, scums = sources[n]
+            start, stop = soffsets[i], soffsets[i + 1]
+            ids.frombytes(sids[start:stop].tobytes())
+            cums.frombytes(scums[start:stop].tobytes())
+        else:
+            row = {}
+            for n, i in found:
+                _, soffsets, sids, scums = sources[n]
+                prev = 0
+                for j in range(soffsets[i], soffsets[i + 1]):
+                    row[sids[j]] = row.get(sids[j], 0) + scums[j] - prev
+                    prev = scums[j]
+            total = 0
+            for wid in sorted(row):
+                total += row[wid]
+                ids.append(wid)
+                cums.append(total)
+        offsets.append(len(ids))
+    return keys, offsets, ids, cums
@@ -0,0 +1,181 @@
+"""
+outbox.py
+
+A queue of outgoing messages drained by a single writer thread at a rate the
+server will put up with. Lines are sent as a token bucket allows: up to burst
+lines at once, then rate lines per second. Targets (channels and nicks) take
+turns, so one busy target doesn't hold up the rest.
+
+Lines too long to fit in an IRC message are split on character boundaries,
+preferably at a space. While throttled, lines queued for the same target are
+packed together into as few messages as fit, so a backlog drains in fewer
+messages.
+"""
+
+import six
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger("fortunebot")
+
+# Bytes allowed in an IRC message, including the trailing CRLF
+LINE_BYTES = 512
+# Bytes to set aside for the ":nick!user@host " prefix the server adds when
+# relaying a message
+PREFIX_BYTES = 96
+SEPARATOR = " | "
+
+def split_line(text, limit):
+    """
+    Split text into pieces of at most limit bytes when encoded as UTF-8
+    """
+    data = text.encode("utf-8")
+    pieces = []
+    while len(data) > limit:
+        cut = limit
+        # Don't cut a multi-byte character in half
+        while cut > 0 and six.indexbytes(data, cut) & 0xC0 == 0x80:
+            cut -= 1
+        space = data.rfind(b" ", 0, cut + 1)
+        if space > limit // 2:
+            pieces.append(data[:space])
+            data = data[space + 1:]
+        else:
+            pieces.append(data[:cut])
+            data = data[cut:]
+    pieces.append(data)
+    return [p.decode("utf-8") for p in pieces]
+
+class Outbox(object):
+
+    def __init__(self, send, rate=2.0, burst=5):
+        """
+        send is called with a target and a line from the writer thread
+        """
+        self.send = send
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.stamp = time.time()
+        self.queues = {}
+        self.targets = deque()
+        self.sending = 0
+        self.cond = threading.Condition()
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def configure(self, rate, burst):
+        with self.cond:
+            self.rate = max(0.01, rate)
+            self.burst = max(1, burst)
+            self.tokens = min(self.tokens, self.burst)
+            self.cond.notify_all()
+
+    def limit(self, target):
+        """
+        Get the number of bytes of text that fit in a message to target
+        """
+        command = "PRIVMSG {0} :\r\n".format(target)
+        return LINE_BYTES - PREFIX_BYTES - len(command.encode("utf-8"))
+
+    def put(self, target, lines):
+        limit = self.limit(target)
+        pieces = []
+        for line in lines:
+            pieces.extend(split_line(line, limit))
+        if not pieces:
+            return
+        with self.cond:
+            if target not in self.queues:
+                self.queues[target] = deque()
+                self.targets.append(target)
+            self.queues[target].extend(pieces)
+            self.cond.notify_all()
+
+    def depth(self):
+        """
+        Get the number of lines waiting to be sent
+        """
+        with self.cond:
+            return sum(len(lines) for lines in self.queues.values())
+
+    def clear(self):
+        """
+        Drop every queued line
+        """
+        with self.cond:
+            self.queues.clear()
+            self.targets.clear()
+            self.cond.notify_all()
+
+    def refill(self):
+        now = time.time()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self):
+        """
+        Wait for a line and a token to send it with, and return the target
+        and the line
+        """
+        with self.cond:
+            while True:
+                if not self.targets:
+                    self.cond.wait()
+                    continue
+                self.refill()
+                if self.tokens >= 1:
+                    break
+                self.cond.wait((1 - self.tokens) / self.rate)
+            self.tokens -= 1
+            target = self.targets.popleft()
+            lines = self.queues[target]
+            text = lines.popleft()
+            if self.tokens < 1:
+                # Throttled, so pack whatever else fits into this message
+                limit = self.limit(target)
+                size = len(text.encode("utf-8"))
+                while lines:
+                    more = len((SEPARATOR + lines[0]).encode("utf-8"))
+                    if size + more > limit:
+                        break
+                    text += SEPARATOR + lines.popleft()
+                    size += more
+            if lines:
+                self.targets.append(target)
+            else:
+                del self.queues[target]
+            self.sending += 1
+            return target, text
+
+    def run(self):
+        while True:
+            target, text = self.take()
+            try:
+                self.send(target, text)
+            except Exception as e:
+                logger.warning("Failed on send_msg: {0}".format(e))
+            finally:
+                with self.cond:
+                    self.sending -= 1
+                    self.cond.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Block until every queued line has been sent
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while self.queues or self.sending:
+                if deadline is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+        return True
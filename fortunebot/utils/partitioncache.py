@@ -0,0 +1,188 @@
+"""
+partitioncache.py
+
+Keeps markov tables for parts of the conversation, like single channels or
+speakers, within a memory budget. The tables all share one vocabulary, so
+each only holds its own counts. They're loaded from disk when first needed,
+and while the tables loaded take up more than the budget, the ones used least
+recently are dropped. Those with unsaved counts are kept aside until the
+owner writes them out, which it does outside its lock, and are taken back
+from there if needed again in the meantime.
+
+On disk, each partition is a snapshot with a vocabulary of only its own
+words, so it stays valid however the shared vocabulary is rebuilt. Loading or
+saving a partition is O(n) in its number of counts.
+"""
+
+import os
+import logging
+from collections import OrderedDict
+from six.moves.urllib.parse import quote
+from fortunebot.utils.markovtable import MarkovTable
+logger = logging.getLogger("fortunebot")
+
+# Partitions are small, so their counts are merged into arrays sooner, which
+# take up much less memory than the dicts holding fresh counts
+MIN_DELTA = 256
+
+class PartitionCache(object):
+
+    def __init__(self, vocab, path, budget, order=MarkovTable.ORDER):
+        """
+        Partitions are kept in the directory path, or forgotten when dropped
+        if it's empty. Their tables count contexts up to order.
+        """
+        self.vocab = vocab
+        self.order = order
+        self.path = path
+        self.budget = budget
+        self.tables = OrderedDict()
+        self.sizes = {}
+        self.size = 0
+        self.dirty = set()
+        # Tables dropped before their counts were saved, and those being
+        # written out, by key
+        self.evicted = {}
+        self.writing = {}
+        if path and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def filename(self, key):
+        name = quote("-".join(key).encode("utf-8"), safe="")
+        return os.path.join(self.path, name + ".snapshot")
+
+    def get(self, key, create=False):
+        """
+        Get the table of a partition, loading it if it's on disk. Returns None
+        for a partition never seen before, unless create is set.
+        """
+        table = self.tables.pop(key, None)
+        if table is None:
+            table = self.evicted.pop(key, None)
+            if table is None:
+                table = self.writing.pop(key, None)
+            if table is not None:
+                # Still not on disk as it is
+                self.dirty.add(key)
+            else:
+                table = self.load(key)
+            if table is None:
+                if not create:
+                    return None
+                table = MarkovTable(MIN_DELTA, self.order)
+                table.vocab = self.vocab
+            self.tables[key] = table
+            self.sizes[key] = table.nbytes()
+            self.size += self.sizes[key]
+            self.shrink()
+        else:
+            self.tables[key] = table
+        return table
+
+    def update(self, key):
+        """
+        Account for counts added to a loaded partition
+        """
+        size = self.tables[key].nbytes()
+        self.size += size - self.sizes[key]
+        self.sizes[key] = size
+        self.dirty.add(key)
+        self.shrink()
+
+    def shrink(self):
+        # The partition used last is kept, even if it's over budget alone
+        while self.size > self.budget and len(self.tables) > 1:
+            self.evict()
+
+    def evict(self):
+        """
+        Drop the partition used least recently, keeping it aside to be saved
+        if it has unsaved counts
+        """
+        key, table = self.tables.popitem(last=False)
+        self.size -= self.sizes.pop(key)
+        if key in self.dirty and self.path:
+            self.evicted[key] = table
+        self.dirty.discard(key)
+
+    def load(self, key):
+        if not self.path:
+            return None
+        path = self.filename(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            saved, _ = MarkovTable.load(path)
+        except (ValueError, EnvironmentError) as e:
+            logger.warning("Ignoring markov partition {0}: {1}".format(path, e))
+            return None
+        table = MarkovTable(MIN_DELTA, self.order)
+        table.vocab = self.vocab
+        table.add_table(saved)
+        table.compact()
+        return table
+
+    def detached(self, table):
+        """
+        Copy the table over to a vocabulary of its own words, to be saved
+        """
+        res = MarkovTable(order=table.order)
+        res.add_table(table)
+        return res
+
+    def save(self, path, table):
+        try:
+            table.save(path)
+        except EnvironmentError as e:
+            logger.warning("Unable to save markov partition {0}: {1}".format(path, e))
+
+    def rebase(self, vocab):
+        """
+        Move the partitions in memory over to another vocabulary
+        """
+        self.vocab = vocab
+        for key, table in list(self.tables.items()):
+            self.tables[key] = self.rebased(table)
+            size = self.tables[key].nbytes()
+            self.size += size - self.sizes[key]
+            self.sizes[key] = size
+        for tables in (self.evicted, self.writing):
+            for key, table in list(tables.items()):
+                tables[key] = self.rebased(table)
+
+    def rebased(self, table):
+        res = MarkovTable(MIN_DELTA, self.order)
+        res.vocab = self.vocab
+        res.add_table(table)
+        res.compact()
+        return res
+
+    def take_dirty(self):
+        """
+        Get copies of the partitions changed since they were last saved,
+        evicted ones included, as (path, table) pairs to pass to save. Call
+        written once they're saved.
+        """
+        if not self.path:
+            self.dirty = set()
+            return []
+        res = [(self.filename(key), self.detached(self.tables[key]))
+               for key in self.dirty]
+        res.extend((self.filename(key), self.detached(table))
+                   for key, table in self.evicted.items())
+        self.writing.update(self.evicted)
+        self.evicted = {}
+        self.dirty = set()
+        return res
+
+    def written(self):
+        """
+        Forget the evicted partitions taken by take_dirty, now on disk
+        """
+        self.writing = {}
+
+    def __contains__(self, key):
+        return key in self.tables
+
+    def __len__(self):
+        return len(self.tables)
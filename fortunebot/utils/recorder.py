@@ -0,0 +1,249 @@
+"""
+recorder.py
+
+Records lines to a corpus file without holding up whoever hears them. Lines
+are queued in memory and appended in batches by a background thread, once
+enough have built up or the oldest has waited long enough.
+
+Once the corpus grows past the segment size, it's moved aside, compressed
+with gzip, and a fresh one is started. Only the newest few segments are kept,
+so the disk used stays bounded. A segment is named after the range of offsets
+it covered in the stream of everything recorded, as corpus.START-END.gz, so a
+position in the stream still means the same lines after a rotation.
+
+Several processes may record to the same corpus. Their appends and rotations
+are serialized by an flock on a lock file next to it. A recorder can keep the
+ranges of the stream it wrote itself, so a reader can tell its own lines
+apart from the ones other processes appended in between.
+"""
+
+import os
+import re
+import six
+import gzip
+import time
+import fcntl
+import shutil
+import logging
+import threading
+from contextlib import contextmanager
+logger = logging.getLogger("fortunebot")
+
+def segment_name(path, start, end):
+    return "{0}.{1}-{2}".format(path, start, end)
+
+def segments(path):
+    """
+    Get the (start, end) offsets of each segment rotated out of the corpus at
+    path, oldest first
+    """
+    d, base = os.path.split(os.path.abspath(path))
+    pattern = re.compile(r"{0}\.(\d+)-(\d+)(\.gz)?$".format(re.escape(base)))
+    found = set()
+    for name in os.listdir(d):
+        m = pattern.match(name)
+        if m:
+            found.add((int(m.group(1)), int(m.group(2))))
+    return sorted(found)
+
+def start_position(path):
+    """
+    Get the offset in the stream the corpus at path starts at
+    """
+    found = segments(path)
+    return found[-1][1] if found else 0
+
+def end_position(path):
+    size = os.path.getsize(path) if os.path.exists(path) else 0
+    return start_position(path) + size
+
+def open_segment(path, start, end):
+    name = segment_name(path, start, end)
+    try:
+        return open(name, "rb")
+    except EnvironmentError:
+        # Already compressed
+        return gzip.open(name + ".gz", "rb")
+
+def read_lines(path, position=0):
+    """
+    Yield every line recorded from position in the stream onwards, from the
+    segments kept and then the corpus, along with the position after it
+    """
+    # Make sure the corpus wasn't rotated while the segments were listed
+    while True:
+        f = open(path, "rb")
+        found = segments(path)
+        if os.fstat(f.fileno()).st_ino == os.stat(path).st_ino:
+            break
+        f.close()
+    parts = []
+    for start, end in found:
+        if end > position:
+            parts.append((start, lambda s=start, e=end: open_segment(path, s, e)))
+    parts.append((found[-1][1] if found else 0, lambda: f))
+    try:
+        for start, opener in parts:
+            try:
+                part = opener()
+            except EnvironmentError:
+                # Dropped for retention in the meantime
+                continue
+            with part:
+                offset = max(0, position - start)
+                part.seek(offset)
+                for line in part:
+                    offset += len(line)
+                    yield start + offset, line.decode("utf-8", "replace")
+    finally:
+        f.close()
+
+class Recorder(object):
+
+    def __init__(self, path, flush_lines=100, flush_interval=5.0,
+                 segment_size=16 << 20, keep=8, track=False):
+        self.path = os.path.abspath(path)
+        self.flush_lines = flush_lines
+        self.flush_interval = flush_interval
+        self.segment_size = segment_size
+        self.keep = max(1, keep)
+        self.pending = []
+        # (start, end) positions of the batches written since last taken, if
+        # tracked
+        self.track = track
+        self.written = []
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.closed = False
+        self.rotated = False
+        self.lockfd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o644)
+        self.fd = None
+        self.reopen()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def reopen(self):
+        if self.fd is not None:
+            os.close(self.fd)
+        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0o644)
+
+    def write(self, line):
+        """
+        Queue a line to be recorded
+        """
+        with self.cond:
+            self.pending.append(line)
+            if len(self.pending) >= self.flush_lines:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                deadline = time.time() + self.flush_interval
+                while not self.closed and len(self.pending) < self.flush_lines:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                closed = self.closed
+            try:
+                self.flush()
+                if self.rotated:
+                    self.rotated = False
+                    self.compress()
+            except EnvironmentError as e:
+                logger.warning("Unable to record to {0}: {1}".format(self.path, e))
+            if closed:
+                break
+
+    @contextmanager
+    def locked(self):
+        fcntl.flock(self.lockfd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lockfd, fcntl.LOCK_UN)
+
+    def flush(self):
+        """
+        Append the lines queued so far, and move the corpus aside if it's
+        grown past the segment size. Returns the position in the stream after
+        them.
+        """
+        with self.io_lock:
+            with self.cond:
+                lines, self.pending = self.pending, []
+            data = b"".join(
+                (line.encode("utf-8") if isinstance(line, six.text_type)
+                 else line) + b"\n" for line in lines)
+            with self.locked():
+                # Another process may have rotated the corpus
+                try:
+                    if os.stat(self.path).st_ino != os.fstat(self.fd).st_ino:
+                        self.reopen()
+                except OSError:
+                    self.reopen()
+                length = len(data)
+                while data:
+                    data = data[os.write(self.fd, data):]
+                size = os.fstat(self.fd).st_size
+                start = start_position(self.path)
+                if length and self.track:
+                    self.written.append((start + size - length, start + size))
+                if size >= self.segment_size:
+                    os.rename(self.path, segment_name(self.path, start,
+                                                      start + size))
+                    self.reopen()
+                    self.rotated = True
+            return start + size
+
+    def take_written(self):
+        """
+        Get the (start, end) positions of the batches written since last
+        called, oldest first
+        """
+        with self.io_lock:
+            written, self.written = self.written, []
+        return written
+
+    def compress(self):
+        """
+        Compress the segments rotated out, and drop the oldest ones past the
+        number kept
+        """
+        found = segments(self.path)
+        for start, end in found:
+            name = segment_name(self.path, start, end)
+            if not os.path.exists(name):
+                continue
+            tmp = "{0}.gz.{1}.tmp".format(name, os.getpid())
+            try:
+                with open(name, "rb") as src:
+                    with gzip.open(tmp, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+                os.rename(tmp, name + ".gz")
+                os.unlink(name)
+            except EnvironmentError:
+                # Compressed by another process in the meantime
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+        for start, end in found[:-self.keep]:
+            name = segment_name(self.path, start, end)
+            for old in [name, name + ".gz"]:
+                try:
+                    os.unlink(old)
+                except OSError:
+                    pass
+
+    def close(self):
+        """
+        Record whatever is still queued and stop
+        """
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        os.close(self.fd)
+        os.close(self.lockfd)
@@ -0,0 +1,106 @@
+"""
+reminderstore.py
+
+A SQLite database of reminders, so that they survive restarts and reloads.
+Reminders are indexed by due time, so that only the ones coming up soon need
+to be read into memory, and by channel, so that a channel's reminders can be
+counted without reading them.
+
+Adds and removes are queued and written together in a single transaction by
+flush(), so a burst of reminders costs one fsync instead of one each. Reminder
+ids are handed out on add, before they are written.
+
+The store isn't thread-safe by itself, so callers must serialize access.
+
+Adding or removing a reminder is O(1), and flushing them O(log n) each
+Reading the reminders due in a window is O(log n + k)
+"""
+
+import sqlite3
+
+class ReminderStore(object):
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS reminders ("
+                "id INTEGER PRIMARY KEY, channel TEXT NOT NULL, "
+                "due INTEGER NOT NULL, message TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS reminders_due ON reminders (due)")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS reminders_channel "
+                "ON reminders (channel)")
+        last = self.conn.execute("SELECT MAX(id) FROM reminders").fetchone()[0]
+        self.next_id = (last or 0) + 1
+        self.added = []
+        self.removed = []
+        self.counts = {}
+
+    def add(self, channel, due, message):
+        """
+        Queue a reminder to be written, and return its id
+        """
+        rid = self.next_id
+        self.next_id += 1
+        self.added.append((rid, channel, int(due), message))
+        if channel in self.counts:
+            self.counts[channel] += 1
+        return rid
+
+    def remove(self, channel, ids):
+        """
+        Queue reminders of a channel to be deleted
+        """
+        self.removed.extend((rid,) for rid in ids)
+        if channel in self.counts:
+            self.counts[channel] -= len(ids)
+
+    def pending(self):
+        return len(self.added) + len(self.removed)
+
+    def flush(self):
+        if not self.pending():
+            return
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO reminders (id, channel, due, message) "
+                "VALUES (?, ?, ?, ?)", self.added)
+            self.conn.executemany(
+                "DELETE FROM reminders WHERE id = ?", self.removed)
+        self.added = []
+        self.removed = []
+
+    def count(self, channel):
+        """
+        Get the number of reminders set for a channel
+        """
+        if channel not in self.counts:
+            self.flush()
+            self.counts[channel] = self.conn.execute(
+                "SELECT COUNT(*) FROM reminders WHERE channel = ?",
+                (channel,)).fetchone()[0]
+        return self.counts[channel]
+
+    def due(self, start, end):
+        """
+        Get the (id, channel, due, message) of the reminders due from start
+        (or any time, if None) until end, in order of due time
+        """
+        self.flush()
+        if start is None:
+            cursor = self.conn.execute(
+                "SELECT id, channel, due, message FROM reminders "
+                "WHERE due < ? ORDER BY due, id", (end,))
+        else:
+            cursor = self.conn.execute(
+                "SELECT id, channel, due, message FROM reminders "
+                "WHERE due >= ? AND due < ? ORDER BY due, id", (start, end))
+        return cursor.fetchall()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
@@ -0,0 +1,63 @@
+"""
+router.py
+
+An index of which scripts are interested in which public messages, so that a
+message is only handed to the scripts that may respond to it. Scripts declare
+their triggers with any of these attributes, on the class or the instance:
+
+COMMANDS: words that trigger the script when a message starts with them
+PREFIXES: strings that trigger the script when a message starts with them
+PATTERNS: regular expressions that trigger the script when found in a message
+
+A script that declares none of them gets every message. Commands and patterns
+are matched case-insensitively, commands with a single dict lookup. Triggers
+only narrow down which scripts are called, so scripts still check messages
+themselves.
+"""
+
+import re
+from collections import defaultdict
+
+class Router(object):
+
+    def __init__(self, scripts=None, hook="on_pubmsg"):
+        self.commands = defaultdict(list)
+        self.prefixes = []
+        self.patterns = []
+        self.everything = []
+        if scripts:
+            for position, (name, s) in enumerate(scripts.items()):
+                if hook in dir(s):
+                    self.add(position, name, s)
+
+    def add(self, position, name, script):
+        route = (position, name, script)
+        commands = getattr(script, "COMMANDS", None)
+        prefixes = getattr(script, "PREFIXES", None)
+        patterns = getattr(script, "PATTERNS", None)
+        if not (commands or prefixes or patterns):
+            self.everything.append(route)
+            return
+        for command in commands or []:
+            self.commands[command.lower()].append(route)
+        for prefix in prefixes or []:
+            self.prefixes.append((prefix, route))
+        for pattern in patterns or []:
+            self.patterns.append((re.compile(pattern, re.I), route))
+
+    def route(self, text):
+        """
+        Get the (name, script) pairs interested in text, in script order
+        """
+        routes = list(self.everything)
+        words = text.split(None, 1)
+        if words:
+            routes.extend(self.commands.get(words[0].lower(), []))
+        for prefix, route in self.prefixes:
+            if text.startswith(prefix):
+                routes.append(route)
+        for pattern, route in self.patterns:
+            if pattern.search(text):
+                routes.append(route)
+        routes = sorted(set(routes), key=lambda r: r[0])
+        return [(name, script) for _, name, script in routes]
@@ -0,0 +1,102 @@
+"""
+saferegex.py
+
+Runs regular expressions given by users without letting a pathological one
+hang the bot. A pattern like (a+)+$ takes exponential time to fail on a long
+enough line of a's, and Python's re module can't be interrupted (or even
+release the GIL) while matching. So patterns run in a worker process instead,
+which is killed and replaced whenever it overruns its deadline.
+
+The worker keeps the patterns it compiles in an LRU cache, so patterns used
+again aren't recompiled.
+"""
+
+import re
+import threading
+import multiprocessing
+from collections import OrderedDict
+
+class RegexTimeout(Exception):
+    pass
+
+def serve(conn, cache_size):
+    cache = OrderedDict()
+    while True:
+        try:
+            op, pattern, args = conn.recv()
+        except (EOFError, IOError):
+            break
+        try:
+            regex = cache.pop(pattern, None)
+            if regex is None:
+                regex = re.compile(pattern)
+            cache[pattern] = regex
+            if len(cache) > cache_size:
+                cache.popitem(last=False)
+            if op == "search":
+                res = -1
+                for i, text in enumerate(args[0]):
+                    if regex.search(text):
+                        res = i
+                        break
+            else:
+                res = regex.sub(args[0], args[1])
+            conn.send((True, res))
+        except Exception as e:
+            conn.send((False, re.error(str(e))))
+
+class SafeRegex(object):
+
+    def __init__(self, timeout=0.5, cache_size=128):
+        self.timeout = timeout
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+        self.proc = None
+        self.conn = None
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=serve,
+                                            args=(child, self.cache_size))
+        self.proc.daemon = True
+        self.proc.start()
+        child.close()
+
+    def stop(self):
+        with self.lock:
+            self.kill()
+
+    def kill(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.join()
+            self.conn.close()
+        self.proc = None
+        self.conn = None
+
+    def call(self, op, pattern, *args):
+        """
+        Run op in the worker, raising RegexTimeout if it takes too long, or
+        re.error if the pattern is invalid
+        """
+        with self.lock:
+            if self.proc is None or not self.proc.is_alive():
+                self.kill()
+                self.start()
+            self.conn.send((op, pattern, args))
+            if not self.conn.poll(self.timeout):
+                self.kill()
+                raise RegexTimeout("Pattern took too long")
+            ok, res = self.conn.recv()
+        if not ok:
+            raise res
+        return res
+
+    def search(self, pattern, texts):
+        """
+        Get the index of the first of texts pattern is found in, or -1
+        """
+        return self.call("search", pattern, list(texts))
+
+    def sub(self, pattern, repl, text):
+        return self.call("sub", pattern, repl, text)
@@ -0,0 +1,107 @@
+"""
+scheduler.py
+
+Runs functions at given times from a single thread, which sleeps until the
+earliest deadline instead of waking up at a fixed interval. Deadlines are kept
+in a heap. A deadline can be given a key, in which case scheduling another one
+under the same key replaces it, and replaced or removed deadlines are simply
+skipped when they come up.
+
+Scheduling a function is amortized O(log n)
+Removing a deadline is O(1)
+"""
+
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+logger = logging.getLogger("fortunebot")
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.heap = []
+        self.keys = {}
+        self.stale = 0
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.finished = threading.Event()
+        self.finished.set()
+
+    def start(self):
+        if not self.finished.is_set():
+            raise RuntimeError("Scheduler is still running!")
+        self.finished.clear()
+        t = threading.Thread(target=self.run)
+        t.daemon = True
+        t.start()
+
+    def cancel(self):
+        with self.cond:
+            self.finished.set()
+            self.cond.notify()
+
+    def call_at(self, when, function, key=None):
+        """
+        Run function at the given epoch time. If a key is given, replace the
+        deadline previously scheduled under it.
+        """
+        with self.cond:
+            seq = next(self.counter)
+            if key is not None:
+                if key in self.keys:
+                    self.stale += 1
+                self.keys[key] = seq
+            heapq.heappush(self.heap, (when, seq, key, function))
+            if self.stale > len(self.heap) // 2 + 64:
+                # Too many replaced deadlines waiting to come up
+                self.heap = [e for e in self.heap if self.live(e)]
+                heapq.heapify(self.heap)
+                self.stale = 0
+            if self.heap[0][1] == seq:
+                self.cond.notify()
+
+    def call_later(self, delay, function, key=None):
+        self.call_at(time.time() + delay, function, key)
+
+    def remove(self, key):
+        with self.cond:
+            if self.keys.pop(key, None) is not None:
+                self.stale += 1
+
+    def scheduled(self):
+        """
+        Get the keys that have a deadline scheduled
+        """
+        with self.cond:
+            return list(self.keys)
+
+    def live(self, entry):
+        _, seq, key, _ = entry
+        return key is None or self.keys.get(key) == seq
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.finished.is_set():
+                    while self.heap and not self.live(self.heap[0]):
+                        heapq.heappop(self.heap)
+                        self.stale = max(0, self.stale - 1)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if self.finished.is_set():
+                    return
+                _, _, key, function = heapq.heappop(self.heap)
+                if key is not None:
+                    del self.keys[key]
+            try:
+                function()
+            except Exception as e:
+                logger.warning("Scheduled call failed: {0}".format(e))
@@ -0,0 +1,75 @@
+"""
+singleflight.py
+
+Deduplicates concurrent calls for the same key. While a call for a key is in
+flight, other callers asking for the same key wait for it and share its
+result (or its exception) instead of making their own, so a burst of cache
+misses for one key costs a single fetch.
+"""
+
+import threading
+
+class Call(object):
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def begin(self, key):
+        """
+        Get the call in flight for key, and whether it was just started
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                return call, False
+            call = self.calls[key] = Call()
+            return call, True
+
+    def run(self, key, call, func, args):
+        try:
+            call.result = func(*args)
+        except Exception as e:
+            call.error = e
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+
+    def do(self, key, func, *args):
+        """
+        Call func, or wait for the call already in flight for key
+        """
+        call, leader = self.begin(key)
+        if leader:
+            self.run(key, call, func, args)
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+    def start(self, key, func, *args):
+        """
+        Call func in the background, unless a call for key is already in
+        flight. Returns whether a call was started.
+        """
+        call, leader = self.begin(key)
+        if leader:
+            t = threading.Thread(target=self.run, args=(key, call, func, args))
+            t.daemon = True
+            t.start()
+        return leader
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.calls
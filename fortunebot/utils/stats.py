@@ -0,0 +1,217 @@
+"""
+stats.py
+
+Instrumentation for finding out where the bot spends its time. Stats counts
+the calls and errors of every script hook, keeps a histogram of how long they
+take, and counts the messages seen in each channel. Gauges, like the depth of
+the outbound queue, are read when the stats are reported.
+
+The stats can be served over HTTP by StatsServer, as JSON at /stats or in the
+Prometheus text format at /metrics.
+"""
+
+import json
+import time
+import bisect
+import threading
+from collections import defaultdict
+from six.moves import BaseHTTPServer, socketserver
+
+# Upper bounds of the latency histogram buckets, in seconds
+BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0]
+PREFIX = "fortunebot"
+
+class Histogram(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """
+        Get the upper bound of the bucket holding the q quantile, or None if
+        it's past the last bucket
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return None
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0.0
+
+class Stats(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.calls = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.latency = defaultdict(Histogram)
+        self.messages = defaultdict(int)
+        self.gauges = {}
+
+    def record(self, script, hook, seconds, error=False):
+        key = (script, hook)
+        with self.lock:
+            self.calls[key] += 1
+            if error:
+                self.errors[key] += 1
+            self.latency[key].observe(seconds)
+
+    def message(self, channel):
+        with self.lock:
+            self.messages[channel] += 1
+
+    def add_gauge(self, name, func):
+        """
+        Report the value func returns as the gauge name
+        """
+        with self.lock:
+            self.gauges[name] = func
+
+    def read_gauges(self):
+        with self.lock:
+            gauges = list(self.gauges.items())
+        return dict((name, func()) for name, func in gauges)
+
+    def snapshot(self):
+        """
+        Get the stats as plain data, to be dumped as JSON
+        """
+        gauges = self.read_gauges()
+        with self.lock:
+            uptime = time.time() - self.started
+            scripts = []
+            for (script, hook), h in sorted(self.latency.items()):
+                scripts.append({
+                    "script": script,
+                    "hook": hook,
+                    "calls": self.calls[(script, hook)],
+                    "errors": self.errors[(script, hook)],
+                    "mean": h.mean(),
+                    "p50": h.quantile(0.5),
+                    "p95": h.quantile(0.95),
+                    "buckets": dict(zip([str(b) for b in BUCKETS] + ["inf"],
+                                        h.counts)),
+                })
+            channels = {}
+            for channel, count in self.messages.items():
+                channels[channel] = {"messages": count,
+                                     "per_minute": count * 60.0 / uptime}
+        return {"uptime": uptime, "scripts": scripts, "channels": channels,
+                "gauges": gauges}
+
+    def prometheus(self):
+        """
+        Get the stats in the Prometheus text exposition format
+        """
+        gauges = self.read_gauges()
+        lines = []
+        with self.lock:
+            lines.append("# TYPE {0}_script_calls_total counter".format(PREFIX))
+            for key, count in sorted(self.calls.items()):
+                lines.append("{0}_script_calls_total{1} {2}".format(
+                    PREFIX, labels(script=key[0], hook=key[1]), count))
+            lines.append("# TYPE {0}_script_errors_total counter".format(PREFIX))
+            for key in sorted(self.calls):
+                lines.append("{0}_script_errors_total{1} {2}".format(
+                    PREFIX, labels(script=key[0], hook=key[1]),
+                    self.errors.get(key, 0)))
+            name = "{0}_script_latency_seconds".format(PREFIX)
+            lines.append("# TYPE {0} histogram".format(name))
+            for (script, hook), h in sorted(self.latency.items()):
+                total = 0
+                for bound, count in zip(BUCKETS + ["+Inf"], h.counts):
+                    total += count
+                    lines.append("{0}_bucket{1} {2}".format(name, labels(
+                        script=script, hook=hook, le=bound), total))
+                lines.append("{0}_sum{1} {2}".format(
+                    name, labels(script=script, hook=hook), h.sum))
+                lines.append("{0}_count{1} {2}".format(
+                    name, labels(script=script, hook=hook), h.count))
+            lines.append("# TYPE {0}_channel_messages_total counter".format(PREFIX))
+            for channel, count in sorted(self.messages.items()):
+                lines.append("{0}_channel_messages_total{1} {2}".format(
+                    PREFIX, labels(channel=channel), count))
+            lines.append("# TYPE {0}_uptime_seconds gauge".format(PREFIX))
+            lines.append("{0}_uptime_seconds {1}".format(
+                PREFIX, time.time() - self.started))
+        for gauge, value in sorted(gauges.items()):
+            lines.append("# TYPE {0}_{1} gauge".format(PREFIX, gauge))
+            lines.append("{0}_{1} {2}".format(PREFIX, gauge, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self, count=5):
+        """
+        Get a one line summary of the slowest script hooks, for chat
+        """
+        data = self.snapshot()
+        scripts = sorted(data["scripts"], key=lambda s: s["mean"],
+                         reverse=True)[:count]
+        parts = ["{0}.{1}: {2} calls, {3} errors, {4:.0f}ms avg".format(
+            s["script"], s["hook"], s["calls"], s["errors"], s["mean"] * 1000)
+            for s in scripts]
+        messages = sum(c["messages"] for c in data["channels"].values())
+        parts.append("{0} messages in {1:.0f}m".format(
+            messages, data["uptime"] / 60))
+        parts.extend("{0}: {1}".format(name, value)
+                     for name, value in sorted(data["gauges"].items()))
+        return " | ".join(parts)
+
+def labels(**kwargs):
+    pairs = []
+    for k, v in sorted(kwargs.items()):
+        v = str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        pairs.append("{0}=\"{1}\"".format(k, v))
+    return "{" + ",".join(pairs) + "}"
+
+class StatsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path == "/metrics":
+            body = self.server.stats.prometheus()
+            ctype = "text/plain; version=0.0.4"
+        elif path in ["/", "/stats"]:
+            body = json.dumps(self.server.stats.snapshot(), sort_keys=True)
+            ctype = "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StatsServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, stats, host, port):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), StatsHandler)
+        self.stats = stats
+        self.host = host
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
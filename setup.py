@@ -7,20 +7,20 @@ setup(
     classifiers=[
       'Development Status :: 4 - Beta',
       'License :: OSI Approved :: GNU General Public License v3 (GPLv3)',
-      'Programming Language :: Python :: 2.7',
       'Programming Language :: Python :: 3.4',
     ],
     url='https://github.com/EaterOA/fortunebot',
     author='Vincent Wong',
     author_email='duperduper@ucla.edu',
     license='GPL3',
+    python_requires='>=3.4',
     packages=find_packages(),
     include_package_data=True,
     install_requires=[
         'irc>=11',
         'appdirs',
         'requests',
-        'six',
+        'six>=1.13',
         'nose',
         'mock',
     ],
@@ -28,6 +28,8 @@ setup(
         'console_scripts': [
             'fortunebot = fortunebot.botrunner:main',
             'fortunebot-generate-config = fortunebot.generate_config:main',
+            'fortunebot-markov-train = fortunebot.markov_train:main',
+            'fortunebot-benchmark = fortunebot.benchmark:main',
         ],
     },
 )
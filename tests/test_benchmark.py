@@ -0,0 +1,44 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import random
+
+from fortunebot import benchmark
+
+EXAMPLE_LOG = [
+    "#bench nick1 hello there",
+    "#bench2 nick2 !choose a b",
+    "just a line",
+    "#bench",
+    "",
+]
+
+class TestBenchmark(object):
+
+    def test_parse_log(self):
+        assert benchmark.parse_log(EXAMPLE_LOG) == [
+            ("#bench", "nick1", "hello there"),
+            ("#bench2", "nick2", "!choose a b"),
+            (benchmark.CHANNELS[0], benchmark.NICKS[0], "just a line"),
+        ]
+
+    def test_replay(self):
+        rng = random.Random(benchmark.SEED)
+        corpus = benchmark.make_corpus(rng, 200)
+        log = benchmark.make_log(rng, 300, corpus)
+        res = benchmark.bench_replay(log, corpus)
+        assert res["messages_per_sec"] > 0
+        assert res["sent"] > 0
+        assert "choose.on_pubmsg.p95_ms" in res
+        assert "weather.on_pubmsg.p95_ms" in res
+
+    def test_compare(self):
+        baseline = {"replay": {"messages_per_sec": 100.0, "p95_ms": 1.0,
+                               "peak_rss_kb": 1000}}
+        results = {"replay": {"messages_per_sec": 70.0, "p95_ms": 1.05,
+                              "peak_rss_kb": 2000}}
+        regressions = benchmark.compare(results, baseline, 0.25)
+        assert len(regressions) == 2
+        assert regressions[0].startswith("replay.messages_per_sec")
+        assert regressions[1].startswith("replay.peak_rss_kb")
+        assert benchmark.compare(results, {}, 0.25) == []
@@ -1,19 +1,43 @@
 #! /usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import six
 import mock
+import shutil
+import tempfile
 
 import irc
 from fortunebot import bot
+from fortunebot.utils import Router
+from fortunebot.scripts.burn import Burn
 
 MODULE = 'fortunebot.botrunner'
 
 EXAMPLE_CHANNEL = "#test"
 EXAMPLE_NICK = "fortunebot"
+EXAMPLE_SOURCE = irc.client.NickMask("fortunebot!bot@example.com")
 EXAMPLE_MSG = "abcdefg"
 EXAMPLE_MSG2 = "星空"
 EXAMPLE_SCRIPT_RETURN = EXAMPLE_MSG2
+EXAMPLE_CONFIG = """
+[Connect]
+server = localhost
+port = 6667
+channels = test
+nickname = fortunebot
+realname = fortunebot
+reconnect_tries = 0
+reconnect_interval = 0
+ping_tries = 0
+ping_interval = 30
+
+[Scripts]
+enable_choose = yes
+enable_magic8ball = {magic8ball}
+enable_burn = yes
+burn_words = {words}
+"""
 
 class TestFortunebot(object):
 
@@ -23,14 +47,17 @@ class TestFortunebot(object):
         mock_script = mock.create_autospec(MockScript)
         mock_script.on_pubmsg.return_value = EXAMPLE_SCRIPT_RETURN
         self.bot.scripts = {"mock_script": mock_script}
+        self.bot.router = Router(self.bot.scripts)
 
     def test_send_msg(self):
         self.bot.send_msg(EXAMPLE_CHANNEL, EXAMPLE_MSG)
+        self.bot.outbox.wait()
         self.bot.connection.privmsg.assert_called_with(
             EXAMPLE_CHANNEL,
             to_unicode(EXAMPLE_MSG))
 
         self.bot.send_msg(EXAMPLE_CHANNEL, EXAMPLE_MSG2)
+        self.bot.outbox.wait()
         self.bot.connection.privmsg.assert_called_with(
             EXAMPLE_CHANNEL,
             to_unicode(EXAMPLE_MSG2))
@@ -38,17 +65,24 @@ class TestFortunebot(object):
     def test_send_msg_multiple(self):
         messages = [EXAMPLE_MSG + str(i) for i in six.moves.xrange(10)]
         self.bot.send_msg(EXAMPLE_CHANNEL, messages)
-        assert self.bot.connection.privmsg.call_count == len(messages)
+        self.bot.outbox.wait()
+        # Once the burst runs out, the remaining messages are joined together
+        calls = self.bot.connection.privmsg.call_args_list
+        assert len(calls) == self.bot.outbox.burst
+        sent = " | ".join(args[1] for args, _ in calls)
+        assert sent == " | ".join(messages)
 
     def test_send_msg_illegal(self):
         msg = "\r\n"
         self.bot.send_msg(EXAMPLE_CHANNEL, msg)
+        self.bot.outbox.wait()
         self.bot.connection.privmsg.assert_called_with(
             EXAMPLE_CHANNEL,
             "")
 
         msg = "\t\x7F"
         self.bot.send_msg(EXAMPLE_CHANNEL, msg)
+        self.bot.outbox.wait()
         self.bot.connection.privmsg.assert_called_with(
             EXAMPLE_CHANNEL,
             "")
@@ -56,6 +90,8 @@ class TestFortunebot(object):
     def test_on_pubmsg(self):
         e = irc.client.Event("", EXAMPLE_NICK, EXAMPLE_CHANNEL, [EXAMPLE_MSG])
         self.bot.on_pubmsg(self.bot.connection, e)
+        self.bot.dispatcher.wait()
+        self.bot.outbox.wait()
 
         self.bot.scripts["mock_script"].on_pubmsg.assert_called_with(
             EXAMPLE_NICK,
@@ -65,6 +101,129 @@ class TestFortunebot(object):
             EXAMPLE_CHANNEL,
             to_unicode(EXAMPLE_SCRIPT_RETURN))
 
+    def test_stats(self):
+        e = irc.client.Event("", EXAMPLE_SOURCE, EXAMPLE_CHANNEL, [EXAMPLE_MSG])
+        self.bot.on_pubmsg(self.bot.connection, e)
+        self.bot.dispatcher.wait()
+        data = self.bot.stats.snapshot()
+        assert data["scripts"][0]["script"] == "mock_script"
+        assert data["scripts"][0]["calls"] == 1
+        assert data["channels"][EXAMPLE_CHANNEL]["messages"] == 1
+
+        e = irc.client.Event("", EXAMPLE_SOURCE, EXAMPLE_CHANNEL, ["!stats"])
+        self.bot.config["stats_admins"] = []
+        self.bot.on_pubmsg(self.bot.connection, e)
+        self.bot.dispatcher.wait()
+        self.bot.outbox.wait()
+        self.bot.config["stats_admins"] = [EXAMPLE_NICK]
+        self.bot.on_pubmsg(self.bot.connection, e)
+        self.bot.dispatcher.wait()
+        self.bot.outbox.wait()
+        sent = [args[1] for args, _ in
+                self.bot.connection.privmsg.call_args_list]
+        assert len([m for m in sent if m.startswith("mock_script.on_pubmsg")]) == 1
+
+class TestLoadConfig(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.confpath = os.path.join(self.tmpdir, "fortunebot.conf")
+        self.bot = bot.Fortunebot()
+        self.bot.ping_thread = None
+
+    def teardown(self):
+        self.bot.clean()
+        shutil.rmtree(self.tmpdir)
+
+    def write_config(self, magic8ball, words):
+        with open(self.confpath, "w") as f:
+            f.write(EXAMPLE_CONFIG.format(magic8ball=magic8ball, words=words))
+
+    def test_reload(self):
+        self.write_config("yes", "burn")
+        self.bot.load_config([self.confpath])
+        assert sorted(self.bot.scripts) == ["burn", "choose", "magic8ball"]
+        choose = self.bot.scripts["choose"]
+        burn = self.bot.scripts["burn"]
+
+        self.write_config("no", "scorch")
+        self.bot.reload_config([self.confpath]).join()
+        # Only the scripts whose settings changed are rebuilt
+        assert sorted(self.bot.scripts) == ["burn", "choose"]
+        assert self.bot.scripts["choose"] is choose
+        assert self.bot.scripts["burn"] is not burn
+        assert self.bot.scripts["burn"].words == ["scorch"]
+        assert "magic8ball" not in self.bot.help_msg
+        assert [name for name, _ in self.bot.router.route("!choose a b")] \
+            == ["choose"]
+
+    def test_reload_failed(self):
+        self.write_config("yes", "burn")
+        self.bot.load_config([self.confpath])
+        scripts = self.bot.scripts
+        os.remove(self.confpath)
+        self.bot.reload_config([self.confpath]).join()
+        assert self.bot.scripts is scripts
+
+    def test_reload_swaps_when_built(self):
+        self.write_config("yes", "burn")
+        self.bot.load_config([self.confpath])
+        burn = self.bot.scripts["burn"]
+        burn.on_save = mock.Mock()
+        burn.on_unload = mock.Mock()
+        init = Burn.__init__
+        serving = []
+
+        def build(script, words):
+            # The old script saved its state and is still handling messages
+            assert burn.on_save.called
+            assert not burn.on_unload.called
+            serving.append(self.bot.scripts["burn"] is burn)
+            init(script, words)
+
+        self.write_config("yes", "scorch")
+        with mock.patch.object(Burn, "__init__", build):
+            self.bot.load_config([self.confpath])
+        assert serving == [True]
+        assert self.bot.scripts["burn"].words == ["scorch"]
+        burn.on_unload.assert_called_once_with()
+
+    def test_reload_init_failed(self):
+        self.write_config("yes", "burn")
+        self.bot.load_config([self.confpath])
+        burn = self.bot.scripts["burn"]
+        burn.on_unload = mock.Mock()
+
+        self.write_config("no", "scorch")
+        with mock.patch.object(Burn, "__init__",
+                               mock.Mock(side_effect=ValueError)):
+            self.bot.load_config([self.confpath])
+        # The old script keeps running when its replacement can't be built
+        assert sorted(self.bot.scripts) == ["burn", "choose"]
+        assert self.bot.scripts["burn"] is burn
+        assert not burn.on_unload.called
+        assert self.bot.specs["burn"][1] == {"words": "burn"}
+
+        # and is rebuilt on the next reload that succeeds
+        self.bot.load_config([self.confpath])
+        assert self.bot.scripts["burn"].words == ["scorch"]
+        burn.on_unload.assert_called_once_with()
+
+    def test_reload_limits(self):
+        self.write_config("yes", "burn")
+        self.bot.load_config([self.confpath])
+        default = self.bot.dispatcher.get_limits("burn")
+
+        self.write_config("yes", "scorch")
+        with mock.patch.object(Burn, "TIMEOUT", 30, create=True):
+            with mock.patch.object(Burn, "__init__",
+                                   mock.Mock(side_effect=ValueError)):
+                self.bot.load_config([self.confpath])
+            # The new limits only apply once the script they're for runs
+            assert self.bot.dispatcher.get_limits("burn") == default
+            self.bot.load_config([self.confpath])
+        assert self.bot.dispatcher.get_limits("burn") == (default[0], 30)
+
 class MockScript(object):
     def on_pubmsg(self, source, channel, text):
         pass
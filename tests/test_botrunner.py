@@ -3,6 +3,8 @@
 
 import os
 import mock
+import shutil
+import tempfile
 
 from fortunebot import botrunner
 
@@ -10,6 +12,7 @@ MODULE = 'fortunebot.botrunner'
 
 RELATIVE_FILE = "sup.txt"
 ABSOLUTE_FILE = "/sup.txt"
+EXAMPLE_SHARDS = ["a.conf", "b.conf"]
 
 class TestFortunebotRunner():
 
@@ -37,6 +40,73 @@ class TestFortunebotRunner():
         assert mock_os.close.call_count >= 3
         assert mock_open.call_count == 3
 
+class TestFortunebotSupervisor():
+
+    def setup(self):
+        default_args = get_default_args()
+        self.supervisor = botrunner.FortunebotSupervisor(shards=EXAMPLE_SHARDS,
+                                                         **default_args)
+
+    def test_shard_confpath(self):
+        runner = botrunner.FortunebotRunner(shard=RELATIVE_FILE,
+                                            **get_default_args())
+        assert runner.confpaths[-1] == os.path.abspath(RELATIVE_FILE)
+
+    @mock.patch(MODULE + '.os.fork')
+    def test_spawn(self, mock_fork):
+        mock_fork.side_effect = [100, 101]
+        for shard in EXAMPLE_SHARDS:
+            self.supervisor.spawn(shard)
+        assert self.supervisor.children == {100: "a.conf", 101: "b.conf"}
+
+    @mock.patch(MODULE + '.time.sleep')
+    @mock.patch(MODULE + '.os.fork')
+    @mock.patch(MODULE + '.os.wait')
+    def test_supervise(self, mock_wait, mock_fork, mock_sleep):
+        self.supervisor.children = {100: "a.conf"}
+        mock_fork.return_value = 101
+        def wait():
+            pid = min(self.supervisor.children)
+            if pid == 101:
+                # Restarted once, so stop from here
+                self.supervisor.exiting = True
+            return pid, 0
+        mock_wait.side_effect = wait
+        self.supervisor.supervise()
+        assert mock_fork.call_count == 1
+        assert self.supervisor.children == {}
+
+    def test_snapshot_writers(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            configs = {
+                "common.conf": "[Scripts]\nenable_markov = yes\n"
+                               "markov_snapshot = shared.snapshot\n",
+                "a.conf": "",
+                "b.conf": "[Scripts]\nmarkov_snapshot_save = no\n",
+                "c.conf": "",
+            }
+            for name, text in configs.items():
+                with open(os.path.join(tmpdir, name), "w") as f:
+                    f.write(text)
+            args = get_default_args()
+            args.update(confpath="common.conf", workpath=tmpdir)
+            supervisor = botrunner.FortunebotSupervisor(
+                shards=["a.conf", "b.conf"], **args)
+            path = os.path.join(tmpdir, "shared.snapshot")
+            assert supervisor.snapshot_writers() == {path: ["a.conf"]}
+            supervisor.shards.append("c.conf")
+            assert supervisor.snapshot_writers() == {path: ["a.conf", "c.conf"]}
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @mock.patch(MODULE + '.os.kill')
+    def test_sigterm(self, mock_kill):
+        self.supervisor.children = {100: "a.conf"}
+        self.supervisor.sigterm_handler(None, None)
+        assert self.supervisor.exiting
+        mock_kill.assert_called_with(100, botrunner.signal.SIGTERM)
+
 def get_default_args():
     return {
         'daemonize': False,
@@ -51,4 +121,8 @@ def test_parse_args():
     default_args = get_default_args()
     for k, v in default_args.items():
         assert getattr(args, k) == v
+    assert args.shards == []
+    args = botrunner.parse_args(["--shard", EXAMPLE_SHARDS[0],
+                                 "--shard", EXAMPLE_SHARDS[1]])
+    assert args.shards == EXAMPLE_SHARDS
 
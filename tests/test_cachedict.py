@@ -0,0 +1,89 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import mock
+
+from fortunebot.utils import CacheDict
+
+EXAMPLE_TIME = 1000000
+
+class TestCacheDict(object):
+
+    def setup(self):
+        self.now = EXAMPLE_TIME
+        self.patcher = mock.patch("time.time", lambda: self.now)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+
+    def test_limit(self):
+        cache = CacheDict(limit=2)
+        cache["a"] = 1
+        cache["b"] = 2
+        cache["a"] = 3
+        cache["c"] = 4
+        assert dict(cache) == {"a": 3, "c": 4}
+
+    def test_prune(self):
+        cache = CacheDict(duration=10)
+        cache["a"] = 1
+        self.now += 5
+        cache["b"] = 2
+        assert cache.next_expiry() == EXAMPLE_TIME + 10
+        self.now += 5
+        assert cache.prune() == {"a": 1}
+        assert dict(cache) == {"b": 2}
+        assert cache.next_expiry() == EXAMPLE_TIME + 15
+
+    def test_offset(self):
+        cache = CacheDict()
+        cache.insert("late", 1, 30)
+        cache.insert("early", 2, 10)
+        cache["now"] = 3
+        self.now += 10
+        assert cache.prune() == {"now": 3, "early": 2}
+        assert cache.next_expiry() == EXAMPLE_TIME + 30
+        self.now += 20
+        assert cache.prune() == {"late": 1}
+        assert cache.next_expiry() is None
+
+    def test_delete(self):
+        cache = CacheDict(duration=10)
+        cache["a"] = 1
+        cache["b"] = 2
+        del cache["a"]
+        assert "a" not in cache
+        assert cache.times() == {"b": EXAMPLE_TIME}
+        self.now += 10
+        assert cache.prune() == {"b": 2}
+        assert len(cache) == 0
+
+    def test_lru(self):
+        cache = CacheDict(limit=2, lru=True)
+        cache["a"] = 1
+        self.now += 1
+        cache["b"] = 2
+        self.now += 1
+        assert cache["a"] == 1
+        cache["c"] = 3
+        assert dict(cache) == {"a": 1, "c": 3}
+        assert "c" in cache
+        self.now += 1
+        cache["d"] = 4
+        assert dict(cache) == {"c": 3, "d": 4}
+
+    def test_stale_entries_dropped(self):
+        cache = CacheDict()
+        for i in range(10000):
+            cache[i % 10] = i
+        assert len(cache) == 10
+        assert len(cache.timestore) < 100
+
+    def test_many(self):
+        cache = CacheDict(duration=0)
+        for i in range(200000):
+            cache.insert(i, i, 200000 - i)
+        self.now += 100000
+        assert len(cache.prune()) == 100000
+        assert min(cache) == 0
@@ -0,0 +1,75 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+
+from fortunebot.utils import Dispatcher
+
+EXAMPLE_CHANNEL = "#test"
+EXAMPLE_CHANNEL2 = "#test2"
+
+class TestDispatcher(object):
+
+    def setup(self):
+        self.posted = []
+        self.dispatcher = Dispatcher(self.post, workers=4, timeout=1.0)
+
+    def teardown(self):
+        self.dispatcher.resize(0)
+
+    def post(self, target, msg):
+        self.posted.append((target, msg))
+
+    def test_order_per_target(self):
+        self.dispatcher.submit("slow", EXAMPLE_CHANNEL, sleep_return, 0.2, "a")
+        self.dispatcher.submit("fast", EXAMPLE_CHANNEL, sleep_return, 0, "b")
+        self.dispatcher.submit("fast", EXAMPLE_CHANNEL2, sleep_return, 0, "c")
+        time.sleep(0.1)
+        assert self.posted == [(EXAMPLE_CHANNEL2, "c")]
+        self.dispatcher.wait()
+        assert self.posted == [(EXAMPLE_CHANNEL2, "c"),
+                               (EXAMPLE_CHANNEL, "a"),
+                               (EXAMPLE_CHANNEL, "b")]
+
+    def test_timeout(self):
+        self.dispatcher.set_limits("slow", timeout=0.1)
+        self.dispatcher.submit("slow", EXAMPLE_CHANNEL, sleep_return, 0.5, "a")
+        self.dispatcher.submit("fast", EXAMPLE_CHANNEL, sleep_return, 0, "b")
+        time.sleep(0.2)
+        self.dispatcher.flush(EXAMPLE_CHANNEL)
+        assert self.posted == [(EXAMPLE_CHANNEL, "b")]
+        time.sleep(0.5)
+        assert self.posted == [(EXAMPLE_CHANNEL, "b")]
+
+    def test_concurrency(self):
+        running = []
+        peak = []
+        lock = threading.Lock()
+        def handler():
+            with lock:
+                running.append(1)
+                peak.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.pop()
+        self.dispatcher.set_limits("limited", concurrency=2)
+        for _ in range(6):
+            self.dispatcher.submit("limited", EXAMPLE_CHANNEL, handler)
+        self.dispatcher.wait()
+        assert max(peak) == 2
+
+    def test_inline(self):
+        self.dispatcher.resize(0)
+        self.dispatcher.submit("fast", EXAMPLE_CHANNEL, sleep_return, 0, "a")
+        assert self.posted == [(EXAMPLE_CHANNEL, "a")]
+
+    def test_errors(self):
+        self.dispatcher.submit("broken", EXAMPLE_CHANNEL, int, "a")
+        self.dispatcher.submit("fast", EXAMPLE_CHANNEL, sleep_return, 0, "b")
+        self.dispatcher.wait()
+        assert self.posted == [(EXAMPLE_CHANNEL, "b")]
+
+def sleep_return(duration, msg):
+    time.sleep(duration)
+    return msg
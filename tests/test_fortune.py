@@ -0,0 +1,45 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from fortunebot.scripts.fortune import Fortune
+from fortunebot.utils.fortunedb import write_strfile
+
+EXAMPLE_LENGTH = 20
+EXAMPLE_FORTUNES = {
+    "short": ["Hello\nworld", "x" * 30, "Bye"],
+    "long": ["y" * 30],
+    "rot": ["Secret"],
+}
+
+class TestFortune(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        for name, fortunes in EXAMPLE_FORTUNES.items():
+            write_strfile(os.path.join(self.tmpdir, name), fortunes,
+                           name == "rot")
+        self.fortune = Fortune(EXAMPLE_LENGTH, self.tmpdir)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_category(self):
+        for _ in range(20):
+            assert self.fortune.get_fortune("short") in ["Hello world", "Bye"]
+        assert self.fortune.get_fortune("rot") == "Secret"
+
+    def test_all(self):
+        seen = set(self.fortune.get_fortune(None) for _ in range(100))
+        assert seen == set(["Hello world", "Bye", "Secret"])
+
+    def test_not_found(self):
+        assert self.fortune.get_fortune("long") == "ERROR: Fortune not found"
+        assert self.fortune.get_fortune("nope") == "ERROR: Fortune not found"
+
+    def test_on_pubmsg(self):
+        assert self.fortune.on_pubmsg(None, None, "!fortune rot!") == "Secret"
+        assert self.fortune.on_pubmsg(None, None, "fortune") is None
@@ -0,0 +1,66 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+from six.moves import BaseHTTPServer, socketserver
+
+from fortunebot.utils import HTTPClient
+
+EXAMPLE_BODY = b"hello"
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests += 1
+        status = 200
+        if self.path == "/flaky" and self.server.requests == 1:
+            status = 503
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(EXAMPLE_BODY)))
+        self.end_headers()
+        self.wfile.write(EXAMPLE_BODY)
+
+    def log_message(self, *args):
+        pass
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class TestHTTPClient(object):
+
+    def setup(self):
+        self.server = Server(("127.0.0.1", 0), Handler)
+        self.server.connections = 0
+        self.server.requests = 0
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = "http://127.0.0.1:{0}".format(self.server.server_address[1])
+        self.client = HTTPClient(backoff=0)
+
+    def teardown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_keep_alive(self):
+        for _ in range(5):
+            assert self.client.get(self.url + "/").content == EXAMPLE_BODY
+        assert self.server.requests == 5
+        assert self.server.connections == 1
+
+    def test_retry(self):
+        r = self.client.get(self.url + "/flaky")
+        assert r.status_code == 200
+        assert self.server.requests == 2
+
+    def test_get_async(self):
+        results = [self.client.get_async(self.url + "/") for _ in range(8)]
+        assert all(r.get(5).content == EXAMPLE_BODY for r in results)
+        assert self.server.connections <= 4
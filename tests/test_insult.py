@@ -0,0 +1,60 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import mock
+
+from fortunebot.scripts.insult import Insult
+
+MODULE = "fortunebot.scripts.insult"
+
+EXAMPLE_PAGE = "<html>\nThou art a knave.</font>\n</html>"
+EXAMPLE_INSULT = "Thou art a knave."
+EXAMPLE_POOL = 4
+
+class TestInsult(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, "insults")
+        self.client = mock.Mock()
+        self.client.get.return_value = mock.Mock(text=EXAMPLE_PAGE)
+        self.patcher = mock.patch(MODULE + ".get_client", lambda: self.client)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def wait_filled(self, insult):
+        while insult.filling:
+            time.sleep(0.01)
+
+    def test_pool(self):
+        insult = Insult(EXAMPLE_POOL, self.cache)
+        self.wait_filled(insult)
+        assert len(insult.pool) == EXAMPLE_POOL
+        assert self.client.get.call_count == EXAMPLE_POOL
+        assert insult.on_pubmsg(None, None, "!insult") == EXAMPLE_INSULT
+        assert self.client.get.call_count == EXAMPLE_POOL
+        # Below the low water mark, the pool is topped up again
+        for _ in range(3):
+            insult.get_insult()
+        self.wait_filled(insult)
+        assert len(insult.pool) == EXAMPLE_POOL
+
+    def test_fallback(self):
+        insult = Insult(EXAMPLE_POOL, self.cache)
+        self.wait_filled(insult)
+        self.client.get.side_effect = IOError
+        insult = Insult(EXAMPLE_POOL, self.cache)
+        self.wait_filled(insult)
+        assert not insult.pool
+        assert insult.get_insult() == EXAMPLE_INSULT
+        os.remove(self.cache)
+        insult = Insult(EXAMPLE_POOL, self.cache)
+        self.wait_filled(insult)
+        assert insult.get_insult() == "ERROR: Unable to retrieve insult"
@@ -0,0 +1,541 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import shutil
+import tempfile
+import mock
+from collections import Counter
+
+from fortunebot.scripts.markov import Markov, Keywords
+from fortunebot.utils import MarkovTable, PartitionCache
+from fortunebot.utils.markovtable import decay
+
+EXAMPLE_RESPOND = "fortunebot"
+EXAMPLE_LINES = [
+    "the quick brown fox jumps over the lazy dog",
+    "the lazy dog sleeps",
+    "a quick brown dog jumps",
+    "星空 is the sky full of stars",
+    "the sky",
+]
+
+class TestMarkovTable(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        # A tiny delta limit forces frequent merges into the arrays
+        self.table = MarkovTable(min_delta=4)
+        for line in EXAMPLE_LINES:
+            for triplet in Markov.triples(line):
+                self.table.add_triple(*triplet)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_rows_match_counters(self):
+        expected = reference_table(EXAMPLE_LINES)
+        for order in range(3):
+            for base, counters in expected[order].items():
+                for idx, prepend in enumerate([True, False]):
+                    row = self.table.row(order, base, prepend)
+                    counter = counters[idx]
+                    if not counter:
+                        assert not row
+                        continue
+                    assert len(row) == len(counter)
+                    assert row.total() == sum(counter.values())
+                    for word, n in counter.items():
+                        assert row.count(word) == n
+
+    def test_compact_preserves_rows(self):
+        before = self.table.row(1, "the", False)
+        self.table.compact()
+        after = self.table.row(1, "the", False)
+        assert before.items() == after.items()
+
+    def test_sample(self):
+        self.table.compact()
+        self.table.add_triple("the", "lazy", "cat")
+        row = self.table.row(1, "lazy", False)
+        assert row.extra and row.hi > row.lo
+        seen = set(row.sample() for _ in range(200))
+        assert seen == set(["dog", "cat"])
+
+    def test_snapshot(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        self.table.save(path, 42)
+        table, position = MarkovTable.load(path)
+        assert position == 42
+        assert len(table) == len(self.table)
+        assert "星空" in table
+        for order, base in [(0, None), (1, "the"), (2, ("the", "lazy"))]:
+            for prepend in [True, False]:
+                assert (table.row(order, base, prepend).items() ==
+                        self.table.row(order, base, prepend).items())
+
+    def test_snapshot_attach(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        frozen = self.table.freeze()
+        self.table.add_triple("the", "lazy", "cat")
+        frozen.save(path)
+        self.table.attach(path)
+        self.table.add_triple("the", "lazy", "catfish")
+        assert self.table.row(1, "lazy", False).items() == [
+            ("dog", 2), ("cat", 1), ("catfish", 1)]
+
+    def test_common(self):
+        self.table.compact()
+        self.table.add_triple("the", "lazy", "cat")
+        row = self.table.row(1, "lazy", False)
+        vocab = self.table.vocab
+        few = set(vocab.lookup(w) for w in ["cat", "fox"])
+        many = set(vocab.lookup(w) for w in ["dog", "cat", "fox", "the"])
+        assert row.common(few) == [vocab.lookup("cat")]
+        assert sorted(row.common(many)) == sorted(
+            vocab.lookup(w) for w in ["dog", "cat"])
+        assert not row.single()
+        assert self.table.row(1, "fox", False).single()
+
+    def test_large_counts(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        self.table.transitions[0][1].add(0, self.table.vocab.lookup("the"),
+                                         1 << 33)
+        self.table.compact()
+        self.table.save(path)
+        table, _ = MarkovTable.load(path)
+        assert table.row(0, None, False).count("the") == (1 << 33) + 2
+
+    def test_snapshot_replaced(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        frozen = self.table.freeze()
+        generation = frozen.save(path)
+        # Another process saves to the same path in the meantime
+        MarkovTable().save(path)
+        try:
+            self.table.attach(path, generation)
+            assert False
+        except ValueError:
+            pass
+        self.table.thaw(frozen)
+        assert self.table.row(1, "the", False).total() == 5
+
+    def test_unknown_base(self):
+        assert self.table.row(1, "unknown", False) is None
+        assert self.table.row(2, ("the", "unknown"), True) is None
+
+    def test_vocabulary(self):
+        assert len(self.table) == len(reference_table(EXAMPLE_LINES)[1])
+        assert "星空" in self.table
+        assert None not in self.table
+        for _ in range(20):
+            assert self.table.random_word() in self.table
+
+    def test_decay(self):
+        lines = EXAMPLE_LINES + ["the lazy dog"] * 3
+        table = MarkovTable(min_delta=4)
+        for line in lines:
+            for triplet in Markov.triples(line):
+                table.add_triple(*triplet)
+        table.compact()
+        size = len(table)
+        for _ in decay([table], 0.5, step=2):
+            pass
+        for order, rows in enumerate(reference_table(lines)):
+            for base, counters in rows.items():
+                for prepend, counter in zip([True, False], counters):
+                    expected = dict((w, n // 2) for w, n in counter.items()
+                                    if n // 2)
+                    row = table.row(order, base, prepend)
+                    assert (dict(row.items()) if row else {}) == expected
+        # Words no longer counted are released, and their ids reused
+        assert "星空" not in table
+        assert "lazy" in table
+        assert table.vocab.intern("new") <= size
+        assert len(table) == size
+
+    def test_decay_snapshot(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        self.table.save(path)
+        table, _ = MarkovTable.load(path)
+        for _ in decay([table], 0.5):
+            pass
+        assert "星空" not in table
+        assert table.row(1, "the", False).items() == [("lazy", 1), ("sky", 1)]
+        table.save(path)
+        table, _ = MarkovTable.load(path)
+        assert "星空" not in table
+        assert "lazy" in table
+        assert table.row(1, "the", False).items() == [("lazy", 1), ("sky", 1)]
+
+    def test_decay_reuses_ids(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        table = MarkovTable()
+        for cycle in range(5):
+            words = ["w{0}_{1}".format(cycle, i) for i in range(50)]
+            for i in range(0, len(words), 5):
+                table.add_words(words[i:i + 5])
+            table.attach(path, table.freeze().save(path))
+            # Everything from the cycle before is dropped
+            for _ in decay([table], 0.5, threshold=2):
+                pass
+            assert words[0] not in table
+        # The ids of released snapshot words are taken by the new ones, once
+        # the next snapshot has left them out
+        assert len(table) <= 100
+        table.add_words(["the", "new", "words"])
+        table.attach(path, table.freeze().save(path))
+        table, _ = MarkovTable.load(path)
+        assert "w4_0" not in table
+        assert table.row(1, "the", False).items() == [("new", 1)]
+        assert table.vocab.word(table.vocab.lookup("words")) == "words"
+
+    def test_bulk(self):
+        table = MarkovTable(order=3)
+        expected = MarkovTable(order=3)
+        # A tiny chunk makes for several chunks to merge
+        with mock.patch("fortunebot.utils.markovtable.BULK_CHUNK", 4):
+            table.start_bulk()
+            for line in EXAMPLE_LINES * 2:
+                table.add_words(line.split())
+                expected.add_words(line.split())
+            table.end_bulk()
+        assert table.delta_size() == 0
+        for pair, expected_pair in zip(table.transitions, expected.transitions):
+            for t, expected_t in zip(pair, expected_pair):
+                found = Counter()
+                for key, wid, n in expected_t.counts():
+                    found[key, wid] += n
+                assert list(t.counts()) == sorted(
+                    (key, wid, n) for (key, wid), n in found.items())
+
+    def test_decay_interleaved(self):
+        table = MarkovTable(min_delta=1)
+        for _ in range(2):
+            table.add_words(["the", "quick", "brown", "fox"])
+        table.compact()
+        passes = decay([table], 0.5, step=1)
+        next(passes)
+        # Counts added midway aren't merged into orders yet to be scaled
+        table.add_words(["x", "a", "y"])
+        for _ in passes:
+            pass
+        assert table.row(1, "x", False).items() == [("a", 1)]
+        assert table.row(1, "a", False).items() == [("y", 1)]
+        assert table.row(1, "the", False).items() == [("quick", 1)]
+
+    def test_lookup_after_reuse(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        table = MarkovTable()
+        table.add_words(["d", "c", "c", "a"])
+        table.attach(path, table.freeze().save(path))
+        for _ in decay([table], 0.5, 1):
+            pass
+        # The ids released from the snapshot wait for the next one
+        table.add_words(["c", "d", "d"])
+        assert "c" in table
+        assert table.row(1, "c", False).items() == [("d", 1)]
+        table.attach(path, table.freeze().save(path))
+        for _ in decay([table], 0.5, 1):
+            pass
+        table.add_words(["e", "c"])
+        table.add_words(["c", "e"])
+        # e takes an id the snapshot left empty
+        assert table.vocab.lookup("e") < table.vocab.base
+        for word in ("c", "e"):
+            assert table.vocab.word(table.vocab.lookup(word)) == word
+        assert table.row(1, "c", False).items() == [(None, 1), ("e", 1)]
+
+    def test_random_word_after_decay(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        table = MarkovTable()
+        for i in range(100):
+            table.add_words(["w{0}".format(i), "rare{0}".format(i)])
+        table.add_words(["kept", "kept", "kept", "words"] * 4)
+        table.attach(path, table.freeze().save(path))
+        # Only a handful of the words are left, most of them in the snapshot
+        for _ in decay([table], 0.5, threshold=2):
+            pass
+        table.add_words(["fresh"])
+        for _ in range(50):
+            assert table.random_word() in ("kept", "words", "fresh")
+        table.attach(path, table.freeze().save(path))
+        table, _ = MarkovTable.load(path)
+        assert sorted(table.vocab.word(wid) for wid in table.vocab.used) == \
+            ["fresh", "kept", "words"]
+        assert MarkovTable().random_word() is None
+
+class TestMarkov(object):
+
+    def setup(self):
+        self.markov = Markov("", True, False, EXAMPLE_RESPOND)
+        for line in EXAMPLE_LINES:
+            self.markov.on_pubmsg(None, "#test", line)
+
+    def test_filter_keywords(self):
+        text = "{0} the fox and the unknown".format(EXAMPLE_RESPOND)
+        keywords = self.markov.filter_keywords(text)
+        assert keywords == ["the", "fox", "the"]
+
+    def test_keywords(self):
+        vocab = self.markov.table.vocab
+        keywords = Keywords(vocab, ["the", "fox", "the", "lazy"])
+        keywords.discard("the")
+        keywords.discard("unknown")
+        assert sorted(vocab.word(w) for w in keywords.ids) == [
+            "fox", "lazy", "the"]
+        row = self.markov.table.row(1, "quick", False)
+        assert keywords.pop_from(row) is None
+        row = self.markov.table.row(1, "the", False)
+        assert keywords.pop_from(row) == "lazy"
+        assert sorted([keywords.pop(), keywords.pop()]) == ["fox", "the"]
+        assert not keywords
+
+    def test_generate(self):
+        for _ in range(20):
+            msg = self.markov.on_pubmsg(None, "#test", EXAMPLE_RESPOND + " fox")
+            assert msg
+            for word in msg.replace(". ", " ").split():
+                assert word in self.markov.table
+
+class TestMarkovSnapshot(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sample.txt")
+        self.snapshot = os.path.join(self.tmpdir, "sample.snapshot")
+        with open(self.path, "w") as f:
+            f.write("\n".join(EXAMPLE_LINES[:3]) + "\n")
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_reads_only_new_lines(self):
+        markov = Markov(self.path, True, False, EXAMPLE_RESPOND, self.snapshot)
+        assert os.path.exists(self.snapshot)
+        with open(self.path, "a") as f:
+            f.write(EXAMPLE_LINES[3] + "\n")
+        markov = Markov(self.path, True, False, EXAMPLE_RESPOND, self.snapshot)
+        _, position = MarkovTable.load(self.snapshot)
+        assert position == os.path.getsize(self.path)
+        assert markov.table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 2), ("sky", 1)]
+
+class TestMarkovDecay(object):
+
+    def test_decay_slices(self):
+        markov = Markov("", True, False, EXAMPLE_RESPOND, decay_interval=60)
+        markov.DECAY_STEP = 2
+        for line in EXAMPLE_LINES * 2:
+            markov.on_pubmsg(None, "#test", line)
+        markov.table.compact()
+        markov.decay_due = 0
+        slices = 0
+        while True:
+            markov.on_poll("#test")
+            slices += 1
+            if not markov.decaying:
+                break
+            markov.decay_due = 0
+        assert slices > 1
+        assert markov.next_poll("#test") > time.time() + 30
+        assert markov.table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 2), ("sky", 2)]
+
+    def test_blocked_deadlines(self):
+        markov = Markov("", True, False, EXAMPLE_RESPOND, decay_interval=60)
+        markov.snapshot_save = True
+        now = time.time()
+        # An overdue snapshot waits for the decay, which is polled for alone
+        markov.snapshot_due = 0
+        markov.decaying = iter([])
+        markov.decay_due = now + 10
+        assert markov.next_poll("#test") == now + 10
+        # An overdue decay waits for the save, which is checked on in a while
+        markov.decaying = None
+        markov.decay_due = 0
+        markov.saving = True
+        assert markov.next_poll("#test") >= now + markov.SAVE_CHECK
+        markov.saving = False
+        assert markov.next_poll("#test") == 0
+
+class TestMarkovPartitions(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.markov = Markov("", True, False, EXAMPLE_RESPOND,
+                             partitions="channel",
+                             partition_path=self.tmpdir)
+        for line in EXAMPLE_LINES[:2]:
+            self.markov.on_pubmsg(None, "#Dogs", line)
+        for line in EXAMPLE_LINES[3:]:
+            self.markov.on_pubmsg(None, "#sky", line)
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_shared_vocabulary(self):
+        dogs = self.markov.partitions.get(("channel", "#dogs"))
+        sky = self.markov.partitions.get(("channel", "#sky"))
+        assert dogs.vocab is sky.vocab is self.markov.table.vocab
+        assert dogs.row(1, "the", False).items() == [("quick", 1), ("lazy", 2)]
+        assert sky.row(1, "the", False).items() == [("sky", 2)]
+        assert self.markov.table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 2), ("sky", 2)]
+
+    def test_rebase(self):
+        table = MarkovTable()
+        table.add_words(["sky", "words"])
+        self.markov.partitions.rebase(table.vocab)
+        dogs = self.markov.partitions.get(("channel", "#dogs"))
+        assert dogs.vocab is table.vocab
+        assert dogs.row(1, "the", False).items() == [("quick", 1), ("lazy", 2)]
+
+    def test_fallback(self):
+        self.markov.min_row = 2
+        tables = [self.markov.partitions.get(("channel", "#sky")),
+                  self.markov.table]
+        assert self.markov.row(tables, 1, "the", False).items() == [
+            ("sky", 2)]
+        assert self.markov.row(tables, 1, "dog", False).total() == 2
+        self.markov.min_row = 3
+        assert self.markov.row(tables, 1, "the", False).total() == 5
+
+    def test_evict(self):
+        cache = self.markov.partitions
+        cache.budget = 1
+        dogs = cache.get(("channel", "#dogs"))
+        cache.get(("channel", "#sky"))
+        cache.shrink()
+        assert ("channel", "#dogs") not in cache
+        # Written out on the next poll rather than while handling a message
+        assert os.listdir(self.tmpdir) == []
+        assert self.markov.next_poll("#test") <= time.time()
+        # and taken back from there if needed again first
+        assert cache.get(("channel", "#dogs")) is dogs
+        assert ("channel", "#sky") not in cache
+        self.markov.save_partitions()
+        assert not cache.evicted and not cache.writing
+        assert len(os.listdir(self.tmpdir)) == 2
+        assert dogs.vocab is self.markov.table.vocab
+        assert dogs.row(1, "the", False).items() == [("quick", 1), ("lazy", 2)]
+        # Loaded again from disk into a fresh vocabulary
+        cache = PartitionCache(MarkovTable().vocab, self.tmpdir, 1)
+        sky = cache.get(("channel", "#sky"))
+        assert sky.row(1, "the", False).items() == [("sky", 2)]
+        assert cache.get(("channel", "#nowhere")) is None
+
+class TestMarkovOrder(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.table = MarkovTable(min_delta=4, order=4)
+        for line in EXAMPLE_LINES:
+            self.table.add_words(line.split())
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lower_orders_match_counters(self):
+        expected = reference_table(EXAMPLE_LINES)
+        for order in range(3):
+            for base, counters in expected[order].items():
+                for prepend, counter in zip([True, False], counters):
+                    row = self.table.row(order, base, prepend)
+                    assert (dict(row.items()) if row else {}) == dict(counter)
+
+    def test_higher_orders(self):
+        table = self.table
+        assert table.row(3, ("the", "lazy", "dog"), False).items() == [
+            (None, 1), ("sleeps", 1)]
+        assert table.row(3, ("quick", "brown", "dog"), True).items() == [
+            ("a", 1)]
+        assert table.row(4, ("the", "quick", "brown", "fox"), False).items() == [
+            ("jumps", 1)]
+        assert table.row(3, ("the", "lazy", "cat"), False) is None
+        assert table.row(5, ("the", "quick", "brown", "fox", "jumps"),
+                         False) is None
+        # Contexts sharing a prefix share its node
+        key = table.key(4, ("the", "quick", "brown", "fox"))
+        assert table.nodes[1].by_id[key >> 32] >> 32 == \
+            table.key(3, ("the", "quick", "brown")) >> 32
+        assert [table.vocab.word(w) for w in table.context(4, key)] == [
+            "the", "quick", "brown", "fox"]
+
+    def test_snapshot(self):
+        path = os.path.join(self.tmpdir, "model.snapshot")
+        frozen = self.table.freeze()
+        self.table.add_words("the quick brown cat".split())
+        frozen.save(path)
+        self.table.attach(path)
+        assert self.table.row(3, ("the", "quick", "brown"), False).items() == [
+            ("fox", 1), ("cat", 1)]
+        table, _ = MarkovTable.load(path)
+        assert table.order == 4
+        assert table.row(3, ("the", "quick", "brown"), False).items() == [
+            ("fox", 1)]
+        try:
+            MarkovTable().attach(path)
+            assert False
+        except ValueError:
+            pass
+
+    def test_add_table(self):
+        table = MarkovTable(order=3)
+        table.add_table(self.table)
+        assert table.row(3, ("the", "lazy", "dog"), False).items() == [
+            (None, 1), ("sleeps", 1)]
+        assert table.row(4, ("the", "quick", "brown", "fox"), False) is None
+
+    def test_decay(self):
+        self.table.add_words("the lazy dog sleeps".split())
+        self.table.compact()
+        for _ in decay([self.table], 0.5, step=2):
+            pass
+        assert self.table.row(3, ("the", "lazy", "dog"), False).items() == [
+            ("sleeps", 1)]
+        assert self.table.row(3, ("quick", "brown", "fox"), False) is None
+        # Only the nodes of "the lazy dog sleeps" are left
+        assert [len(nodes.keys) + len(nodes.delta)
+                for nodes in self.table.nodes] == [2, 1]
+        nodes = self.table.nodes[0]
+        # Released nodes are reused
+        size = len(nodes.by_id)
+        self.table.add_words("quick brown fox".split())
+        assert len(nodes.by_id) == size
+        assert self.table.row(3, ("quick", "brown", "fox"), True).items() == [
+            (None, 1)]
+
+    def test_backoff(self):
+        markov = Markov("", True, False, EXAMPLE_RESPOND, order=3)
+        for line in EXAMPLE_LINES:
+            markov.on_pubmsg(None, "#test", line)
+        tables = [markov.table]
+        context = ("over", "the", "lazy")
+        markov.backoff = 1
+        assert markov.context_row(tables, context, False).items() == [
+            ("dog", 1)]
+        markov.backoff = 2
+        assert markov.context_row(tables, context, False).items() == [
+            ("dog", 2)]
+        for _ in range(20):
+            msg = markov.on_pubmsg(None, "#test", EXAMPLE_RESPOND + " fox")
+            assert msg
+
+def reference_table(lines):
+    """
+    The plain dict and Counter layout the tables used to be stored in
+    """
+    table = [{}, {}, {}]
+    for line in lines:
+        for before, word, after in Markov.triples(line):
+            for order, key in [(0, None), (1, word)]:
+                counters = table[order].setdefault(key, (Counter(), Counter()))
+                counters[0][before] += 1
+                counters[1][after] += 1
+            counters = table[2].setdefault((word, after), (Counter(), Counter()))
+            counters[0][before] += 1
+            counters = table[2].setdefault((before, word), (Counter(), Counter()))
+            counters[1][after] += 1
+    return table
@@ -0,0 +1,71 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from fortunebot import markov_train
+from fortunebot.scripts.markov import Markov
+from fortunebot.utils import MarkovTable
+
+EXAMPLE_RESPOND = "fortunebot"
+EXAMPLE_LINES = [
+    "the quick brown fox jumps over the lazy dog",
+    "the lazy dog sleeps",
+    "fortunebot say something",
+    "a quick brown dog jumps",
+    "星空 is the sky full of stars",
+    "the sky",
+] * 5
+
+class TestMarkovTrain(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sample.txt")
+        self.snapshot = os.path.join(self.tmpdir, "sample.snapshot")
+        with open(self.path, "wb") as f:
+            for line in EXAMPLE_LINES:
+                f.write((line + "\n").encode("utf-8"))
+
+    def teardown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_split_ranges(self):
+        ranges = markov_train.split_ranges(self.path, 7)
+        assert ranges[0][0] == 0
+        assert ranges[-1][1] == os.path.getsize(self.path)
+        for (_, end), (start, _) in zip(ranges, ranges[1:]):
+            assert end == start
+        with open(self.path, "rb") as f:
+            data = f.read()
+        for start, _ in ranges[1:]:
+            assert data[start-1:start] == b"\n"
+
+    def test_train_matches_markov(self):
+        markov_train.train(self.path, self.snapshot, EXAMPLE_RESPOND, 3)
+        trained, position = MarkovTable.load(self.snapshot)
+        assert position == os.path.getsize(self.path)
+        markov = Markov(self.path, True, False, EXAMPLE_RESPOND)
+        assert len(trained) == len(markov.table)
+        assert "fortunebot" not in trained
+        bases = [(0, None), (1, "the"), (1, "星空"), (2, ("the", "lazy")),
+                 (2, (None, "the")), (2, ("sky", None))]
+        for order, base in bases:
+            for prepend in [True, False]:
+                expected = markov.table.row(order, base, prepend)
+                row = trained.row(order, base, prepend)
+                assert (dict(row.items()) if row else None) == \
+                       (dict(expected.items()) if expected else None)
+
+    def test_failed_train_cleans_up(self):
+        # Writing over a directory fails once everything is counted
+        os.mkdir(self.snapshot)
+        try:
+            markov_train.train(self.path, self.snapshot, EXAMPLE_RESPOND, 2)
+            assert False
+        except EnvironmentError:
+            pass
+        assert sorted(os.listdir(self.tmpdir)) == [
+            "sample.snapshot", "sample.txt"]
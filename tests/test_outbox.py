@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from fortunebot.utils.outbox import Outbox, split_line
+
+EXAMPLE_CHANNEL = "#test"
+EXAMPLE_CHANNEL2 = "#test2"
+EXAMPLE_MSG = "abcdefg"
+EXAMPLE_MSG2 = "星空"
+
+class TestOutbox(object):
+
+    def setup(self):
+        self.sent = []
+        self.outbox = Outbox(lambda target, text: self.sent.append((target, text)),
+                             rate=100.0, burst=2)
+
+    def test_split_line(self):
+        assert split_line(EXAMPLE_MSG, 10) == [EXAMPLE_MSG]
+        assert split_line(EXAMPLE_MSG, 3) == ["abc", "def", "g"]
+        # Each character is 3 bytes
+        assert split_line(EXAMPLE_MSG2 * 3, 7) == [EXAMPLE_MSG2] * 3
+        assert split_line("aaaa bbbb cc", 10) == ["aaaa bbbb", "cc"]
+
+    def test_long_line(self):
+        line = EXAMPLE_MSG2 * 1000
+        self.outbox.put(EXAMPLE_CHANNEL, [line])
+        self.outbox.wait()
+        limit = self.outbox.limit(EXAMPLE_CHANNEL)
+        assert all(len(text.encode("utf-8")) <= limit for _, text in self.sent)
+        assert "".join(text for _, text in self.sent) == line
+
+    def test_coalesce(self):
+        messages = [str(i) for i in range(10)]
+        self.outbox.put(EXAMPLE_CHANNEL, messages)
+        self.outbox.wait()
+        assert self.sent == [(EXAMPLE_CHANNEL, "0"),
+                             (EXAMPLE_CHANNEL, " | ".join(messages[1:]))]
+
+    def test_rate(self):
+        self.outbox.configure(20.0, 1)
+        self.outbox.tokens = 0
+        start = time.time()
+        for target in [EXAMPLE_CHANNEL, EXAMPLE_CHANNEL2]:
+            self.outbox.put(target, [EXAMPLE_MSG])
+        self.outbox.wait()
+        assert time.time() - start >= 0.09
+        assert self.sent == [(EXAMPLE_CHANNEL, EXAMPLE_MSG),
+                             (EXAMPLE_CHANNEL2, EXAMPLE_MSG)]
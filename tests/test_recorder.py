@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+
+from fortunebot.scripts.markov import Markov
+from fortunebot.utils import Recorder, MarkovTable
+from fortunebot.utils.recorder import segments, read_lines, end_position
+
+EXAMPLE_RESPOND = "fortunebot"
+EXAMPLE_LINES = [
+    "the quick brown fox jumps over the lazy dog",
+    "the lazy dog sleeps",
+    "a quick brown dog jumps",
+    "星空 is the sky full of stars",
+    "the sky",
+]
+
+class TestRecorder(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "sample.txt")
+        self.recorder = None
+
+    def teardown(self):
+        if self.recorder:
+            self.recorder.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_batches(self):
+        self.recorder = Recorder(self.path, flush_lines=3, flush_interval=60)
+        self.recorder.write(EXAMPLE_LINES[0])
+        assert os.path.getsize(self.path) == 0
+        self.recorder.write(EXAMPLE_LINES[1])
+        self.recorder.write(EXAMPLE_LINES[2])
+        position = self.recorder.flush()
+        assert position == os.path.getsize(self.path)
+        assert [line for _, line in read_lines(self.path)] == \
+            [line + "\n" for line in EXAMPLE_LINES[:3]]
+
+    def test_rotation(self):
+        self.recorder = Recorder(self.path, flush_interval=60,
+                                 segment_size=50, keep=2)
+        expected = []
+        for i in range(10):
+            line = "{0} {1}".format(i, EXAMPLE_LINES[i % len(EXAMPLE_LINES)])
+            expected.append(line + "\n")
+            self.recorder.write(line)
+            self.recorder.flush()
+        self.recorder.compress()
+        found = segments(self.path)
+        assert len(found) == 2
+        names = os.listdir(self.tmpdir)
+        for start, end in found:
+            assert "sample.txt.{0}-{1}.gz".format(start, end) in names
+        # Positions in the stream still line up after rotating
+        lines = list(read_lines(self.path))
+        assert lines[0][1] == expected[-len(lines)]
+        assert [line for _, line in lines] == expected[-len(lines):]
+        position = lines[-3][0]
+        assert [line for _, line in read_lines(self.path, position)] == \
+            expected[-2:]
+        assert lines[-1][0] == end_position(self.path)
+
+    def test_markov(self):
+        snapshot = os.path.join(self.tmpdir, "sample.snapshot")
+        markov = Markov(self.path, True, True, EXAMPLE_RESPOND, snapshot,
+                        flush_interval=60)
+        for line in EXAMPLE_LINES:
+            markov.on_pubmsg(None, "#test", line)
+        markov.save_snapshot()
+        markov.on_unload()
+        _, position = MarkovTable.load(snapshot)
+        assert position == os.path.getsize(self.path)
+        markov = Markov(self.path, True, False, EXAMPLE_RESPOND)
+        assert markov.table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 2), ("sky", 2)]
+
+    def test_shared_corpus(self):
+        snapshot = os.path.join(self.tmpdir, "sample.snapshot")
+        writer = Markov(self.path, True, True, EXAMPLE_RESPOND, snapshot,
+                        flush_interval=60)
+        reader = Markov(self.path, True, True, EXAMPLE_RESPOND, snapshot,
+                        flush_interval=60, snapshot_save=False)
+        writer.on_pubmsg(None, "#test", EXAMPLE_LINES[0])
+        reader.on_pubmsg(None, "#test", EXAMPLE_LINES[3])
+        reader.recorder.flush()
+        writer.on_pubmsg(None, "#test", EXAMPLE_LINES[4])
+        writer.save_snapshot()
+        # The reader switches over to the newer snapshot on its next poll,
+        # dropping the counts it covers
+        assert reader.next_poll("#test") == reader.snapshot_due
+        reader.refresh_snapshot()
+        assert reader.table.generation == writer.table.generation
+        assert reader.table.delta_size() == 0
+        assert reader.table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 1), ("sky", 2)]
+        # and merges what it hears in the meantime on its own
+        assert not reader.table.transitions[1][1].pinned
+        reader.on_unload()
+        writer.on_unload()
+        # The writer learned the reader's line before saving past it
+        assert "星空" in writer.table
+        table, position = MarkovTable.load(snapshot)
+        assert position == os.path.getsize(self.path)
+        assert "星空" in table
+        assert table.row(1, "the", False).items() == [
+            ("quick", 1), ("lazy", 1), ("sky", 2)]
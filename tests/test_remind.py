@@ -0,0 +1,77 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import mock
+
+from fortunebot.scripts.remind import Remind
+
+EXAMPLE_CHANNEL = "#test"
+EXAMPLE_CHANNEL2 = "#test2"
+EXAMPLE_TIME = 1000000
+
+class TestRemind(object):
+
+    def setup(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "remind.db")
+        self.now = EXAMPLE_TIME
+        self.patcher = mock.patch("time.time", lambda: self.now)
+        self.patcher.start()
+
+    def teardown(self):
+        self.patcher.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_memory(self):
+        remind = Remind(2)
+        assert remind.on_pubmsg(None, EXAMPLE_CHANNEL, "!remind -s 10 hi") \
+            == "Task registered"
+        assert remind.next_poll(EXAMPLE_CHANNEL) == EXAMPLE_TIME + 10
+        self.now += 10
+        assert remind.on_poll(EXAMPLE_CHANNEL) == ["hi"]
+        assert remind.next_poll(EXAMPLE_CHANNEL) is None
+
+    def test_survives_restart(self):
+        remind = Remind(10, self.path)
+        remind.set_reminder(EXAMPLE_CHANNEL, 10, "soon")
+        remind.set_reminder(EXAMPLE_CHANNEL2, 2 * Remind.WINDOW, "later")
+        assert remind.next_poll(EXAMPLE_CHANNEL) == EXAMPLE_TIME + 1
+        remind.on_unload()
+        remind = Remind(10, self.path)
+        assert remind.next_poll(EXAMPLE_CHANNEL) == EXAMPLE_TIME + 10
+        assert EXAMPLE_CHANNEL2 not in remind.tasks
+        self.now += 10
+        assert remind.on_poll(EXAMPLE_CHANNEL) == ["soon"]
+        remind = Remind(10, self.path)
+        assert remind.store.count(EXAMPLE_CHANNEL) == 0
+        assert remind.store.count(EXAMPLE_CHANNEL2) == 1
+
+    def test_window(self):
+        remind = Remind(10, self.path)
+        remind.set_reminder(EXAMPLE_CHANNEL, Remind.WINDOW + 10, "later")
+        assert remind.on_poll(EXAMPLE_CHANNEL) is None
+        assert remind.next_poll(EXAMPLE_CHANNEL) \
+            == EXAMPLE_TIME + Remind.WINDOW // 2
+        self.now += Remind.WINDOW // 2
+        assert remind.on_poll(EXAMPLE_CHANNEL) is None
+        assert EXAMPLE_CHANNEL in remind.tasks
+        assert remind.next_poll(EXAMPLE_CHANNEL) \
+            == EXAMPLE_TIME + Remind.WINDOW
+        self.now += Remind.WINDOW // 2
+        assert remind.on_poll(EXAMPLE_CHANNEL) is None
+        assert remind.next_poll(EXAMPLE_CHANNEL) \
+            == EXAMPLE_TIME + Remind.WINDOW + 10
+        self.now += 10
+        assert remind.on_poll(EXAMPLE_CHANNEL) == ["later"]
+
+    def test_limit(self):
+        remind = Remind(1, self.path)
+        assert remind.set_reminder(EXAMPLE_CHANNEL, 10, "a") == "Task registered"
+        assert remind.set_reminder(EXAMPLE_CHANNEL, 10, "b").startswith("NOPE")
+        assert remind.set_reminder(EXAMPLE_CHANNEL2, 10, "c") == "Task registered"
+        remind.on_unload()
+        remind = Remind(1, self.path)
+        assert remind.set_reminder(EXAMPLE_CHANNEL, 10, "b").startswith("NOPE")
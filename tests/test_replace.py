@@ -0,0 +1,83 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import irc.client
+
+from fortunebot.scripts.replace import Replace
+from fortunebot.utils.historystore import (HistoryStore, LINE_OVERHEAD,
+                                           HISTORY_OVERHEAD)
+
+EXAMPLE_SOURCE = irc.client.NickMask("nick!user@example.com")
+EXAMPLE_CHANNEL = "#test"
+
+class TestReplace(object):
+
+    def setup(self):
+        self.replace = Replace(True, 200, 20, 0.5)
+        for text in ["the quick brown fox", "a" * 30 + "!", "hello world"]:
+            self.send(text)
+
+    def teardown(self):
+        self.replace.on_unload()
+
+    def send(self, text):
+        return self.replace.on_pubmsg(EXAMPLE_SOURCE, EXAMPLE_CHANNEL, text)
+
+    def test_replace(self):
+        assert self.send("s/world/there/") == "nick meant: hello there"
+        assert self.send("s/quick/slow/3") == "nick meant: the slow brown fox"
+        assert self.send("s/qu(i)ck/sl\\1m/s") \
+            == "nick meant: the slim brown fox"
+        assert self.send("s/nope/x/s") \
+            == "Unable to find anything that matches pattern!"
+
+    def test_invalid(self):
+        assert self.send("s/(/x/") == "But nick, that's not valid regex!"
+        assert self.send("s/(/x/s") == "But nick, that's not valid regex!"
+        assert self.send("s/o/\\9/") == "But nick, that's not valid regex!"
+
+    def test_catastrophic(self):
+        start = time.time()
+        assert self.send("s/(a+)+$/x/s").startswith("Nice try")
+        assert time.time() - start < 2
+        # The worker is replaced afterwards
+        assert self.send("s/world/there/") == "nick meant: hello there"
+
+    def test_channels(self):
+        self.replace.on_pubmsg(EXAMPLE_SOURCE, "#other", "goodbye world")
+        assert self.send("s/world/there/") == "nick meant: hello there"
+        assert self.replace.on_pubmsg(EXAMPLE_SOURCE, "#other",
+                                      "s/world/there/") \
+            == "nick meant: goodbye there"
+        assert self.replace.on_pubmsg(EXAMPLE_SOURCE, "#empty",
+                                      "s/world/there/") is None
+
+class TestHistoryStore(object):
+
+    def setup(self):
+        self.size = HISTORY_OVERHEAD + 2 * (LINE_OVERHEAD + 5)
+        self.store = HistoryStore(2, 3 * self.size)
+
+    def test_maxlines(self):
+        for text in ["one", "two", "three"]:
+            self.store.add(EXAMPLE_CHANNEL, "nick", text)
+        assert self.store.get(EXAMPLE_CHANNEL, "nick") == ["three", "two"]
+        assert self.store.get("#other", "nick") == []
+
+    def test_evict(self):
+        for nick in ["a", "b", "c"]:
+            self.store.add(EXAMPLE_CHANNEL, nick, "hello")
+            self.store.add(EXAMPLE_CHANNEL, nick, "world")
+        assert self.store.size == 3 * self.size
+        assert len(self.store) == 3
+        # Using a history keeps it from being evicted first
+        self.store.get(EXAMPLE_CHANNEL, "a")
+        self.store.add(EXAMPLE_CHANNEL, "d", "hello")
+        assert (EXAMPLE_CHANNEL, "b") not in self.store
+        assert (EXAMPLE_CHANNEL, "a") in self.store
+        assert self.store.size <= 3 * self.size
+
+    def test_unicode(self):
+        self.store.add(EXAMPLE_CHANNEL, "nick", u"h\xe9llo")
+        assert self.store.get(EXAMPLE_CHANNEL, "nick") == [u"h\xe9llo"]
@@ -0,0 +1,58 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from collections import OrderedDict
+
+from fortunebot.utils import Router
+
+class TestRouter(object):
+
+    def setup(self):
+        self.scripts = OrderedDict([
+            ("listener", Listener()),
+            ("command", Command()),
+            ("prefix", Prefix()),
+            ("pattern", Pattern()),
+            ("silent", object()),
+        ])
+        self.router = Router(self.scripts)
+
+    def routed(self, text):
+        return [name for name, _ in self.router.route(text)]
+
+    def test_everything(self):
+        assert self.routed("") == ["listener"]
+        assert self.routed("hello there") == ["listener"]
+
+    def test_commands(self):
+        assert self.routed("!cmd arg") == ["listener", "command"]
+        assert self.routed("!CMD") == ["listener", "command"]
+        assert self.routed("arg !cmd") == ["listener"]
+
+    def test_prefixes(self):
+        assert self.routed("s/a/b/") == ["listener", "prefix"]
+        assert self.routed("as/a/b/") == ["listener"]
+
+    def test_patterns(self):
+        assert self.routed("so your FACE") == ["listener", "pattern"]
+
+    def test_order(self):
+        assert self.routed("s/your face/") == ["listener", "prefix", "pattern"]
+
+    def test_scripts(self):
+        for name, script in self.router.route("!cmd"):
+            assert script is self.scripts[name]
+
+class Listener(object):
+    def on_pubmsg(self, source, channel, text):
+        pass
+
+class Command(Listener):
+    COMMANDS = ["!cmd", "!command"]
+
+class Prefix(Listener):
+    PREFIXES = ["s/"]
+
+class Pattern(Listener):
+    def __init__(self):
+        self.PATTERNS = ["your.*face"]
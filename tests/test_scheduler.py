@@ -0,0 +1,55 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+
+from fortunebot.utils import Scheduler
+
+EXAMPLE_KEY = ("remind", "#test")
+
+class TestScheduler(object):
+
+    def setup(self):
+        self.called = []
+        self.scheduler = Scheduler()
+        self.scheduler.start()
+
+    def teardown(self):
+        self.scheduler.cancel()
+
+    def call(self, value):
+        return lambda: self.called.append(value)
+
+    def test_order(self):
+        self.scheduler.call_later(0.2, self.call("b"))
+        self.scheduler.call_later(0.1, self.call("a"))
+        self.scheduler.call_later(0, self.call("now"))
+        time.sleep(0.05)
+        assert self.called == ["now"]
+        time.sleep(0.25)
+        assert self.called == ["now", "a", "b"]
+
+    def test_replace(self):
+        self.scheduler.call_later(0.1, self.call("old"), EXAMPLE_KEY)
+        self.scheduler.call_later(0.2, self.call("new"), EXAMPLE_KEY)
+        assert self.scheduler.scheduled() == [EXAMPLE_KEY]
+        time.sleep(0.3)
+        assert self.called == ["new"]
+        assert self.scheduler.scheduled() == []
+
+    def test_remove(self):
+        self.scheduler.call_later(0.1, self.call("a"), EXAMPLE_KEY)
+        self.scheduler.remove(EXAMPLE_KEY)
+        time.sleep(0.2)
+        assert self.called == []
+
+    def test_stale_entries_dropped(self):
+        for i in range(1000):
+            self.scheduler.call_later(60, self.call(i), EXAMPLE_KEY)
+        assert len(self.scheduler.heap) < 200
+
+    def test_errors(self):
+        self.scheduler.call_later(0, lambda: 1 // 0)
+        self.scheduler.call_later(0.05, self.call("a"))
+        time.sleep(0.1)
+        assert self.called == ["a"]
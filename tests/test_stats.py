@@ -0,0 +1,59 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from six.moves.urllib.request import urlopen
+
+from fortunebot.utils import Stats, StatsServer
+
+EXAMPLE_CHANNEL = "#test"
+EXAMPLE_SCRIPT = "weather"
+EXAMPLE_HOOK = "on_pubmsg"
+
+class TestStats(object):
+
+    def setup(self):
+        self.stats = Stats()
+        self.stats.record(EXAMPLE_SCRIPT, EXAMPLE_HOOK, 0.002)
+        self.stats.record(EXAMPLE_SCRIPT, EXAMPLE_HOOK, 0.2, True)
+        self.stats.message(EXAMPLE_CHANNEL)
+        self.stats.add_gauge("outbox_depth", lambda: 3)
+
+    def test_snapshot(self):
+        data = self.stats.snapshot()
+        script = data["scripts"][0]
+        assert script["calls"] == 2
+        assert script["errors"] == 1
+        assert script["p50"] == 0.005
+        assert script["p95"] == 0.5
+        assert data["channels"][EXAMPLE_CHANNEL]["messages"] == 1
+        assert data["gauges"] == {"outbox_depth": 3}
+
+    def test_prometheus(self):
+        lines = self.stats.prometheus().splitlines()
+        labels = '{hook="on_pubmsg",script="weather"}'
+        assert "fortunebot_script_calls_total" + labels + " 2" in lines
+        assert "fortunebot_script_errors_total" + labels + " 1" in lines
+        assert 'fortunebot_script_latency_seconds_bucket{hook="on_pubmsg",' \
+            'le="0.01",script="weather"} 1' in lines
+        assert 'fortunebot_script_latency_seconds_bucket{hook="on_pubmsg",' \
+            'le="+Inf",script="weather"} 2' in lines
+        assert 'fortunebot_channel_messages_total{channel="#test"} 1' in lines
+        assert "fortunebot_outbox_depth 3" in lines
+
+    def test_summary(self):
+        summary = self.stats.summary()
+        assert summary.startswith("weather.on_pubmsg: 2 calls, 1 errors")
+        assert "outbox_depth: 3" in summary
+
+    def test_server(self):
+        server = StatsServer(self.stats, "127.0.0.1", 0)
+        server.start()
+        try:
+            url = "http://127.0.0.1:{0}".format(server.server_address[1])
+            data = json.loads(urlopen(url + "/stats").read().decode("utf-8"))
+            assert data["scripts"][0]["calls"] == 2
+            text = urlopen(url + "/metrics").read().decode("utf-8")
+            assert "fortunebot_outbox_depth 3" in text
+        finally:
+            server.stop()
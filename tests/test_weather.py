@@ -0,0 +1,80 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import time
+import threading
+import mock
+
+from fortunebot.scripts.weather import Weather
+
+MODULE = "fortunebot.scripts.weather"
+
+EXAMPLE_ZIP = "90024"
+EXAMPLE_CACHEDUR = 100
+EXAMPLE_DATA = {"data": {
+    "nearest_area": [{"areaName": [{"value": "Los Angeles"}],
+                      "region": [{"value": "California"}]}],
+    "current_condition": [{"temp_F": "70", "temp_C": "21",
+                           "weatherDesc": [{"value": "Sunny"}],
+                           "humidity": "40"}],
+}}
+
+class TestWeather(object):
+
+    def setup(self):
+        self.now = 1000000
+        self.time_patcher = mock.patch("time.time", lambda: self.now)
+        self.time_patcher.start()
+        self.client = mock.Mock()
+        self.release = threading.Event()
+        self.release.set()
+        def get(url):
+            self.release.wait()
+            return mock.Mock(text=json.dumps(EXAMPLE_DATA))
+        self.client.get.side_effect = get
+        self.client_patcher = mock.patch(MODULE + ".get_client",
+                                         lambda: self.client)
+        self.client_patcher.start()
+        self.weather = Weather("key", EXAMPLE_CACHEDUR, "")
+
+    def teardown(self):
+        self.client_patcher.stop()
+        self.time_patcher.stop()
+
+    def test_single_flight(self):
+        self.release.clear()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            self.weather.get_weather(EXAMPLE_ZIP))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        while ("zip", EXAMPLE_ZIP) not in self.weather.flights:
+            time.sleep(0.01)
+        self.release.set()
+        for t in threads:
+            t.join()
+        assert len(set(results)) == 1
+        assert "Sunny" in results[0]
+        assert self.client.get.call_count == 1
+
+    def test_stale_while_revalidate(self):
+        first = self.weather.get_weather(EXAMPLE_ZIP)
+        self.now += EXAMPLE_CACHEDUR // 2
+        assert self.weather.get_weather(EXAMPLE_ZIP) == first
+        assert self.client.get.call_count == 1
+        self.now += EXAMPLE_CACHEDUR // 3
+        assert self.weather.get_weather(EXAMPLE_ZIP) == first
+        while ("zip", EXAMPLE_ZIP) in self.weather.flights:
+            time.sleep(0.01)
+        assert self.client.get.call_count == 2
+        assert self.weather.zipcache.expires(EXAMPLE_ZIP) \
+            == self.now + EXAMPLE_CACHEDUR
+
+    def test_connection_failure(self):
+        self.client.get.side_effect = IOError
+        assert self.weather.get_weather(EXAMPLE_ZIP) \
+            == "Unable to connect to weather API!"
+        assert EXAMPLE_ZIP not in self.weather.zipcache
+        assert self.weather.get_zip("host") == ""
+        assert "host" not in self.weather.hostcache